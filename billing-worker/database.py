@@ -1,3 +1,4 @@
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
@@ -16,6 +17,70 @@ AsyncSessionLocal = sessionmaker(
     expire_on_commit=False
 )
 
+# create_all creates missing tables but never changes existing ones. Columns and constraints added to
+# existing tables are listed here and added on startup; each statement must be safe to repeat.
+SCHEMA_UPGRADES = [
+    # Rate limit algorithm per plan
+    "ALTER TABLE plans ADD COLUMN IF NOT EXISTS rate_limit_algorithm VARCHAR",
+    # Request and response bytes metered separately; totals can exceed 2 GiB a day
+    "ALTER TABLE usage_aggregates ADD COLUMN IF NOT EXISTS total_request_bytes BIGINT DEFAULT 0",
+    "ALTER TABLE usage_aggregates ADD COLUMN IF NOT EXISTS total_response_bytes BIGINT DEFAULT 0",
+    "ALTER TABLE usage_aggregates ALTER COLUMN total_bytes TYPE BIGINT",
+    # Per-plan rate limit policies
+    "ALTER TABLE plans ADD COLUMN IF NOT EXISTS rate_limit_requests INTEGER",
+    "ALTER TABLE plans ADD COLUMN IF NOT EXISTS rate_limit_window_seconds INTEGER",
+    "ALTER TABLE plans ADD COLUMN IF NOT EXISTS rate_limit_burst INTEGER",
+    # Per-API response cache
+    "ALTER TABLE apis ADD COLUMN IF NOT EXISTS response_cache_enabled BOOLEAN NOT NULL DEFAULT false",
+    "ALTER TABLE apis ADD COLUMN IF NOT EXISTS response_cache_vary_headers VARCHAR",
+    "ALTER TABLE apis ADD COLUMN IF NOT EXISTS response_cache_max_ttl_seconds INTEGER",
+    # Behaviour of each plan while Redis is unreachable
+    "ALTER TABLE plans ADD COLUMN IF NOT EXISTS rate_limit_failure_mode VARCHAR",
+    # Upstream load balancing and health checks; upstream_targets is a new table
+    "ALTER TABLE apis ADD COLUMN IF NOT EXISTS load_balancing VARCHAR",
+    "ALTER TABLE apis ADD COLUMN IF NOT EXISTS health_check_path VARCHAR",
+    # Load shedding priority; left NULL, so existing plans get the default for their price
+    "ALTER TABLE plans ADD COLUMN IF NOT EXISTS priority INTEGER",
+    # One usage row per API, client and day, which the billing worker upserts against.
+    # Duplicate rows are merged into the oldest one before the constraint is added
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_usage_aggregates_api_client_date') THEN
+            RETURN;
+        END IF;
+        LOCK TABLE usage_aggregates IN SHARE ROW EXCLUSIVE MODE;
+        -- Another service may have added it while this one waited for the lock
+        IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_usage_aggregates_api_client_date') THEN
+            RETURN;
+        END IF;
+        UPDATE usage_aggregates AS u SET
+            total_requests = d.total_requests,
+            total_bytes = d.total_bytes,
+            total_request_bytes = d.total_request_bytes,
+            total_response_bytes = d.total_response_bytes
+        FROM (
+            SELECT
+                min(id) AS id,
+                sum(coalesce(total_requests, 0)) AS total_requests,
+                sum(coalesce(total_bytes, 0)) AS total_bytes,
+                sum(coalesce(total_request_bytes, 0)) AS total_request_bytes,
+                sum(coalesce(total_response_bytes, 0)) AS total_response_bytes
+            FROM usage_aggregates
+            GROUP BY api_id, client_id, date
+            HAVING count(*) > 1
+        ) AS d
+        WHERE u.id = d.id;
+        DELETE FROM usage_aggregates AS u
+        USING usage_aggregates AS kept
+        WHERE kept.api_id = u.api_id AND kept.client_id = u.client_id AND kept.date = u.date AND kept.id < u.id;
+        ALTER TABLE usage_aggregates
+            ADD CONSTRAINT uq_usage_aggregates_api_client_date UNIQUE (api_id, client_id, date);
+    END
+    $$
+    """,
+]
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
@@ -23,3 +88,5 @@ async def get_db():
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
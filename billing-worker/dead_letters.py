@@ -0,0 +1,41 @@
+import time
+from typing import Dict
+
+from prometheus_client import Counter
+
+USAGE_DLQ_KEY = "usage_events:dlq"
+
+MALFORMED = "malformed" # The event could not be parsed; retrying cannot help
+MAX_DELIVERIES = "max_deliveries" # Every attempt to process the event failed
+
+# Fields added to a dead-lettered event next to its original fields
+DLQ_FIELDS = ("dlq_reason", "dlq_error", "dlq_stream", "dlq_message_id", "dlq_deliveries", "dlq_failed_at")
+
+BILLING_USAGE_EVENTS_DEAD_LETTERED = Counter('billing_usage_events_dead_lettered_total', 'Usage events moved to the dead-letter stream', ['reason'])
+
+
+def retry_backoff_ms(deliveries: int, base_ms: int, max_ms: int) -> int:
+    """How long an entry delivered `deliveries` times stays pending before its next attempt."""
+    return min(max_ms, base_ms * 2 ** max(0, deliveries - 1))
+
+
+def dead_letter(pipe, stream: str, group: str, message_id: str, event: Dict[str, str], reason: str, error: str, deliveries: int, maxlen: int):
+    """Queues on `pipe` the move of one entry from `stream` to the dead-letter stream.
+
+    Run the pipeline as a transaction so that the entry is acknowledged only
+    together with the write of its dead-letter copy.
+    """
+    pipe.xadd(USAGE_DLQ_KEY, {
+        **event,
+        "dlq_reason": reason,
+        "dlq_error": error[:500],
+        "dlq_stream": stream,
+        "dlq_message_id": message_id,
+        "dlq_deliveries": deliveries,
+        "dlq_failed_at": time.time(),
+    }, maxlen=maxlen, approximate=True)
+    pipe.xack(stream, group, message_id)
+
+
+def original_event(entry: Dict[str, str]) -> Dict[str, str]:
+    return {field: value for field, value in entry.items() if field not in DLQ_FIELDS}
@@ -0,0 +1,133 @@
+"""Inspect, replay and purge dead-lettered usage events.
+
+Events land in the usage_events:dlq stream when they cannot be parsed or keep
+failing (see billing-worker/main.py). Replaying puts an event back on the
+partition it came from, where the billing workers pick it up as a new entry.
+
+    python dlq_cli.py stats
+    python dlq_cli.py list --count 20 --reason malformed
+    python dlq_cli.py replay --reason max_deliveries
+    python dlq_cli.py replay --id 1712345678901-0 --id 1712345678902-0
+    python dlq_cli.py purge --before 2024-04-01
+"""
+import argparse
+import json
+import os
+from collections import Counter
+from datetime import datetime, timezone
+
+import redis
+
+from dead_letters import USAGE_DLQ_KEY, original_event
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+PAGE_SIZE = 500
+
+
+def iter_entries(r: redis.Redis, args):
+    """Yields the dead-lettered (entry_id, fields) pairs selected by the command line."""
+    if args.id:
+        for entry_id in args.id:
+            for entry in r.xrange(USAGE_DLQ_KEY, min=entry_id, max=entry_id):
+                yield entry
+        return
+
+    max_id = "+"
+    if args.before:
+        max_id = f"({int(datetime.fromisoformat(args.before).replace(tzinfo=timezone.utc).timestamp() * 1000)}-0"
+    start_id, yielded = "-", 0
+    while True:
+        page = r.xrange(USAGE_DLQ_KEY, min=start_id, max=max_id, count=PAGE_SIZE)
+        for entry_id, fields in page:
+            if args.reason and fields.get("dlq_reason") != args.reason:
+                continue
+            yield entry_id, fields
+            yielded += 1
+            if args.count and yielded >= args.count:
+                return
+        if len(page) < PAGE_SIZE:
+            return
+        start_id = f"({page[-1][0]}"
+
+
+def command_stats(r: redis.Redis, args):
+    reasons = Counter(fields.get("dlq_reason") for _, fields in iter_entries(r, args))
+    print(f"{sum(reasons.values())} dead-lettered usage events")
+    for reason, count in reasons.most_common():
+        print(f"  {reason}: {count}")
+
+
+def command_list(r: redis.Redis, args):
+    for entry_id, fields in iter_entries(r, args):
+        failed_at = datetime.fromtimestamp(float(fields.get("dlq_failed_at", 0)), timezone.utc).isoformat()
+        print(json.dumps({
+            "id": entry_id,
+            "reason": fields.get("dlq_reason"),
+            "error": fields.get("dlq_error"),
+            "stream": fields.get("dlq_stream"),
+            "message_id": fields.get("dlq_message_id"),
+            "deliveries": fields.get("dlq_deliveries"),
+            "failed_at": failed_at,
+            "event": original_event(fields),
+        }))
+
+
+def command_replay(r: redis.Redis, args):
+    # Collected first so that replayed entries are not paged over while being deleted
+    entries = []
+    for entry_id, fields in iter_entries(r, args):
+        if not fields.get("dlq_stream"):
+            print(f"Skipping {entry_id}: no source stream recorded")
+            continue
+        entries.append((entry_id, fields))
+    if args.dry_run:
+        for entry_id, fields in entries:
+            print(f"Would replay {entry_id} to {fields['dlq_stream']}")
+        return
+
+    for start in range(0, len(entries), PAGE_SIZE):
+        # Each chunk moves in one transaction, so an event is never both replayed and kept
+        with r.pipeline(transaction=True) as pipe:
+            for entry_id, fields in entries[start:start + PAGE_SIZE]:
+                pipe.xadd(fields["dlq_stream"], original_event(fields))
+                pipe.xdel(USAGE_DLQ_KEY, entry_id)
+            pipe.execute()
+    print(f"Replayed {len(entries)} usage events")
+
+
+def command_purge(r: redis.Redis, args):
+    entry_ids = [entry_id for entry_id, _ in iter_entries(r, args)]
+    if args.dry_run:
+        print(f"Would delete {len(entry_ids)} usage events")
+        return
+    for start in range(0, len(entry_ids), PAGE_SIZE):
+        r.xdel(USAGE_DLQ_KEY, *entry_ids[start:start + PAGE_SIZE])
+    print(f"Deleted {len(entry_ids)} usage events")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=REDIS_URL, help="defaults to $REDIS_URL")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, command, help_text in (
+        ("stats", command_stats, "count dead-lettered events by reason"),
+        ("list", command_list, "print dead-lettered events as JSON lines"),
+        ("replay", command_replay, "put dead-lettered events back on their partitions"),
+        ("purge", command_purge, "delete dead-lettered events"),
+    ):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.set_defaults(handler=command)
+        subparser.add_argument("--reason", help="only events dead-lettered for this reason (malformed, max_deliveries)")
+        subparser.add_argument("--before", help="only events dead-lettered before this ISO date or time (UTC)")
+        subparser.add_argument("--id", action="append", help="only this dead-letter entry; may be repeated")
+        subparser.add_argument("--count", type=int, help="at most this many events")
+        if name in ("replay", "purge"):
+            subparser.add_argument("--dry-run", action="store_true", help="show what would happen without changing anything")
+    args = parser.parse_args()
+
+    r = redis.from_url(args.redis_url, decode_responses=True)
+    args.handler(r, args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,21 +1,28 @@
 import os
 import redis.asyncio as redis
 import asyncio
+import time
 import json
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 from collections import defaultdict
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import sessionmaker, joinedload
-from sqlalchemy import func
-
-from database import Base # Import Base from the copied database.py
-from models import UsageAggregate, API, Client, Plan, User, Subscription, Invoice, Payout # Import models from the copied models.py
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import BigInteger, and_, case, cast, delete, func, literal, or_, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
+
+from database import Base, SCHEMA_UPGRADES # Import Base from the copied database.py
+from models import UsageAggregate, UsageRollupMonth, API, Client, Plan, User, Subscription, Invoice, Payout, BillingRun, BillingLedger # Import models from the copied models.py
+from partitions import PartitionAssigner, usage_stream_key
+from usage_rollups import RESOLUTIONS, ROLLUP_MODELS, TOTAL_COLUMNS, bucket_column, bucket_start, retained_since, usage_totals_query
+from dead_letters import BILLING_USAGE_EVENTS_DEAD_LETTERED, MALFORMED, MAX_DELIVERIES, dead_letter, retry_backoff_ms
+from stripe_calls import StripeCaller
 from redis import exceptions as redis_exceptions
 import stripe
 
-from prometheus_client import start_http_server, Counter, Histogram, generate_latest
+from prometheus_client import start_http_server, Counter, Gauge, Histogram, generate_latest
 
 import logging
 import uuid
@@ -44,16 +51,77 @@ DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:example@
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 
 stripe.api_key = STRIPE_SECRET_KEY
-
-USAGE_STREAM_KEY = "usage_events"
+# Stripe allows 100 requests per second in live mode and 25 in test mode, shared by
+# everything using the account; see stripe_calls.py
+STRIPE_REQUESTS_PER_SECOND = float(os.getenv("STRIPE_REQUESTS_PER_SECOND", "20"))
+STRIPE_MAX_CONCURRENCY = int(os.getenv("STRIPE_MAX_CONCURRENCY", "8")) # Stripe requests in flight at once
+STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", "4")) # Per request, for rate limited, connection and server errors
+
+USAGE_STREAM_KEY = "usage_events" # Partitions are usage_events:0 .. usage_events:<n-1>
+USAGE_STREAM_PARTITIONS = int(os.getenv("USAGE_STREAM_PARTITIONS", "8")) # Must match the gateway
 CONSUMER_GROUP = "billing_group"
-CONSUMER_NAME = os.getenv("HOSTNAME", "billing_consumer_1")
+CONSUMER_NAME = f"{os.getenv('HOSTNAME', 'billing_consumer')}-{os.getpid()}" # Unique per process, so several can run on one host
+
+# Live workers split the partitions between them; see partitions.py
+USAGE_CONSUMERS_KEY = "usage_consumers"
+USAGE_CONSUMER_HEARTBEAT_INTERVAL = float(os.getenv("USAGE_CONSUMER_HEARTBEAT_INTERVAL", "5")) # seconds
+USAGE_CONSUMER_TIMEOUT = float(os.getenv("USAGE_CONSUMER_TIMEOUT", "15")) # seconds without a heartbeat before a worker is dropped
+# Entries delivered but not acknowledged for this long are claimed again, e.g. after a crash or a failed batch.
+# Each further attempt waits twice as long, and entries that keep failing go to the dead-letter stream.
+USAGE_CLAIM_INTERVAL = float(os.getenv("USAGE_CLAIM_INTERVAL", "30")) # seconds
+USAGE_CLAIM_MIN_IDLE_MS = int(os.getenv("USAGE_CLAIM_MIN_IDLE_MS", "60000"))
+USAGE_RETRY_MAX_BACKOFF_MS = int(os.getenv("USAGE_RETRY_MAX_BACKOFF_MS", "900000"))
+USAGE_MAX_DELIVERIES = int(os.getenv("USAGE_MAX_DELIVERIES", "5"))
+USAGE_DLQ_MAXLEN = int(os.getenv("USAGE_DLQ_MAXLEN", "100000")) # Approximate cap on dead-lettered entries
+USAGE_ERROR_MAX_BACKOFF = float(os.getenv("USAGE_ERROR_MAX_BACKOFF", "30")) # seconds between attempts while reads or writes keep failing
+
+# Usage events are read in batches that grow with the consumer group's lag and shrink once it catches up
+USAGE_BATCH_MIN_SIZE = int(os.getenv("USAGE_BATCH_MIN_SIZE", "100"))
+USAGE_BATCH_MAX_SIZE = int(os.getenv("USAGE_BATCH_MAX_SIZE", "10000"))
+USAGE_READ_BLOCK_MS = int(os.getenv("USAGE_READ_BLOCK_MS", "1000"))
+# Rows per upsert statement; at 7 parameters a row this stays well within asyncpg's 32,767 parameters
+USAGE_UPSERT_CHUNK_SIZE = int(os.getenv("USAGE_UPSERT_CHUNK_SIZE", "1000"))
+
+# Monthly billing runs; see process_monthly_billing
+BILLING_CHECK_INTERVAL_SECONDS = int(os.getenv("BILLING_CHECK_INTERVAL_SECONDS", "3600"))
+BILLING_RUN_CHUNK_SIZE = int(os.getenv("BILLING_RUN_CHUNK_SIZE", "100")) # Ledger rows loaded at a time
+BILLING_RUN_LEASE_SECONDS = int(os.getenv("BILLING_RUN_LEASE_SECONDS", "600")) # Renewed after every chunk
+BILLING_MAX_ATTEMPTS = int(os.getenv("BILLING_MAX_ATTEMPTS", "5")) # Per ledger row, across passes
+BYTES_PER_MB = 1024 * 1024
+
+# Monthly quota counters maintained by the gateway (see gateway/quota.py)
+QUOTA_KEY_PREFIX = "quota:"
+QUOTA_KEY_GRACE_SECONDS = 7 * 24 * 3600
+QUOTA_RECONCILE_INTERVAL_SECONDS = int(os.getenv("QUOTA_RECONCILE_INTERVAL_SECONDS", "300"))
+
+# Minute and hour rollups older than their retention (see usage_rollups.py) are deleted in chunks
+ROLLUP_RETENTION_INTERVAL_SECONDS = int(os.getenv("ROLLUP_RETENTION_INTERVAL_SECONDS", "3600"))
+ROLLUP_RETENTION_DELETE_BATCH = int(os.getenv("ROLLUP_RETENTION_DELETE_BATCH", "10000"))
+
+# Raise a counter to the persisted total but never lower it: the gateway counter
+# also includes requests whose usage events have not been aggregated yet.
+RECONCILE_QUOTA_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local persisted = tonumber(ARGV[1])
+if persisted > current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EXAT', ARGV[2])
+    return persisted
+end
+return current
+"""
 
 # Prometheus Metrics for Billing Worker
 BILLING_PROCESS_COUNT = Counter('billing_process_total', 'Total billing processes run')
 BILLING_INVOICE_COUNT = Counter('billing_invoices_created_total', 'Total invoices created', ['status'])
 BILLING_PAYOUT_COUNT = Counter('billing_payouts_total', 'Total payouts initiated', ['status'])
 BILLING_USAGE_EVENTS_PROCESSED = Counter('billing_usage_events_processed_total', 'Total usage events processed')
+BILLING_USAGE_BATCH_SIZE = Gauge('billing_usage_batch_size', 'Usage events requested per stream read')
+BILLING_USAGE_STREAM_LAG = Gauge('billing_usage_stream_lag', 'Usage events not yet delivered to the billing consumer group')
+BILLING_USAGE_BATCH_DURATION = Histogram('billing_usage_batch_duration_seconds', 'Time taken to aggregate, upsert and acknowledge one batch of usage events')
+BILLING_USAGE_EVENTS_CLAIMED = Counter('billing_usage_events_claimed_total', 'Stale pending usage events claimed from other consumers or earlier attempts')
+BILLING_QUOTA_COUNTERS_RECONCILED = Counter('billing_quota_counters_reconciled_total', 'Gateway quota counters checked against the usage rollups')
+BILLING_LEDGER_BUILD_DURATION = Histogram('billing_ledger_build_duration_seconds', 'Time taken to price all subscriptions of a billing period into the ledger')
+BILLING_USAGE_ROLLUPS_EXPIRED = Counter('billing_usage_rollups_expired_total', 'Usage rollup rows deleted after their retention', ['resolution'])
 
 # SQLAlchemy setup
 engine = create_async_engine(DATABASE_URL, echo=False)
@@ -65,6 +133,8 @@ AsyncSessionLocal = sessionmaker(
     expire_on_commit=False
 )
 
+stripe_caller = StripeCaller(STRIPE_REQUESTS_PER_SECOND, STRIPE_MAX_CONCURRENCY, STRIPE_MAX_RETRIES)
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
@@ -72,94 +142,540 @@ async def get_db():
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
+    await backfill_month_rollups()
+
+async def backfill_month_rollups():
+    """Derives the month rollups from usage_aggregates when there are none yet.
+
+    Only needed once after upgrading from daily aggregates alone; the consumer
+    keeps every resolution up to date from then on. Minute and hour rollups
+    cannot be derived and start with the upgrade.
+    """
+    async with AsyncSessionLocal() as db:
+        if await db.scalar(select(UsageRollupMonth.id).limit(1)) is not None:
+            return
+        month = func.date_trunc("month", UsageAggregate.date, "UTC")
+        source = select(
+            UsageAggregate.api_id,
+            UsageAggregate.client_id,
+            month,
+            *(func.coalesce(func.sum(getattr(UsageAggregate, column)), 0) for column in TOTAL_COLUMNS),
+        ).group_by(UsageAggregate.api_id, UsageAggregate.client_id, month)
+        stmt = insert(UsageRollupMonth).from_select(["api_id", "client_id", "bucket_start", *TOTAL_COLUMNS], source)
+        result = await db.execute(stmt.on_conflict_do_nothing(index_elements=["api_id", "client_id", "bucket_start"]))
+        await db.commit()
+    if result.rowcount:
+        logger.info(f"Backfilled {result.rowcount} month usage rollups from usage_aggregates")
+
+def billing_period(today: date):
+    """The calendar month before `today`, as [start, end) in UTC."""
+    end = datetime(today.year, today.month, 1, tzinfo=timezone.utc)
+    last_day = end - timedelta(days=1)
+    return datetime(last_day.year, last_day.month, 1, tzinfo=timezone.utc), end
+
+async def claim_billing_run(period_start: datetime, period_end: datetime):
+    """Creates the period's run if needed and takes its lease.
+
+    Returns the run, or None when the period is already billed or another
+    worker holds the lease.
+    """
+    now = datetime.now(timezone.utc)
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            insert(BillingRun).values(period_start=period_start, period_end=period_end)
+            .on_conflict_do_nothing(index_elements=["period_start"])
+        )
+        result = await db.execute(
+            update(BillingRun)
+            .where(
+                BillingRun.period_start == period_start,
+                BillingRun.status == "running",
+                or_(BillingRun.locked_until.is_(None), BillingRun.locked_until < now, BillingRun.locked_by == CONSUMER_NAME),
+            )
+            .values(locked_by=CONSUMER_NAME, locked_until=now + timedelta(seconds=BILLING_RUN_LEASE_SECONDS))
+            .returning(BillingRun)
+        )
+        run = result.scalar()
+        await db.commit()
+    return run
+
+async def renew_billing_run_lease(run_id: int, checkpoint_ledger_id: int) -> bool:
+    """Extends our lease on the run and records that ledger rows up to `checkpoint_ledger_id` are done."""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(BillingRun)
+            .where(BillingRun.id == run_id, BillingRun.locked_by == CONSUMER_NAME)
+            .values(
+                checkpoint_ledger_id=checkpoint_ledger_id,
+                locked_until=datetime.now(timezone.utc) + timedelta(seconds=BILLING_RUN_LEASE_SECONDS),
+            )
+        )
+        await db.commit()
+    return result.rowcount == 1
+
+async def build_billing_ledger(run: BillingRun):
+    """Adds a ledger row with usage and amount due for every subscription active in the period.
+
+    All subscriptions are priced by one INSERT ... SELECT over the usage rollups.
+    Rows already in the ledger are left as they are.
+    """
+    _, _, usage = usage_totals_query(run.period_start, run.period_end, "api_id", "client_id")
+    usage = usage.subquery()
+    # Usage of all the subscriber's clients on the plan's API; the invoice is recorded against the first client
+    subscriber_usage = select(
+        Client.user_id,
+        usage.c.api_id,
+        func.sum(usage.c.total_requests).label("total_requests"),
+        func.sum(usage.c.total_bytes).label("total_bytes"),
+    ).join(usage, usage.c.client_id == Client.id).group_by(Client.user_id, usage.c.api_id).subquery()
+    first_client = select(Client.user_id, func.min(Client.id).label("client_id")).group_by(Client.user_id).subquery()
+
+    total_requests = func.coalesce(subscriber_usage.c.total_requests, 0)
+    total_bytes = func.coalesce(subscriber_usage.c.total_bytes, 0)
+    unit_price = func.coalesce(Plan.unit_price_cents, 0)
+    amount_cents = cast(func.round(case(
+        (Plan.unit_type == "subscription", Plan.price_cents),
+        (Plan.unit_type == "request", total_requests * unit_price),
+        (Plan.unit_type == "MB", total_bytes * unit_price / float(BYTES_PER_MB)),
+        else_=0,
+    )), BigInteger)
+
+    source = select(
+        literal(run.id),
+        Subscription.id,
+        first_client.c.client_id,
+        Plan.api_id,
+        literal(run.period_start),
+        literal(run.period_end),
+        total_requests,
+        total_bytes,
+        amount_cents,
+        case((amount_cents > 0, "pending"), else_="skipped"),
+    ).join(
+        Plan, Plan.id == Subscription.plan_id
+    ).outerjoin(
+        first_client, first_client.c.user_id == Subscription.user_id
+    ).outerjoin(
+        subscriber_usage, and_(subscriber_usage.c.user_id == Subscription.user_id, subscriber_usage.c.api_id == Plan.api_id)
+    ).filter(
+        Subscription.started_at < run.period_end,
+        or_(Subscription.canceled_at.is_(None), Subscription.canceled_at >= run.period_start),
+    )
+    stmt = insert(BillingLedger).from_select(
+        ["run_id", "subscription_id", "client_id", "api_id", "period_start", "period_end", "total_requests", "total_bytes", "amount_cents", "status"],
+        source,
+    ).on_conflict_do_nothing(index_elements=["subscription_id", "period_start"])
+
+    with BILLING_LEDGER_BUILD_DURATION.time():
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt)
+            ledger_rows = select(func.count(BillingLedger.id)).filter(BillingLedger.run_id == run.id)
+            await db.execute(
+                update(BillingRun).where(BillingRun.id == run.id).values(
+                    ledger_built_at=func.now(),
+                    subscriptions_total=ledger_rows.scalar_subquery(),
+                    skipped_count=ledger_rows.filter(BillingLedger.status == "skipped").scalar_subquery(),
+                )
+            )
+            await db.commit()
+
+async def invoice_ledger_entry(run_id: int, entry: BillingLedger, plan: Plan, stripe_customer_id: str):
+    last_day = entry.period_end - timedelta(days=1) # Invoices record the period's last day, as before
+    # Keyed by subscription and period only, so every attempt at a period gets the same Stripe objects back
+    idempotency_prefix = f"billing-{entry.subscription_id}-{entry.period_start.date()}"
+    stripe_invoice_id = entry.stripe_invoice_id # Set when an earlier attempt created the invoice
+    try:
+        if entry.client_id is None:
+            raise ValueError("Subscriber has no client to record the invoice against")
+        if stripe_invoice_id is None:
+            # The invoice takes only the item added to it below, not other pending items of the
+            # customer, as invoices for several of their subscriptions may be created at once.
+            # It stays a draft until the item is on it
+            stripe_invoice = await stripe_caller.call(
+                stripe.Invoice.create,
+                customer=stripe_customer_id,
+                collection_method='charge_automatically',
+                auto_advance=False,
+                pending_invoice_items_behavior="exclude",
+                description=f"Invoice for {plan.name} ({entry.period_start.date()} - {last_day.date()})",
+                idempotency_key=f"{idempotency_prefix}-invoice",
+            )
+            stripe_invoice_id = stripe_invoice.id
+            # Recorded before anything else can fail, so a retry completes this invoice instead of creating another
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(BillingLedger).where(BillingLedger.id == entry.id)
+                    .values(stripe_invoice_id=stripe_invoice_id)
+                )
+                await db.commit()
+        # Create Stripe Invoice Item (for metered billing)
+        if plan.unit_type != "subscription":
+            await stripe_caller.call(
+                stripe.InvoiceItem.create,
+                customer=stripe_customer_id,
+                invoice=stripe_invoice_id,
+                price=plan.stripe_price_id, # This should be a metered price
+                quantity=entry.total_requests if plan.unit_type == "request" else (entry.total_bytes / BYTES_PER_MB),
+                unit_amount=plan.unit_price_cents,
+                currency="usd", # Assuming USD
+                idempotency_key=f"{idempotency_prefix}-item",
+            )
+        await stripe_caller.call(
+            stripe.Invoice.modify,
+            stripe_invoice_id,
+            auto_advance=True, # Auto-finalize and attempt collection
+        )
+    except (stripe.StripeError, ValueError) as e:
+        BILLING_INVOICE_COUNT.labels(status="failed").inc()
+        logger.error(f"Could not invoice subscription {entry.subscription_id} for {entry.period_start.date()}: {e}")
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(BillingLedger).where(BillingLedger.id == entry.id)
+                .values(status="failed", attempts=BillingLedger.attempts + 1, error=str(e)[:1000])
+            )
+            await db.execute(
+                update(BillingRun).where(BillingRun.id == run_id)
+                .values(failed_count=BillingRun.failed_count + 1)
+            )
+            await db.commit()
+        return
 
-async def process_monthly_billing():
+    # The invoice and the ledger row are committed together
+    async with AsyncSessionLocal() as db:
+        invoice = Invoice(
+            client_id=entry.client_id,
+            api_id=entry.api_id,
+            period_start=entry.period_start,
+            period_end=last_day,
+            amount_cents=entry.amount_cents,
+            status="draft", # Will be updated by webhook to paid/failed
+            stripe_invoice_id=stripe_invoice_id
+        )
+        db.add(invoice)
+        await db.flush()
+        await db.execute(
+            update(BillingLedger).where(BillingLedger.id == entry.id).values(
+                status="invoiced", attempts=BillingLedger.attempts + 1, error=None,
+                invoice_id=invoice.id,
+            )
+        )
+        await db.execute(
+            update(BillingRun).where(BillingRun.id == run_id)
+            .values(invoiced_count=BillingRun.invoiced_count + 1)
+        )
+        await db.commit()
+    BILLING_INVOICE_COUNT.labels(status="created").inc()
+
+def billable_ledger_entries(run_id: int):
+    return select(BillingLedger).filter(
+        BillingLedger.run_id == run_id,
+        BillingLedger.status.in_(("pending", "failed")),
+        BillingLedger.attempts < BILLING_MAX_ATTEMPTS,
+    )
+
+async def process_monthly_billing(today: date = None):
+    """Bills the previous month once, resuming an interrupted run where it stopped.
+
+    The ledger is built for all subscriptions at once; its rows are then
+    invoiced in chunks in ID order, the rows of a chunk concurrently, and the
+    run's checkpoint moves past a chunk once all of its rows are done.
+    Rows that failed are retried on later passes, up to BILLING_MAX_ATTEMPTS.
+    """
+    period_start, period_end = billing_period(today or datetime.now(timezone.utc).date())
+    run = await claim_billing_run(period_start, period_end)
+    if run is None:
+        return
     BILLING_PROCESS_COUNT.inc()
-    logger.info("Starting monthly billing process...")
+    logger.info(f"Billing run {run.id} for {period_start.date()} - {period_end.date()} resuming after ledger row {run.checkpoint_ledger_id}")
+
+    if run.ledger_built_at is None:
+        await build_billing_ledger(run)
+
+    checkpoint = run.checkpoint_ledger_id
+    while True:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                billable_ledger_entries(run.id)
+                .add_columns(Plan, User.stripe_customer_id)
+                .join(Subscription, Subscription.id == BillingLedger.subscription_id)
+                .join(Plan, Plan.id == Subscription.plan_id)
+                .join(User, User.id == Subscription.user_id)
+                .filter(BillingLedger.id > checkpoint)
+                .order_by(BillingLedger.id)
+                .limit(BILLING_RUN_CHUNK_SIZE)
+            )).all()
+        if not rows:
+            break
+        # Stripe requests are limited by stripe_caller; the event loop keeps consuming usage meanwhile
+        await asyncio.gather(*(
+            invoice_ledger_entry(run.id, entry, plan, stripe_customer_id)
+            for entry, plan, stripe_customer_id in rows
+        ))
+        checkpoint = rows[-1][0].id
+        if not await renew_billing_run_lease(run.id, checkpoint):
+            logger.warning(f"Lost the lease on billing run {run.id}; another worker continues it")
+            return
+
     async with AsyncSessionLocal() as db:
-        stmt = select(Subscription).options(joinedload(Subscription.user), joinedload(Subscription.plan))
-        subscriptions = (await db.execute(stmt)).scalars().all()
-
-        for sub in subscriptions:
-            today = datetime.now().date()
-            # For simplicity, let's bill for the previous full month
-            end_of_last_month = date(today.year, today.month, 1) - timedelta(days=1)
-            start_of_last_month = date(end_of_last_month.year, end_of_last_month.month, 1)
-
-            logger.info(f"Processing subscription {sub.id} for user {sub.user.email} for period {start_of_last_month} to {end_of_last_month}")
-
-            # Aggregate usage for the period
-            usage_stmt = select(func.sum(UsageAggregate.total_requests), func.sum(UsageAggregate.total_bytes)).filter(
-                UsageAggregate.api_id == sub.plan.api_id,
-                UsageAggregate.client_id == sub.user.clients[0].id, # Assuming one client per user for simplicity
-                UsageAggregate.date >= start_of_last_month,
-                UsageAggregate.date <= end_of_last_month
+        remaining = await db.scalar(select(func.count()).select_from(billable_ledger_entries(run.id).subquery()))
+        # Either done, or the next pass retries the failed rows from the start
+        values = {"checkpoint_ledger_id": 0, "locked_by": None, "locked_until": None}
+        if not remaining:
+            values.update(status="completed", finished_at=func.now())
+        await db.execute(update(BillingRun).where(BillingRun.id == run.id).values(**values))
+        await db.commit()
+        run = await db.get(BillingRun, run.id, populate_existing=True)
+    logger.info(
+        f"Billing run {run.id} {'completed' if not remaining else 'paused'}: {run.invoiced_count} invoiced, "
+        f"{run.skipped_count} with nothing due, {remaining} to retry, of {run.subscriptions_total} subscriptions"
+    )
+
+async def reconcile_quota_counters(r: redis.Redis):
+    now = datetime.now(timezone.utc)
+    if now.month == 12:
+        next_month = datetime(now.year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        next_month = datetime(now.year, now.month + 1, 1, tzinfo=timezone.utc)
+    expire_at = int(next_month.timestamp()) + QUOTA_KEY_GRACE_SECONDS
+    period = now.strftime("%Y%m")
+
+    async with AsyncSessionLocal() as db:
+        # Only APIs with a quota plan have gateway counters worth repairing
+        quota_api_ids = select(Plan.api_id).filter(Plan.quota_limit.isnot(None))
+        _, rollup, stmt = usage_totals_query(datetime(now.year, now.month, 1, tzinfo=timezone.utc), next_month, "api_id", "client_id")
+        rows = (await db.execute(stmt.filter(rollup.api_id.in_(quota_api_ids)))).all()
+
+    if not rows:
+        return
+
+    script = r.register_script(RECONCILE_QUOTA_SCRIPT)
+    async with r.pipeline(transaction=False) as pipe:
+        for row in rows:
+            await script(keys=[f"{QUOTA_KEY_PREFIX}{row.api_id}:{row.client_id}:{period}"], args=[row.total_requests, expire_at], client=pipe)
+        await pipe.execute()
+
+    BILLING_QUOTA_COUNTERS_RECONCILED.inc(len(rows))
+    logger.info(f"Reconciled {len(rows)} quota counters for period {period}")
+
+async def run_quota_reconciliation(r: redis.Redis):
+    while True:
+        try:
+            await reconcile_quota_counters(r)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error reconciling quota counters: {e}", exc_info=True)
+        await asyncio.sleep(QUOTA_RECONCILE_INTERVAL_SECONDS)
+
+async def expire_usage_rollups():
+    for resolution in RESOLUTIONS:
+        cutoff = retained_since(resolution)
+        if cutoff is None:
+            continue
+        model = ROLLUP_MODELS[resolution]
+        # In chunks, so no single statement holds locks for long
+        expired = select(model.id).filter(bucket_column(resolution) < cutoff).limit(ROLLUP_RETENTION_DELETE_BATCH)
+        while True:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(delete(model).where(model.id.in_(expired.scalar_subquery())))
+                await db.commit()
+            BILLING_USAGE_ROLLUPS_EXPIRED.labels(resolution=resolution).inc(result.rowcount)
+            if result.rowcount < ROLLUP_RETENTION_DELETE_BATCH:
+                break
+
+async def run_rollup_retention():
+    while True:
+        try:
+            await expire_usage_rollups()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error expiring usage rollups: {e}", exc_info=True)
+        await asyncio.sleep(ROLLUP_RETENTION_INTERVAL_SECONDS)
+
+def new_usage_totals():
+    # (api_id, client_id) -> (resolution, bucket start) -> totals
+    return defaultdict(lambda: defaultdict(lambda: dict.fromkeys(TOTAL_COLUMNS, 0)))
+
+def aggregate_usage_events(message_list, totals):
+    """Adds a batch of usage events to `totals` at every rollup resolution.
+
+    Returns the (message_id, (api_id, client_id)) pairs of the events included
+    and the (message_id, event, error) triples of those that could not be parsed.
+    """
+    included, malformed = [], []
+    for message_id, event in message_list:
+        try:
+            api_id = int(event["api_id"])
+            client_id = int(event["client_id"])
+            units = int(event.get("units", 1))
+            request_bytes = int(event.get("request_bytes", 0))
+            response_bytes = int(event.get("response_bytes", 0))
+            bytes_transferred = int(event.get("bytes", request_bytes + response_bytes))
+            moment = datetime.fromtimestamp(float(event["timestamp"]), timezone.utc)
+        except (KeyError, ValueError, TypeError, OverflowError) as e:
+            logger.error(f"Malformed usage event {message_id}: {e!r}", extra={"request_id": message_id})
+            malformed.append((message_id, event, repr(e)))
+            continue
+        key = (api_id, client_id)
+        for resolution in RESOLUTIONS:
+            row = totals[key][(resolution, bucket_start(moment, resolution))]
+            row["total_requests"] += units
+            row["total_bytes"] += bytes_transferred
+            row["total_request_bytes"] += request_bytes
+            row["total_response_bytes"] += response_bytes
+        included.append((message_id, key))
+    return included, malformed
+
+async def upsert_usage_rollups(db: AsyncSession, totals):
+    """Adds `totals` to every rollup table in one transaction."""
+    for resolution in RESOLUTIONS:
+        model = ROLLUP_MODELS[resolution]
+        time_column = bucket_column(resolution).key
+        # Rows are written in key order so concurrent consumers lock them in the same order
+        rows = [
+            {"api_id": api_id, "client_id": client_id, time_column: bucket, **row}
+            for (api_id, client_id), buckets in sorted(totals.items())
+            for (row_resolution, bucket), row in sorted(buckets.items())
+            if row_resolution == resolution
+        ]
+        for start in range(0, len(rows), USAGE_UPSERT_CHUNK_SIZE):
+            stmt = insert(model).values(rows[start:start + USAGE_UPSERT_CHUNK_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["api_id", "client_id", time_column],
+                set_={column: func.coalesce(getattr(model, column), 0) + getattr(stmt.excluded, column) for column in TOTAL_COLUMNS},
             )
-            aggregated_usage = (await db.execute(usage_stmt)).first()
-            total_requests = aggregated_usage[0] or 0
-            total_bytes = aggregated_usage[1] or 0
-
-            logger.info(f"  Aggregated: {total_requests} requests, {total_bytes} bytes")
-
-            # Calculate amount due based on plan
-            amount_due_cents = 0
-            if sub.plan.unit_type == "subscription":
-                amount_due_cents = sub.plan.price_cents
-            elif sub.plan.unit_type == "request":
-                amount_due_cents = total_requests * sub.plan.unit_price_cents
-            elif sub.plan.unit_type == "MB":
-                amount_due_cents = (total_bytes / (1024 * 1024)) * sub.plan.unit_price_cents # Convert bytes to MB
-            # Add other pricing models as needed
-
-            if amount_due_cents > 0:
-                logger.info(f"  Amount due: {amount_due_cents} cents")
-                try:
-                    # Create Stripe Invoice Item (for metered billing)
-                    if sub.plan.unit_type != "subscription":
-                        stripe.InvoiceItem.create(
-                            customer=sub.user.stripe_customer_id,
-                            price=sub.plan.stripe_price_id, # This should be a metered price
-                            quantity=total_requests if sub.plan.unit_type == "request" else (total_bytes / (1024 * 1024)),
-                            unit_amount=sub.plan.unit_price_cents,
-                            currency="usd", # Assuming USD
-                        )
-
-                    # Create Stripe Invoice
-                    stripe_invoice = stripe.Invoice.create(
-                        customer=sub.user.stripe_customer_id,
-                        collection_method='charge_automatically',
-                        auto_advance=True, # Auto-finalize and attempt collection
-                        description=f"Invoice for {sub.plan.name} ({start_of_last_month} - {end_of_last_month})",
-                        # For subscription invoices, Stripe handles this automatically
-                        # For one-off invoices, you might need to add invoice items
-                    )
-
-                    # Store invoice in our database
-                    new_invoice = Invoice(
-                        client_id=sub.user.clients[0].id, # Assuming one client per user
-                        api_id=sub.plan.api_id, # Populate api_id
-                        period_start=start_of_last_month,
-                        period_end=end_of_last_month,
-                        amount_cents=amount_due_cents,
-                        status="draft", # Will be updated by webhook to paid/failed
-                        stripe_invoice_id=stripe_invoice.id
-                    )
-                    db.add(new_invoice)
-                    await db.commit()
-                    await db.refresh(new_invoice)
-                    BILLING_INVOICE_COUNT.labels(status="created").inc()
-                    logger.info(f"  Stripe Invoice {stripe_invoice.id} created for {sub.user.email}")
-
-                except stripe.error.StripeError as e:
-                    BILLING_INVOICE_COUNT.labels(status="failed").inc()
-                    logger.error(f"  Stripe error creating invoice for {sub.user.email}: {e}", exc_info=True)
-                except Exception as e:
-                    BILLING_INVOICE_COUNT.labels(status="failed").inc()
-                    logger.error(f"  Unexpected error creating invoice for {sub.user.email}: {e}", exc_info=True)
-            else:
-                logger.info(f"  No amount due for {sub.user.email}")
-
-    logger.info("Monthly billing process finished.")
+            await db.execute(stmt)
+    await db.commit()
+
+async def usage_stream_lag(r: redis.Redis, streams):
+    # Entries not yet delivered to the group; reported by Redis 7 and later
+    total = 0
+    for stream in streams:
+        lag = next((group.get("lag") for group in await r.xinfo_groups(stream) if group.get("name") == CONSUMER_GROUP), None)
+        if lag is None:
+            return None
+        total += lag
+    return total
+
+def next_batch_size(batch_size: int, received: int, lag) -> int:
+    if lag is None:
+        # Without a lag figure, a full read is the sign that more is waiting
+        lag = batch_size if received >= batch_size else 0
+    if lag > batch_size:
+        batch_size *= 2
+    elif lag < batch_size // 4:
+        batch_size //= 2
+    return max(USAGE_BATCH_MIN_SIZE, min(USAGE_BATCH_MAX_SIZE, batch_size))
+
+async def write_usage_rollups(totals):
+    """Upserts `totals` and returns the (api_id, client_id) keys the database refused.
+
+    When the batch as a whole is refused, e.g. because one event names an API or
+    client that does not exist, each API and client is written on its own so
+    that only the events behind the refused ones are held back for a retry.
+    """
+    try:
+        async with AsyncSessionLocal() as db:
+            await upsert_usage_rollups(db, totals)
+        return set()
+    except (IntegrityError, DataError) as e:
+        logger.warning(f"Usage batch refused, writing its {len(totals)} API and client pairs one by one: {e}")
+
+    refused = set()
+    for key, buckets in totals.items():
+        try:
+            async with AsyncSessionLocal() as db:
+                await upsert_usage_rollups(db, {key: buckets})
+        except (IntegrityError, DataError) as e:
+            logger.error(f"Usage of API {key[0]}, client {key[1]} refused: {e}")
+            refused.add(key)
+    return refused
+
+async def process_usage_batch(r: redis.Redis, messages, deliveries=None):
+    """Aggregates [(stream, message_list), ...] with one upsert, then acknowledges it.
+
+    Malformed events go straight to the dead-letter stream. Events whose rows
+    were refused stay pending and are retried by `claim_stale_usage_events`.
+    `deliveries` maps message IDs to their delivery counts when known.
+    """
+    deliveries = deliveries or {}
+    with BILLING_USAGE_BATCH_DURATION.time():
+        totals = new_usage_totals()
+        included, malformed = [], []
+        for stream, message_list in messages:
+            stream_included, stream_malformed = aggregate_usage_events(message_list, totals)
+            included.extend((stream, message_id, key) for message_id, key in stream_included)
+            malformed.extend((stream, *entry) for entry in stream_malformed)
+        refused = await write_usage_rollups(totals) if totals else set()
+
+        # Acknowledged only once the totals are committed
+        acked = defaultdict(list)
+        for stream, message_id, key in included:
+            if key not in refused:
+                acked[stream].append(message_id)
+        async with r.pipeline(transaction=True) as pipe:
+            for stream, message_ids in acked.items():
+                pipe.xack(stream, CONSUMER_GROUP, *message_ids)
+            for stream, message_id, event, error in malformed:
+                dead_letter(pipe, stream, CONSUMER_GROUP, message_id, event, MALFORMED, error, deliveries.get(message_id, 1), USAGE_DLQ_MAXLEN)
+            await pipe.execute()
+
+    if malformed:
+        BILLING_USAGE_EVENTS_DEAD_LETTERED.labels(reason=MALFORMED).inc(len(malformed))
+    processed = sum(len(message_ids) for message_ids in acked.values())
+    BILLING_USAGE_EVENTS_PROCESSED.inc(processed)
+    logger.info(f"Aggregated {processed} usage events for {len(totals) - len(refused)} API and client pairs")
+
+async def claim_stale_usage_events(r: redis.Redis, streams, batch_size: int):
+    """Retries entries left pending by failed batches and departed consumers.
+
+    An entry delivered n times is claimed once it has been pending for
+    USAGE_CLAIM_MIN_IDLE_MS * 2^(n-1), at most USAGE_RETRY_MAX_BACKOFF_MS. After
+    USAGE_MAX_DELIVERIES deliveries it goes to the dead-letter stream instead.
+    """
+    for stream in streams:
+        start_id = "-"
+        while True:
+            pending = await r.xpending_range(
+                stream, CONSUMER_GROUP, min=start_id, max="+", count=batch_size, idle=USAGE_CLAIM_MIN_IDLE_MS,
+            )
+            if not pending:
+                break
+            start_id = f"({pending[-1]['message_id']}"
+            due = {
+                entry["message_id"]: entry["times_delivered"]
+                for entry in pending
+                if entry["time_since_delivered"] >= retry_backoff_ms(entry["times_delivered"], USAGE_CLAIM_MIN_IDLE_MS, USAGE_RETRY_MAX_BACKOFF_MS)
+            }
+            if due:
+                # Claiming also guards against another worker taking the same entries meanwhile
+                claimed = await r.xclaim(stream, CONSUMER_GROUP, CONSUMER_NAME, min_idle_time=USAGE_CLAIM_MIN_IDLE_MS, message_ids=list(due))
+                # Entries trimmed from the stream meanwhile come back without fields
+                claimed = [(message_id, event) for message_id, event in claimed if event]
+                exhausted = [(message_id, event) for message_id, event in claimed if due[message_id] >= USAGE_MAX_DELIVERIES]
+                retried = [(message_id, event) for message_id, event in claimed if due[message_id] < USAGE_MAX_DELIVERIES]
+                if exhausted:
+                    async with r.pipeline(transaction=True) as pipe:
+                        for message_id, event in exhausted:
+                            error = f"Not processed after {due[message_id]} deliveries"
+                            dead_letter(pipe, stream, CONSUMER_GROUP, message_id, event, MAX_DELIVERIES, error, due[message_id], USAGE_DLQ_MAXLEN)
+                        await pipe.execute()
+                    BILLING_USAGE_EVENTS_DEAD_LETTERED.labels(reason=MAX_DELIVERIES).inc(len(exhausted))
+                    logger.error(f"Dead-lettered {len(exhausted)} usage events from {stream} after {USAGE_MAX_DELIVERIES} deliveries")
+                if retried:
+                    BILLING_USAGE_EVENTS_CLAIMED.inc(len(retried))
+                    logger.warning(f"Retrying {len(retried)} stale usage events from {stream}")
+                    await process_usage_batch(r, [(stream, retried)], {message_id: due[message_id] + 1 for message_id, _ in retried})
+            if len(pending) < batch_size:
+                break
+
+        # Forget consumers that have nothing pending and have not read for a while
+        for consumer in await r.xinfo_consumers(stream, CONSUMER_GROUP):
+            if consumer["name"] != CONSUMER_NAME and not consumer["pending"] and consumer["idle"] > USAGE_CLAIM_MIN_IDLE_MS:
+                await r.xgroup_delconsumer(stream, CONSUMER_GROUP, consumer["name"])
 
 async def consume_usage_events():
     r = redis.from_url(REDIS_URL, decode_responses=True)
@@ -167,104 +683,94 @@ async def consume_usage_events():
     # Ensure database tables are created
     await init_db()
 
-    try:
-        await r.xgroup_create(USAGE_STREAM_KEY, CONSUMER_GROUP, mkstream=True)
-    except redis_exceptions.ResponseError as e:
-        if "BUSYGROUP" in str(e):
-            logger.info(f"Consumer group {CONSUMER_GROUP} already exists.")
-        else:
+    for partition in range(USAGE_STREAM_PARTITIONS):
+        try:
+            await r.xgroup_create(usage_stream_key(USAGE_STREAM_KEY, partition), CONSUMER_GROUP, mkstream=True)
+        except redis_exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                logger.error(f"Error creating consumer group: {e}", exc_info=True)
+                return
+        except Exception as e:
             logger.error(f"Error creating consumer group: {e}", exc_info=True)
             return
-    except Exception as e:
-        logger.error(f"Error creating consumer group: {e}", exc_info=True)
-        return
 
-    logger.info(f"Billing worker {CONSUMER_NAME} started, consuming from stream {USAGE_STREAM_KEY} in group {CONSUMER_GROUP}")
+    assigner = PartitionAssigner(
+        r,
+        CONSUMER_NAME,
+        USAGE_STREAM_PARTITIONS,
+        USAGE_CONSUMERS_KEY,
+        heartbeat_interval=USAGE_CONSUMER_HEARTBEAT_INTERVAL,
+        member_timeout=USAGE_CONSUMER_TIMEOUT,
+    )
+    await assigner.heartbeat()
+    assigner.start()
+
+    logger.info(f"Billing worker {CONSUMER_NAME} started, consuming {USAGE_STREAM_PARTITIONS} partitions of {USAGE_STREAM_KEY} in group {CONSUMER_GROUP}")
 
     # Schedule monthly billing process to run once a day (for testing)
     # In production, this would be a cron job or a more robust scheduler
     asyncio.create_task(run_daily_billing_check())
+    asyncio.create_task(run_quota_reconciliation(r))
+    asyncio.create_task(run_rollup_retention())
 
+    batch_size = USAGE_BATCH_MIN_SIZE
+    next_claim = 0.0
+    consecutive_errors = 0
     while True:
         try:
+            streams = [usage_stream_key(USAGE_STREAM_KEY, partition) for partition in assigner.owned]
+            if not streams:
+                # More workers than partitions; stand by until one leaves
+                await asyncio.sleep(USAGE_CONSUMER_HEARTBEAT_INTERVAL)
+                continue
+
+            if time.monotonic() >= next_claim:
+                next_claim = time.monotonic() + USAGE_CLAIM_INTERVAL
+                await claim_stale_usage_events(r, streams, batch_size)
+
+            BILLING_USAGE_BATCH_SIZE.set(batch_size)
+            # The count applies per partition, so the batch is shared out between them
             messages = await r.xreadgroup(
                 CONSUMER_GROUP,
                 CONSUMER_NAME,
-                {USAGE_STREAM_KEY: '>'},
-                count=10, # Read up to 10 messages at once
-                block=1000 # Block for 1 second
+                {stream: '>' for stream in streams},
+                count=max(1, batch_size // len(streams)),
+                block=USAGE_READ_BLOCK_MS
             )
+            messages = [(stream, message_list) for stream, message_list in messages or [] if message_list]
+            if messages:
+                await process_usage_batch(r, messages)
 
-            if not messages:
-                await asyncio.sleep(0.1) # Small sleep to prevent busy-waiting
-                continue
-
-            for stream, message_list in messages:
-                BILLING_USAGE_EVENTS_PROCESSED.inc()
-                async with AsyncSessionLocal() as db:
-                    for message_id, message_data in message_list:
-                        event = {k.decode('utf-8'): v.decode('utf-8') for k, v in message_data.items()}
-                        logger.info(f"Processing message {message_id}: {event}")
-
-                        try:
-                            api_id = int(event["api_id"])
-                            client_id = int(event["client_id"])
-                            units = int(event.get("units", 1))
-                            bytes_transferred = int(event.get("bytes", 0))
-                            timestamp = datetime.fromtimestamp(float(event["timestamp"]))
-                            event_date = timestamp.date() # Aggregate by date
-
-                            # Find or create UsageAggregate record
-                            stmt = select(UsageAggregate).filter_by(
-                                api_id=api_id,
-                                client_id=client_id,
-                                date=event_date
-                            )
-                            result = await db.execute(stmt)
-                            usage_aggregate = result.scalars().first()
-
-                            if usage_aggregate:
-                                usage_aggregate.total_requests += units
-                                usage_aggregate.total_bytes += bytes_transferred
-                            else:
-                                usage_aggregate = UsageAggregate(
-                                    api_id=api_id,
-                                    client_id=client_id,
-                                    date=event_date,
-                                    total_requests=units,
-                                    total_bytes=bytes_transferred
-                                )
-                                db.add(usage_aggregate)
-                            
-                            await db.commit()
-                            await db.refresh(usage_aggregate)
-                            logger.info(f"  Aggregated usage for API {api_id}, Client {client_id} on {event_date}")
-
-                            # Acknowledge the message after successful processing and persistence
-                            await r.xack(USAGE_STREAM_KEY, CONSUMER_GROUP, message_id)
-                            logger.info(f"  Acknowledged message {message_id}")
-
-                        except Exception as e:
-                            logger.error(f"Error processing message {message_id}: {e}", exc_info=True)
-                            # Depending on error handling strategy, you might not ack here
-                            # or move to a Dead Letter Queue
+            lag = await usage_stream_lag(r, streams)
+            if lag is not None:
+                BILLING_USAGE_STREAM_LAG.set(lag)
+            received = sum(len(message_list) for _, message_list in messages)
+            batch_size = next_batch_size(batch_size, received, lag)
+            consecutive_errors = 0
 
         except asyncio.CancelledError:
             logger.info("Consumer task cancelled.")
+            await assigner.close()
             break
         except Exception as e:
             logger.error(f"Error consuming messages: {e}", exc_info=True)
-            await asyncio.sleep(1) # Wait before retrying
+            # Back off while Redis or the database keeps failing rather than spinning on errors
+            consecutive_errors += 1
+            await asyncio.sleep(min(USAGE_ERROR_MAX_BACKOFF, 2 ** (consecutive_errors - 1)))
 
 async def run_daily_billing_check():
     # Start Prometheus HTTP server for metrics
     start_http_server(8002) # Expose metrics on port 8002
 
     while True:
-        now = datetime.now()
-        # For testing, run every minute. In production, run once a day at a specific time.
-        await process_monthly_billing()
-        await asyncio.sleep(60) # Check every minute
+        # Once the month is billed, a check is a single lookup of its run
+        try:
+            await process_monthly_billing()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error running monthly billing: {e}", exc_info=True)
+        await asyncio.sleep(BILLING_CHECK_INTERVAL_SECONDS)
 
 if __name__ == "__main__":
     asyncio.run(consume_usage_events())
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Float
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, Boolean, Text, Float, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -10,9 +10,13 @@ class User(Base):
     password_hash = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     role = Column(String, default="developer") # e.g., "developer", "admin", "publisher"
+    stripe_customer_id = Column(String, unique=True, nullable=True) # Stripe Customer ID
+    stripe_account_id = Column(String, unique=True, nullable=True) # Stripe Connect Account ID for publishers
 
     apis = relationship("API", back_populates="owner")
     clients = relationship("Client", back_populates="user")
+    subscriptions = relationship("Subscription", back_populates="user")
+    invoices = relationship("Invoice", back_populates="user") # Changed to user for direct linking
 
 class API(Base):
     __tablename__ = "apis"
@@ -21,11 +25,28 @@ class API(Base):
     name = Column(String, index=True, nullable=False)
     description = Column(Text)
     base_url = Column(String, nullable=False)
+    response_cache_enabled = Column(Boolean, default=False, nullable=False) # Let the gateway cache cacheable GET responses
+    response_cache_vary_headers = Column(String, nullable=True) # Comma-separated request headers cached responses vary on
+    response_cache_max_ttl_seconds = Column(Integer, nullable=True) # Caps the upstream's max-age; None trusts it
+    load_balancing = Column(String, nullable=True) # "least_outstanding" or "ewma" across upstream targets; gateway default if unset
+    health_check_path = Column(String, nullable=True) # Path the gateway polls on each upstream target; gateway default if unset
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     owner = relationship("User", back_populates="apis")
     plans = relationship("Plan", back_populates="api")
+    upstream_targets = relationship("UpstreamTarget", back_populates="api")
     api_keys = relationship("APIKey", back_populates="api")
+    invoices = relationship("Invoice", back_populates="api") # New relationship
+
+class UpstreamTarget(Base):
+    __tablename__ = "upstream_targets"
+    id = Column(Integer, primary_key=True, index=True)
+    api_id = Column(Integer, ForeignKey("apis.id"), nullable=False, index=True)
+    url = Column(String, nullable=False) # Backend replica base URL; replaces API.base_url once an API has targets
+    enabled = Column(Boolean, default=True, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    api = relationship("API", back_populates="upstream_targets")
 
 class Plan(Base):
     __tablename__ = "plans"
@@ -36,8 +57,17 @@ class Plan(Base):
     price_cents = Column(Integer, nullable=False) # Price in cents
     unit_type = Column(String) # e.g., "request", "MB", "subscription"
     unit_price_cents = Column(Integer) # Price per unit in cents, if applicable
+    stripe_price_id = Column(String, unique=True, nullable=True) # Stripe Price ID
+    quota_limit = Column(Integer, nullable=True) # New field for quota limit
+    rate_limit_requests = Column(Integer, nullable=True) # Requests per rate limit window; gateway default if unset
+    rate_limit_window_seconds = Column(Integer, nullable=True) # Rate limit window length; gateway default if unset
+    rate_limit_burst = Column(Integer, nullable=True) # Burst capacity for token_bucket/gcra/leased_token_bucket; defaults to rate_limit_requests
+    rate_limit_algorithm = Column(String, nullable=True) # "sliding_window_log", "sliding_window_counter", "token_bucket", "gcra" or "leased_token_bucket"; gateway default if unset
+    rate_limit_failure_mode = Column(String, nullable=True) # "open" (approximate local limits) or "closed" (reject) while Redis is down; gateway default if unset
+    priority = Column(Integer, nullable=True) # Higher tiers are shed later when the gateway is overloaded; if unset, 1 for paid plans and 0 for free ones
 
     api = relationship("API", back_populates="plans")
+    subscriptions = relationship("Subscription", back_populates="plan")
 
 class Client(Base):
     __tablename__ = "clients"
@@ -65,13 +95,140 @@ class APIKey(Base):
 
 class UsageAggregate(Base):
     __tablename__ = "usage_aggregates"
+    # One row per API, client and day; the billing worker upserts against it
+    __table_args__ = (UniqueConstraint("api_id", "client_id", "date", name="uq_usage_aggregates_api_client_date"),)
     id = Column(Integer, primary_key=True, index=True)
     api_id = Column(Integer, ForeignKey("apis.id"), nullable=False)
     client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
     date = Column(DateTime(timezone=True), nullable=False) # Aggregation date (e.g., daily)
     total_requests = Column(Integer, default=0)
-    total_bytes = Column(Integer, default=0)
+    total_bytes = Column(BigInteger, default=0) # Request plus response bytes
+    total_request_bytes = Column(BigInteger, default=0) # Ingress bytes
+    total_response_bytes = Column(BigInteger, default=0) # Egress bytes
     # Add other metrics as needed (e.g., total_cost_cents)
 
     api = relationship("API")
-    client = relationship("Client")
\ No newline at end of file
+    client = relationship("Client")
+
+class UsageRollupMinute(Base):
+    __tablename__ = "usage_rollups_minute"
+    # Same totals as UsageAggregate per minute, hour and month; see usage_rollups.py
+    __table_args__ = (UniqueConstraint("api_id", "client_id", "bucket_start", name="uq_usage_rollups_minute_api_client_bucket"),)
+    id = Column(Integer, primary_key=True, index=True)
+    api_id = Column(Integer, ForeignKey("apis.id"), nullable=False)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    bucket_start = Column(DateTime(timezone=True), nullable=False, index=True) # Start of the minute (UTC)
+    total_requests = Column(BigInteger, default=0)
+    total_bytes = Column(BigInteger, default=0)
+    total_request_bytes = Column(BigInteger, default=0)
+    total_response_bytes = Column(BigInteger, default=0)
+
+class UsageRollupHour(Base):
+    __tablename__ = "usage_rollups_hour"
+    __table_args__ = (UniqueConstraint("api_id", "client_id", "bucket_start", name="uq_usage_rollups_hour_api_client_bucket"),)
+    id = Column(Integer, primary_key=True, index=True)
+    api_id = Column(Integer, ForeignKey("apis.id"), nullable=False)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    bucket_start = Column(DateTime(timezone=True), nullable=False, index=True) # Start of the hour (UTC)
+    total_requests = Column(BigInteger, default=0)
+    total_bytes = Column(BigInteger, default=0)
+    total_request_bytes = Column(BigInteger, default=0)
+    total_response_bytes = Column(BigInteger, default=0)
+
+class UsageRollupMonth(Base):
+    __tablename__ = "usage_rollups_month"
+    __table_args__ = (UniqueConstraint("api_id", "client_id", "bucket_start", name="uq_usage_rollups_month_api_client_bucket"),)
+    id = Column(Integer, primary_key=True, index=True)
+    api_id = Column(Integer, ForeignKey("apis.id"), nullable=False)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    bucket_start = Column(DateTime(timezone=True), nullable=False, index=True) # First day of the month (UTC)
+    total_requests = Column(BigInteger, default=0)
+    total_bytes = Column(BigInteger, default=0)
+    total_request_bytes = Column(BigInteger, default=0)
+    total_response_bytes = Column(BigInteger, default=0)
+
+class Subscription(Base):
+    __tablename__ = "subscriptions"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    plan_id = Column(Integer, ForeignKey("plans.id"), nullable=False)
+    stripe_subscription_id = Column(String, unique=True, nullable=False) # Stripe Subscription ID
+    status = Column(String, default="active") # e.g., "active", "canceled", "past_due"
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    canceled_at = Column(DateTime(timezone=True), nullable=True)
+
+    user = relationship("User", back_populates="subscriptions")
+    plan = relationship("Plan", back_populates="subscriptions")
+
+class Invoice(Base):
+    __tablename__ = "invoices"
+    id = Column(Integer, primary_key=True, index=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
+    api_id = Column(Integer, ForeignKey("apis.id"), nullable=False) # New field
+    period_start = Column(DateTime(timezone=True), nullable=False)
+    period_end = Column(DateTime(timezone=True), nullable=False)
+    amount_cents = Column(Integer, nullable=False)
+    status = Column(String, default="draft") # e.g., "draft", "open", "paid", "void", "uncollectible"
+    stripe_invoice_id = Column(String, unique=True, nullable=True) # Stripe Invoice ID
+
+    client = relationship("Client", back_populates="invoices")
+    api = relationship("API", back_populates="invoices") # New relationship
+
+class Payout(Base):
+    __tablename__ = "payouts"
+    id = Column(Integer, primary_key=True, index=True)
+    publisher_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    invoice_id = Column(Integer, ForeignKey("invoices.id"), nullable=False)
+    amount_cents = Column(Integer, nullable=False)
+    status = Column(String, default="pending") # e.g., "pending", "paid", "failed"
+    stripe_payout_id = Column(String, unique=True, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    publisher = relationship("User")
+    invoice = relationship("Invoice")
+
+class BillingRun(Base):
+    __tablename__ = "billing_runs"
+    # One run per billing period; the billing worker resumes it from `checkpoint_ledger_id` after a crash
+    id = Column(Integer, primary_key=True, index=True)
+    period_start = Column(DateTime(timezone=True), nullable=False, unique=True)
+    period_end = Column(DateTime(timezone=True), nullable=False) # Exclusive
+    status = Column(String, default="running", nullable=False) # "running" or "completed"
+    checkpoint_ledger_id = Column(Integer, default=0, nullable=False) # Ledger rows up to this ID are done in the current pass
+    locked_by = Column(String, nullable=True) # Worker processing the run
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    ledger_built_at = Column(DateTime(timezone=True), nullable=True) # Set once every subscription of the period is in the ledger
+    subscriptions_total = Column(Integer, default=0, nullable=False)
+    invoiced_count = Column(Integer, default=0, nullable=False)
+    skipped_count = Column(Integer, default=0, nullable=False)
+    failed_count = Column(Integer, default=0, nullable=False)
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    ledger = relationship("BillingLedger", back_populates="run")
+
+class BillingLedger(Base):
+    __tablename__ = "billing_ledger"
+    # One row per subscription and period, so that each period is invoiced at most once
+    __table_args__ = (UniqueConstraint("subscription_id", "period_start", name="uq_billing_ledger_subscription_period"),)
+    id = Column(Integer, primary_key=True, index=True)
+    run_id = Column(Integer, ForeignKey("billing_runs.id"), nullable=False, index=True)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False)
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=True) # Client the invoice is recorded against
+    api_id = Column(Integer, ForeignKey("apis.id"), nullable=False)
+    period_start = Column(DateTime(timezone=True), nullable=False)
+    period_end = Column(DateTime(timezone=True), nullable=False) # Exclusive
+    total_requests = Column(BigInteger, default=0, nullable=False)
+    total_bytes = Column(BigInteger, default=0, nullable=False)
+    amount_cents = Column(BigInteger, default=0, nullable=False)
+    status = Column(String, default="pending", nullable=False) # "pending", "invoiced", "skipped" (nothing due) or "failed"
+    attempts = Column(Integer, default=0, nullable=False)
+    error = Column(Text, nullable=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id"), nullable=True)
+    stripe_invoice_id = Column(String, nullable=True) # Recorded once the Stripe invoice exists, so retries reuse it
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    run = relationship("BillingRun", back_populates="ledger")
+    subscription = relationship("Subscription")
+    invoice = relationship("Invoice")
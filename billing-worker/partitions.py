@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+import redis.asyncio as redis
+from prometheus_client import Gauge
+
+logger = logging.getLogger(__name__)
+
+BILLING_USAGE_PARTITIONS_OWNED = Gauge('billing_usage_partitions_owned', 'Usage stream partitions assigned to this billing worker')
+BILLING_USAGE_CONSUMERS = Gauge('billing_usage_consumers', 'Live billing workers sharing the usage stream partitions')
+
+
+def usage_stream_key(stream_key: str, partition: int) -> str:
+    # Same naming as the gateway's usage buffer
+    return f"{stream_key}:{partition}"
+
+
+class PartitionAssigner:
+    """Splits the usage stream partitions between the live billing workers.
+
+    Each worker records a heartbeat in the `members_key` sorted set every
+    `heartbeat_interval` seconds, and members silent for `member_timeout` seconds
+    are dropped. Worker i of the n live workers, in name order, owns the
+    partitions p with p % n == i, so partitions move as soon as workers join or
+    leave. While the workers catch up on a change two of them may read the same
+    partition for a moment, which is harmless: the consumer group still delivers
+    every entry to only one of them.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        consumer_name: str,
+        partitions: int,
+        members_key: str,
+        heartbeat_interval: float = 5.0,
+        member_timeout: float = 15.0,
+    ):
+        self.redis_client = redis_client
+        self.consumer_name = consumer_name
+        self.partitions = partitions
+        self.members_key = members_key
+        self.heartbeat_interval = heartbeat_interval
+        self.member_timeout = member_timeout
+        self.owned: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+        self._closing = asyncio.Event()
+
+    async def heartbeat(self):
+        now = time.time()
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.members_key, {self.consumer_name: now})
+            pipe.zremrangebyscore(self.members_key, "-inf", now - self.member_timeout)
+            pipe.zrange(self.members_key, 0, -1)
+            _, _, members = await pipe.execute()
+
+        # Ordered by name; the set itself is ordered by heartbeat time, which keeps changing
+        members = sorted(members)
+        index = members.index(self.consumer_name)
+        owned = [partition for partition in range(self.partitions) if partition % len(members) == index]
+        if owned != self.owned:
+            logger.info(f"Consumer {self.consumer_name} now owns usage partitions {owned} of {self.partitions} ({len(members)} workers)")
+            self.owned = owned
+        BILLING_USAGE_PARTITIONS_OWNED.set(len(owned))
+        BILLING_USAGE_CONSUMERS.set(len(members))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            # The flag covers a cancellation swallowed by the Redis client mid-call
+            self._closing.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Leave right away so the others take over without waiting for the timeout
+        try:
+            await self.redis_client.zrem(self.members_key, self.consumer_name)
+        except redis.RedisError as e:
+            logger.warning(f"Could not leave usage consumer membership: {e}")
+        self.owned = []
+
+    async def _run(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), timeout=self.heartbeat_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Usage consumer heartbeat failed: {e}", exc_info=True)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import random
+import time
+
+import stripe
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+BILLING_STRIPE_REQUESTS = Counter('billing_stripe_requests_total', 'Stripe API requests made by the billing worker', ['outcome'])
+BILLING_STRIPE_REQUEST_DURATION = Histogram('billing_stripe_request_duration_seconds', 'Time taken by one Stripe API request, excluding rate limiting')
+
+# Worth another attempt with the same idempotency key; other Stripe errors are final
+RETRYABLE_ERRORS = (stripe.RateLimitError, stripe.APIConnectionError, stripe.APIError)
+
+
+class StripeRateLimiter:
+    """Token bucket spacing Stripe requests to at most `rate` per second after a burst of `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = float(max(1, burst))
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = asyncio.Lock() # Waiters are served in turn
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class StripeCaller:
+    """Runs the blocking Stripe SDK calls in threads, off the event loop.
+
+    At most `max_concurrency` requests are in flight and all of them pass the
+    rate limiter first. Rate limited, connection and server errors are retried
+    up to `max_retries` times with full jitter backoff, so callers must pass an
+    idempotency key to anything that creates objects.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float,
+        max_concurrency: int,
+        max_retries: int = 4,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 30.0,
+    ):
+        self.limiter = StripeRateLimiter(requests_per_second, max_concurrency)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def retry_delay(self, retry: int) -> float:
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** retry))
+
+    async def call(self, method, *args, **params):
+        retry = 0
+        while True:
+            async with self._semaphore:
+                await self.limiter.acquire()
+                started = time.monotonic()
+                try:
+                    result = await asyncio.to_thread(method, *args, **params)
+                except RETRYABLE_ERRORS as e:
+                    if retry >= self.max_retries:
+                        BILLING_STRIPE_REQUESTS.labels(outcome="failed").inc()
+                        raise
+                    BILLING_STRIPE_REQUESTS.labels(outcome="retried").inc()
+                    error = e
+                except stripe.StripeError:
+                    BILLING_STRIPE_REQUESTS.labels(outcome="failed").inc()
+                    raise
+                else:
+                    BILLING_STRIPE_REQUESTS.labels(outcome="succeeded").inc()
+                    return result
+                finally:
+                    BILLING_STRIPE_REQUEST_DURATION.observe(time.monotonic() - started)
+            # Backing off outside the semaphore leaves the slot to other requests
+            delay = self.retry_delay(retry)
+            retry += 1
+            logger.warning(f"Stripe request failed ({error}); retry {retry} of {self.max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
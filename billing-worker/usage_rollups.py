@@ -0,0 +1,132 @@
+# Copied verbatim to billing-worker/usage_rollups.py; keep the two in sync, like models.py.
+"""Usage totals at minute, hour, day and month resolution.
+
+The billing worker adds every batch of usage events to all four rollups and
+drops minute and hour rows once they are older than their retention. Readers
+ask for a time range and get the query against the coarsest rollup that
+answers it, so a month of billing reads one row per client instead of thirty.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from sqlalchemy import func, select
+
+from models import UsageAggregate, UsageRollupMinute, UsageRollupHour, UsageRollupMonth
+
+MINUTE = "minute"
+HOUR = "hour"
+DAY = "day"
+MONTH = "month"
+RESOLUTIONS = (MINUTE, HOUR, DAY, MONTH) # Finest first
+
+# The daily rollup is the original usage_aggregates table
+ROLLUP_MODELS = {MINUTE: UsageRollupMinute, HOUR: UsageRollupHour, DAY: UsageAggregate, MONTH: UsageRollupMonth}
+TOTAL_COLUMNS = ("total_requests", "total_bytes", "total_request_bytes", "total_response_bytes")
+
+# How long rows of each resolution are kept; None keeps them for good
+RETENTION = {
+    MINUTE: timedelta(hours=int(os.getenv("USAGE_MINUTE_RETENTION_HOURS", "48"))),
+    HOUR: timedelta(days=int(os.getenv("USAGE_HOUR_RETENTION_DAYS", "90"))),
+    DAY: timedelta(days=int(os.getenv("USAGE_DAY_RETENTION_DAYS", "0"))) or None,
+    MONTH: None,
+}
+
+
+def bucket_column(resolution: str):
+    model = ROLLUP_MODELS[resolution]
+    return model.date if resolution == DAY else model.bucket_start
+
+
+def as_utc(moment: datetime) -> datetime:
+    # Naive datetimes are taken to be UTC already
+    return moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def bucket_start(moment: datetime, resolution: str) -> datetime:
+    """Start of the bucket of `resolution` that contains `moment`, in UTC."""
+    moment = as_utc(moment)
+    if resolution == MINUTE:
+        return moment.replace(second=0, microsecond=0)
+    if resolution == HOUR:
+        return moment.replace(minute=0, second=0, microsecond=0)
+    if resolution == DAY:
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def retained_since(resolution: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """Oldest moment still covered by `resolution`, or None if it is kept for good."""
+    if RETENTION[resolution] is None:
+        return None
+    return bucket_start((now or datetime.now(timezone.utc)) - RETENTION[resolution], resolution)
+
+
+def pick_resolution(start: datetime, end: datetime, now: Optional[datetime] = None) -> str:
+    """Coarsest resolution that answers [start, end) exactly and is still retained for `start`.
+
+    A range whose bounds fall inside buckets of every retained resolution is
+    answered by the finest retained one, counting the buckets it overlaps.
+    """
+    start, end = as_utc(start), as_utc(end)
+    retained = [
+        resolution for resolution in RESOLUTIONS
+        if retained_since(resolution, now) is None or bucket_start(start, resolution) >= retained_since(resolution, now)
+    ] or [RESOLUTIONS[-1]]
+    for resolution in reversed(retained):
+        if bucket_start(start, resolution) == start and bucket_start(end, resolution) == end:
+            return resolution
+    return retained[0]
+
+
+# Upper bound on the length of each resolution's buckets, for estimating series lengths
+BUCKET_LENGTH = {MINUTE: timedelta(minutes=1), HOUR: timedelta(hours=1), DAY: timedelta(days=1), MONTH: timedelta(days=31)}
+
+
+def series_resolution(start: datetime, end: datetime, max_points: int, now: Optional[datetime] = None) -> str:
+    """Finest resolution still retained for `start` that covers [start, end) in at most `max_points` buckets."""
+    for resolution in RESOLUTIONS:
+        since = retained_since(resolution, now)
+        if since is not None and bucket_start(start, resolution) < since:
+            continue
+        if (as_utc(end) - bucket_start(start, resolution)) / BUCKET_LENGTH[resolution] <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def usage_totals_query(start: datetime, end: datetime, *group_by: str, now: Optional[datetime] = None) -> Tuple[str, type, object]:
+    """Summed usage in [start, end), optionally grouped by columns such as "api_id".
+
+    Returns the resolution used, its model (to add filters on) and the query,
+    which selects the `group_by` columns and then the four totals.
+    """
+    resolution = pick_resolution(start, end, now)
+    model = ROLLUP_MODELS[resolution]
+    column = bucket_column(resolution)
+    query = select(
+        *(getattr(model, name) for name in group_by),
+        *(func.coalesce(func.sum(getattr(model, name)), 0).label(name) for name in TOTAL_COLUMNS),
+    ).filter(
+        column >= bucket_start(start, resolution),
+        column < as_utc(end),
+    )
+    if group_by:
+        query = query.group_by(*(getattr(model, name) for name in group_by))
+    return resolution, model, query
+
+
+def usage_series_query(start: datetime, end: datetime, resolution: str):
+    """Summed usage per bucket of `resolution` overlapping [start, end), oldest first.
+
+    Selects `bucket_start` and the four totals; returns the model to add filters on and the query.
+    """
+    model = ROLLUP_MODELS[resolution]
+    column = bucket_column(resolution)
+    query = select(
+        column.label("bucket_start"),
+        *(func.sum(getattr(model, name)).label(name) for name in TOTAL_COLUMNS),
+    ).filter(
+        column >= bucket_start(start, resolution),
+        column < as_utc(end),
+    ).group_by(column).order_by(column)
+    return model, query
@@ -0,0 +1,314 @@
+"""Microbenchmarks for the gateway hot path.
+
+Drives the gateway app in-process against fakeredis (or a local Redis with
+--redis-url) and in-process stand-ins for the management API and a publisher
+backend. Each stage is timed on its own and reports requests/s, p50/p99
+latency and Redis commands and round trips per request. Results are written as
+JSON so runs on different commits can be compared with --compare.
+
+    cd gateway
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python benchmarks/run.py --requests 5000
+    python benchmarks/run.py --compare benchmarks/results/<earlier run>.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_DIR = os.path.dirname(BENCHMARKS_DIR)
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+
+sys.path.insert(0, GATEWAY_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import stubs
+
+API_KEY = "bench-key"
+
+
+class RedisOpCounter:
+    """Counts Redis commands and round trips made through redis-py clients.
+
+    A pipeline is one round trip carrying all of its commands; every other
+    command, including script calls, is a round trip of its own.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def install(self):
+        from redis.asyncio.client import Pipeline, Redis
+
+        counter = self
+        execute_command = Redis.execute_command
+        execute_pipeline = Pipeline.execute
+
+        @functools.wraps(execute_command)
+        async def counted_execute_command(client, *args, **options):
+            counter.commands += 1
+            counter.round_trips += 1
+            return await execute_command(client, *args, **options)
+
+        @functools.wraps(execute_pipeline)
+        async def counted_execute_pipeline(pipe, *args, **kwargs):
+            counter.commands += len(pipe.command_stack)
+            counter.round_trips += 1
+            return await execute_pipeline(pipe, *args, **kwargs)
+
+        Redis.execute_command = counted_execute_command
+        Pipeline.execute = counted_execute_pipeline
+
+    def snapshot(self):
+        return self.commands, self.round_trips
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def measure(
+    name: str,
+    operation: Callable[[int], Awaitable[None]],
+    requests: int,
+    warmup: int,
+    concurrency: int,
+    counter: RedisOpCounter,
+    settle: Optional[Callable[[], Awaitable[None]]] = None,
+) -> Dict[str, float]:
+    for i in range(warmup):
+        await operation(i)
+    if settle is not None:
+        await settle()
+
+    latencies: List[float] = []
+    next_index = iter(range(requests))
+
+    async def worker():
+        for i in next_index:
+            start = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - start)
+
+    commands_before, round_trips_before = counter.snapshot()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    # Work the stage defers, such as flushing usage events, is part of its cost
+    if settle is not None:
+        await settle()
+    elapsed = time.perf_counter() - start
+    commands_after, round_trips_after = counter.snapshot()
+
+    latencies.sort()
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "requests_per_second": requests / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "redis_commands_per_request": (commands_after - commands_before) / requests,
+        "redis_round_trips_per_request": (round_trips_after - round_trips_before) / requests,
+    }
+    print(
+        f"{name:<24} {result['requests_per_second']:>10.0f} req/s  "
+        f"p50 {result['p50_ms']:>7.3f} ms  p99 {result['p99_ms']:>7.3f} ms  "
+        f"redis {result['redis_commands_per_request']:>5.2f} cmd / {result['redis_round_trips_per_request']:>5.2f} rtt per request"
+    )
+    return result
+
+
+def configure_environment(args):
+    # Read by main at import time
+    os.environ["MANAGEMENT_API_URL"] = stubs.MANAGEMENT_API_URL
+    os.environ["REDIS_URL"] = args.redis_url or "redis://fakeredis"
+    os.environ["LOG_SAMPLE_RATE"] = "0" # Keep the request log out of the measurements; errors are still logged
+    os.environ["API_KEY_FILTER_ENABLED"] = "false"
+    os.environ["RESPONSE_CACHE_ENABLED"] = "false"
+
+
+async def start_gateway(args, counter: RedisOpCounter):
+    import httpx
+    import main
+    from management_client import ManagementApiClient
+    from upstream import UpstreamClients
+
+    if not args.redis_url:
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        main.redis.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+    else:
+        # A dedicated database, emptied so runs do not see each other's state
+        flush_client = main.redis.from_url(args.redis_url)
+        await flush_client.flushdb()
+        await flush_client.close()
+
+    plan = stubs.make_plan(args.algorithm)
+    management_stub = stubs.ManagementApiStub([API_KEY], plan)
+    main.ManagementApiClient = functools.partial(ManagementApiClient, transport=httpx.ASGITransport(app=management_stub))
+    main.UpstreamClients = functools.partial(UpstreamClients, transport=httpx.ASGITransport(app=stubs.upstream_stub))
+
+    counter.install()
+    await main.startup_event()
+    # The key update listener loads the policy table once it has subscribed
+    for _ in range(100):
+        if len(main.policy_table):
+            break
+        await asyncio.sleep(0.05)
+    else:
+        raise RuntimeError("Gateway did not load the plan policy table from the management API stub")
+    return main, management_stub
+
+
+async def run(args) -> Dict[str, Dict[str, float]]:
+    import hashlib
+
+    import httpx
+    from prometheus_client import CollectorRegistry, Counter, Histogram
+
+    from request_metrics import RequestMetricsMiddleware
+
+    counter = RedisOpCounter()
+    main, management_stub = await start_gateway(args, counter)
+    api_key_hash = hashlib.sha256(API_KEY.encode()).hexdigest()
+    run_stage = functools.partial(measure, requests=args.requests, warmup=args.warmup, counter=counter)
+    results = {}
+
+    try:
+        # Key validation served from the in-process L1 cache
+        async def validate_hot(i):
+            await main.validate_api_key(API_KEY)
+        results["validate_api_key_l1"] = await run_stage("validate_api_key (L1)", validate_hot, concurrency=1)
+
+        # Key validation that misses L1 and is answered by the api_key: Redis entry
+        async def validate_redis(i):
+            main.api_key_cache.invalidate(api_key_hash)
+            await main.validate_api_key(API_KEY)
+        results["validate_api_key_redis"] = await run_stage("validate_api_key (Redis)", validate_redis, concurrency=1)
+
+        # Rate limit and quota decision for the plan's algorithm
+        validated_key = await main.validate_api_key(API_KEY)
+        policy = main.resolve_policy(validated_key)
+
+        async def rate_limit(i):
+            await main.apply_rate_limit(f"{api_key_hash}:{i % 1000}", policy, validated_key)
+        results["apply_rate_limit"] = await run_stage(f"apply_rate_limit ({policy.algorithm})", rate_limit, concurrency=1)
+
+        # Usage emission, including the batched stream writes it causes
+        async def emit_usage(i):
+            main.record_usage(validated_key, "bench/items", 128, 1024)
+
+        async def drain_usage():
+            while len(main.usage_buffer):
+                await main.usage_buffer.flush()
+        results["usage_emission"] = await run_stage("usage emission", emit_usage, concurrency=1, settle=drain_usage)
+
+        # Request ID, metrics and logging middleware around an app that does nothing
+        registry = CollectorRegistry()
+        middleware = RequestMetricsMiddleware(
+            stubs.upstream_stub,
+            request_count=Counter('bench_requests_total', 'Benchmark requests', ['method', 'api_id', 'endpoint', 'status_code'], registry=registry),
+            request_latency=Histogram('bench_request_duration_seconds', 'Benchmark latency', ['method', 'api_id', 'endpoint'], registry=registry),
+            per_api=True,
+        )
+        middleware_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=middleware), base_url="http://gateway.bench")
+        bare_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stubs.upstream_stub), base_url="http://gateway.bench")
+
+        async def bare_request(i):
+            await bare_client.get("/bench/items")
+        async def middleware_request(i):
+            await middleware_client.get("/bench/items")
+        results["asgi_baseline"] = await run_stage("ASGI baseline", bare_request, concurrency=1)
+        results["middleware"] = await run_stage("metrics middleware", middleware_request, concurrency=1)
+        await middleware_client.aclose()
+        await bare_client.aclose()
+
+        # Whole proxied request through the gateway app
+        gateway_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://gateway.bench")
+        headers = {"X-API-Key": API_KEY}
+
+        async def proxied_request(i):
+            response = await gateway_client.get("/bench/items", headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError(f"Proxied request failed with {response.status_code}: {response.text}")
+        results["end_to_end"] = await run_stage(
+            f"end to end (x{args.concurrency})", proxied_request, concurrency=args.concurrency, settle=drain_usage
+        )
+        await gateway_client.aclose()
+    finally:
+        await main.shutdown_event()
+
+    print(f"management API stub calls: {management_stub.calls}")
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=GATEWAY_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    for stage, current in results.items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is None:
+            continue
+        changes = []
+        for metric in ("requests_per_second", "p50_ms", "p99_ms", "redis_round_trips_per_request"):
+            if previous.get(metric):
+                changes.append(f"{metric} {100 * (current[metric] - previous[metric]) / previous[metric]:+.1f}%")
+        print(f"{stage:<24} " + "  ".join(changes))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="measured operations per stage")
+    parser.add_argument("--warmup", type=int, default=200, help="unmeasured operations run before each stage")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients for the end to end stage")
+    parser.add_argument("--algorithm", default="gcra", help="rate limit algorithm of the benchmark plan")
+    parser.add_argument("--redis-url", help="use this Redis (its database is flushed) instead of fakeredis")
+    parser.add_argument("--output", help="where to write the JSON results (default: benchmarks/results/)")
+    parser.add_argument("--compare", help="earlier results file to report changes against")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    results = asyncio.run(run(args))
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "redis": args.redis_url or "fakeredis",
+        "algorithm": args.algorithm,
+        "stages": results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{commit or 'nocommit'}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main_cli()
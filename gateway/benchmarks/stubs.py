@@ -0,0 +1,96 @@
+"""In-process stand-ins for the services the gateway talks to over HTTP.
+
+Both are plain ASGI apps served through `httpx.ASGITransport`, so benchmark
+numbers measure the gateway and Redis rather than a network.
+"""
+import hashlib
+import json
+
+MANAGEMENT_API_URL = "http://management-api.bench"
+UPSTREAM_URL = "http://upstream.bench"
+
+API_ID = 1
+CLIENT_ID = 1
+PLAN_ID = 1
+UPSTREAM_BODY = json.dumps({"data": [{"id": i, "name": f"item-{i}"} for i in range(20)]}).encode()
+
+
+def make_plan(algorithm: str, rate_limit: int = 10 ** 9, quota_limit=None) -> dict:
+    # Limits high enough that benchmarks measure the decision, never a rejection
+    return {
+        "id": PLAN_ID,
+        "api_id": API_ID,
+        "name": "bench",
+        "billing_interval": "monthly",
+        "price_cents": 0,
+        "unit_type": "request",
+        "unit_price_cents": 0,
+        "stripe_price_id": None,
+        "quota_limit": quota_limit,
+        "rate_limit_requests": rate_limit,
+        "rate_limit_window_seconds": 60,
+        "rate_limit_burst": None,
+        "rate_limit_algorithm": algorithm,
+    }
+
+
+def make_key_data(api_key_raw: str, plan: dict) -> dict:
+    return {
+        "id": 1,
+        "client_id": CLIENT_ID,
+        "api_id": API_ID,
+        "key_hash": hashlib.sha256(api_key_raw.encode()).hexdigest(),
+        "status": "active",
+        "created_at": "2024-01-01T00:00:00+00:00",
+        "expires_at": None,
+        "plan": plan,
+        "api_base_url": UPSTREAM_URL,
+        "api_response_cache_enabled": False,
+        "api_response_cache_vary_headers": None,
+        "api_response_cache_max_ttl_seconds": None,
+        "api_upstream_targets": [],
+        "api_load_balancing": None,
+        "api_health_check_path": None,
+    }
+
+
+async def _send_json(send, status: int, body: bytes):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class ManagementApiStub:
+    """Answers the two management API calls the gateway makes and counts them."""
+
+    def __init__(self, api_keys, plan: dict):
+        self.key_data = {key: json.dumps(make_key_data(key, plan)).encode() for key in api_keys}
+        self.plan_policies = json.dumps([plan]).encode()
+        self.calls = 0
+
+    async def __call__(self, scope, receive, send):
+        self.calls += 1
+        path = scope["path"]
+        if path == "/validate/plan-policies":
+            await _send_json(send, 200, self.plan_policies)
+            return
+        if path.startswith("/validate/validate-api-key/"):
+            body = self.key_data.get(path.rsplit("/", 1)[-1])
+            if body is None:
+                await _send_json(send, 404, b'{"detail": "API Key not found"}')
+            else:
+                await _send_json(send, 200, body)
+            return
+        await _send_json(send, 404, b'{"detail": "Not Found"}')
+
+
+async def upstream_stub(scope, receive, send):
+    # Drain the request body so streamed uploads complete
+    more_body = True
+    while more_body:
+        message = await receive()
+        more_body = message.get("more_body", False)
+    await _send_json(send, 200, UPSTREAM_BODY)
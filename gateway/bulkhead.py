@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+REQUESTS_SHED = Counter('gateway_requests_shed_total', 'Requests rejected with 503 to protect the gateway and other tenants', ['reason', 'priority'])
+IN_FLIGHT_REQUESTS = Gauge('gateway_in_flight_requests', 'Proxied requests admitted and not yet finished', multiprocess_mode='livesum')
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Bulkhead:
+    """Concurrency limit with a bounded wait queue ordered by priority.
+
+    Up to `limit` callers hold a slot at once. Further callers wait, highest
+    priority first and in arrival order within a priority, for at most
+    `queue_timeout` seconds. When `max_queue` callers are already waiting, a new
+    caller displaces the lowest-priority waiter if it outranks it and is
+    rejected otherwise. A released slot is handed straight to the next waiter.
+    """
+
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._queued = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = [] # (-priority, seq, future) heap
+        self._seq = itertools.count()
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and self._queued == 0
+
+    def _displace(self, priority: int) -> bool:
+        live = [entry for entry in self._waiters if not entry[2].done()]
+        lowest = max(live, default=None) # Lowest priority, most recent arrival
+        if lowest is None or -lowest[0] >= priority:
+            return False
+        lowest[2].set_exception(Rejected("queue_full"))
+        self._queued -= 1
+        return True
+
+    async def acquire(self, priority: int = 0):
+        if self.active < self.limit and not self._queued:
+            self.active += 1
+            return
+        if self._queued >= self.max_queue and not self._displace(priority):
+            raise Rejected("queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._seq), future))
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(future)
+            raise Rejected("queue_timeout")
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+
+    def _abandon(self, future: asyncio.Future):
+        if not future.done():
+            future.cancel()
+            self._queued -= 1
+        elif not future.cancelled() and future.exception() is None:
+            # The slot was handed over just as the caller gave up; pass it on
+            self.release()
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._queued -= 1
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class Bulkheads:
+    """One `Bulkhead` per key, created on first use and dropped once idle."""
+
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._bulkheads: Dict[str, Bulkhead] = {}
+
+    def __len__(self):
+        return len(self._bulkheads)
+
+    async def acquire(self, key: str, priority: int = 0):
+        bulkhead = self._bulkheads.get(key)
+        if bulkhead is None:
+            bulkhead = self._bulkheads[key] = Bulkhead(self.limit, self.max_queue, self.queue_timeout)
+        try:
+            await bulkhead.acquire(priority)
+        except BaseException:
+            self._forget_if_idle(key, bulkhead)
+            raise
+
+    def release(self, key: str):
+        bulkhead = self._bulkheads[key]
+        bulkhead.release()
+        self._forget_if_idle(key, bulkhead)
+
+    def _forget_if_idle(self, key: str, bulkhead: Bulkhead):
+        if bulkhead.idle and self._bulkheads.get(key) is bulkhead:
+            del self._bulkheads[key]
+
+
+def parse_shed_thresholds(spec: str) -> Dict[int, float]:
+    """Parses "0:0.7,1:0.9" into {priority: share of capacity}."""
+    thresholds = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        priority, share = part.split(":")
+        thresholds[int(priority)] = float(share)
+    return thresholds
+
+
+class LoadShedder:
+    """Process-wide cap on in-flight requests that sheds low priorities first.
+
+    A request of a priority listed in `thresholds` is admitted only while fewer
+    than that share of `max_in_flight` requests are in flight; priorities below
+    the lowest listed one use its share, and higher ones may use all capacity.
+    With the default "0:0.7", free-tier traffic is shed once the gateway is 70%
+    busy, leaving the rest for paid plans.
+    """
+
+    def __init__(self, max_in_flight: int, thresholds: Optional[Dict[int, float]] = None):
+        self.max_in_flight = max_in_flight
+        self.thresholds = thresholds or {}
+        self.in_flight = 0
+
+    def _share(self, priority: int) -> float:
+        if priority in self.thresholds:
+            return self.thresholds[priority]
+        if self.thresholds and priority < min(self.thresholds):
+            return self.thresholds[min(self.thresholds)]
+        return 1.0
+
+    def admit(self, priority: int = 0):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight * self._share(priority):
+            raise Rejected("overload")
+        self.in_flight += 1
+        IN_FLIGHT_REQUESTS.set(self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        IN_FLIGHT_REQUESTS.set(self.in_flight)
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Tuple, Type, TypeVar
+
+from prometheus_client import Counter, Gauge
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_BREAKER_STATE = Gauge('gateway_circuit_breaker_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)', ['name'], multiprocess_mode='livemax')
+CIRCUIT_BREAKER_TRANSITIONS = Counter('gateway_circuit_breaker_transitions_total', 'Circuit breaker state changes', ['name', 'state'])
+CIRCUIT_BREAKER_REJECTED = Counter('gateway_circuit_breaker_rejected_total', 'Calls short-circuited by an open circuit breaker', ['name'])
+
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After `failure_threshold` failures in a row the circuit opens and calls fail
+    immediately for `recovery_timeout` seconds. It then half-opens and lets up to
+    `half_open_max_calls` trial calls through: a success closes the circuit, a
+    failure opens it again for another `recovery_timeout`.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 10.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        CIRCUIT_BREAKER_STATE.labels(name=name).set(_STATE_VALUES[CLOSED])
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        CIRCUIT_BREAKER_STATE.labels(name=self.name).set(_STATE_VALUES[state])
+        CIRCUIT_BREAKER_TRANSITIONS.labels(name=self.name, state=state).inc()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == OPEN and time.monotonic() - self._opened_at < self.recovery_timeout
+
+    def before_call(self):
+        """Raises `CircuitOpenError` unless a call may go ahead now."""
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                CIRCUIT_BREAKER_REJECTED.labels(name=self.name).inc()
+                raise CircuitOpenError(f"Circuit '{self.name}' is open")
+            self._transition(HALF_OPEN)
+            self._half_open_calls = 0
+        if self.state == HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                CIRCUIT_BREAKER_REJECTED.labels(name=self.name).inc()
+                raise CircuitOpenError(f"Circuit '{self.name}' is half-open and a trial call is in flight")
+            self._half_open_calls += 1
+
+    def release(self):
+        """Gives back a trial slot for a call that ended without an outcome."""
+        if self.state == HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def record_success(self):
+        self._failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._transition(OPEN)
+
+    async def call(self, operation: Callable[[], Awaitable[T]], failures: Tuple[Type[BaseException], ...]) -> T:
+        """Runs `operation` through the breaker; only `failures` count against it."""
+        self.before_call()
+        try:
+            result = await operation()
+        except failures:
+            self.record_failure()
+            raise
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        except Exception:
+            # The dependency answered, even if with an error of its own
+            self.record_success()
+            raise
+        self.record_success()
+        return result
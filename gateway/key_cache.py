@@ -0,0 +1,85 @@
+import math
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional
+
+
+class CachedKey(NamedTuple):
+    key_data: Dict[str, Any]
+    expires_at: float # time.monotonic() when this L1 entry expires
+    source_expires_at: float # time.monotonic() when the shared api_key: Redis entry expires
+
+
+class ApiKeyCache:
+    """Bounded in-process LRU cache with per-entry TTL for validated API keys.
+
+    Sits in front of the `api_key:` Redis entries so hot keys are served without
+    a network round trip. Entries are dropped early when a revocation is pushed
+    over Redis pub/sub (see `invalidate`).
+
+    Expired entries are kept for another `stale_ttl_seconds` as a last-known-good
+    copy, returned only by `get_stale`, for when the key cannot be revalidated.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, stale_ttl_seconds: float = 0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.stale_ttl_seconds = stale_ttl_seconds
+        self._entries: "OrderedDict[str, CachedKey]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key_hash: str) -> Optional[CachedKey]:
+        entry = self._entries.get(key_hash)
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if entry.expires_at <= now:
+            if entry.expires_at + self.stale_ttl_seconds <= now:
+                del self._entries[key_hash]
+            return None
+
+        self._entries.move_to_end(key_hash)
+        return entry
+
+    def get_stale(self, key_hash: str) -> Optional[CachedKey]:
+        entry = self._entries.get(key_hash)
+        if entry is None or entry.expires_at + self.stale_ttl_seconds <= time.monotonic():
+            return None
+        return entry
+
+    def set(self, key_hash: str, key_data: Dict[str, Any], source_ttl_seconds: Optional[float] = None) -> int:
+        """Store an entry and return how many LRU entries were evicted to make room.
+
+        `source_ttl_seconds` is the remaining lifetime of the shared Redis entry
+        the data came from, used to decide when to refresh it early.
+        """
+        now = time.monotonic()
+        source_ttl_seconds = self.ttl_seconds if source_ttl_seconds is None else source_ttl_seconds
+        self._entries[key_hash] = CachedKey(key_data, now + self.ttl_seconds, now + source_ttl_seconds)
+        self._entries.move_to_end(key_hash)
+        evicted = 0
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def invalidate(self, key_hash: str) -> bool:
+        return self._entries.pop(key_hash, None) is not None
+
+    def clear(self):
+        self._entries.clear()
+
+
+def should_refresh_early(entry: CachedKey, delta: float, beta: float = 1.0) -> bool:
+    """Probabilistic early expiration ("XFetch", Vattani et al. 2015).
+
+    Returns True with a probability that rises sharply as the source entry nears
+    expiry. `delta` is how long a refresh takes; larger `beta` refreshes earlier.
+    Hot keys are therefore renewed shortly before they expire, while cold keys
+    rarely pay for a refresh.
+    """
+    return time.monotonic() - delta * beta * math.log(1.0 - random.random()) >= entry.source_expires_at
@@ -0,0 +1,39 @@
+from typing import List
+
+# Must match management-api/key_filter.py, which builds the filter in Redis
+API_KEY_FILTER_KEY = "api_key_filter"
+API_KEY_FILTER_UPDATES_CHANNEL = "api_key_filter_updates"
+API_KEY_FILTER_BITS = 1 << 24
+API_KEY_FILTER_HASHES = 7
+
+
+class KeyFilter:
+    """In-memory copy of the Bloom filter of active API key hashes.
+
+    A key hash the filter does not contain was never issued (or was added while
+    this copy was stale), so it can be rejected without any I/O. A positive
+    answer only means the key may exist and must still be validated.
+    """
+
+    def __init__(self, bitmap: bytes):
+        self._bits = bytearray(bitmap)
+
+    @classmethod
+    def from_bitmap(cls, bitmap: bytes):
+        # SETBIT on a missing key creates a short bitmap; only a full rebuild is usable
+        if bitmap is None or len(bitmap) * 8 != API_KEY_FILTER_BITS:
+            return None
+        return cls(bitmap)
+
+    @staticmethod
+    def positions(key_hash: str) -> List[int]:
+        # key_hash is a SHA-256 hex digest, so its 32-bit slices are already independent hashes
+        return [int(key_hash[i * 8:(i + 1) * 8], 16) % API_KEY_FILTER_BITS for i in range(API_KEY_FILTER_HASHES)]
+
+    def add(self, key_hash: str):
+        for position in self.positions(key_hash):
+            self._bits[position >> 3] |= 0x80 >> (position & 7)
+
+    def might_contain(self, key_hash: str) -> bool:
+        # Same bit order as Redis GETBIT: offset 0 is the most significant bit of byte 0
+        return all(self._bits[position >> 3] & (0x80 >> (position & 7)) for position in self.positions(key_hash))
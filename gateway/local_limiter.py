@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from rate_limiter import RateLimitResult
+
+
+class LocalRateLimiter:
+    """In-process token buckets used while Redis is unreachable.
+
+    Each gateway process admits `share` of every key's limit, so all processes
+    together stay close to the plan's limit without coordinating. Buckets start
+    full and at most `max_keys` are kept, least recently used first out.
+    """
+
+    def __init__(self, share: float, max_keys: int):
+        self.share = share
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict() # identifier -> (tokens, monotonic ts)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def hit(self, identifier: str, limit: int, window_seconds: int, burst: Optional[int] = None) -> RateLimitResult:
+        capacity = max(1.0, (burst or limit) * self.share)
+        rate = max(limit * self.share / window_seconds, 1e-9) # tokens per second
+        now = time.monotonic()
+        tokens, ts = self._buckets.get(identifier, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[identifier] = (tokens, now)
+        self._buckets.move_to_end(identifier)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        reset_after = (capacity - tokens) / rate if allowed else (1 - tokens) / rate
+        return RateLimitResult(allowed, int(capacity), int(tokens), reset_after)
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class QuotaBacklog:
+    """Quota consumed while Redis was unreachable, to be added to the counters later."""
+
+    def __init__(self):
+        self._pending: Dict[str, Tuple[int, int]] = {} # quota key -> (count, expire_at)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key: str, expire_at: int, count: int = 1):
+        pending, _ = self._pending.get(key, (0, expire_at))
+        self._pending[key] = (pending + count, expire_at)
+
+    def drain(self) -> Dict[str, Tuple[int, int]]:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending: Dict[str, Tuple[int, int]]):
+        for key, (count, expire_at) in pending.items():
+            self.add(key, expire_at, count)
@@ -1,208 +1,893 @@
 from fastapi import FastAPI, Request, Response, HTTPException, status
-from httpx import AsyncClient
+import httpx
+import asyncio
 import os
 import redis.asyncio as redis
 import hashlib
+import math
 import json
 import time
 from datetime import datetime, date
-
-from prometheus_client import generate_latest, Counter, Histogram
-from starlette.responses import PlainTextResponse
+from typing import Optional, Tuple
+
+from prometheus_client import generate_latest, multiprocess, CollectorRegistry, Counter, Histogram, Gauge
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from key_cache import ApiKeyCache, should_refresh_early
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from management_client import ManagementApiClient
+from singleflight import SingleFlight
+from key_filter import KeyFilter, API_KEY_FILTER_KEY, API_KEY_FILTER_UPDATES_CHANNEL
+from policies import PlanPolicy, PolicyTable, build_policy_table, policy_from_plan, PLAN_UPDATES_CHANNEL, FAIL_OPEN, FAIL_CLOSED
+from rate_limiter import RateLimiter, RateLimitResult, SLIDING_WINDOW_LOG, LEASED_TOKEN_BUCKET
+from token_lease import TokenLeaser
+from quota import quota_key, quota_expire_at
+from local_limiter import LocalRateLimiter, QuotaBacklog
+from usage_buffer import UsageEventBuffer
+from upstream_pool import UpstreamPools, LEAST_OUTSTANDING
+from bulkhead import Bulkheads, LoadShedder, Rejected, parse_shed_thresholds, REQUESTS_SHED
+from upstream import UpstreamClients, BodyTooLarge, MeteredStream, has_request_body, forwarded_request_headers, forwarded_response_headers
+from response_cache import (
+    ResponseCache,
+    CachedResponse,
+    BodyCapture,
+    CACHEABLE_METHODS,
+    CACHEABLE_STATUS_CODES,
+    RESPONSE_CACHE_LOOKUPS,
+    cache_key,
+    entry_from_response,
+    freshness_lifetime,
+    parse_cache_control,
+    revalidated,
+    vary_headers_for,
+)
+from logging_config import configure_logging
+from request_metrics import RequestMetricsMiddleware, normalize_path
 
 import logging
-import uuid
-
-# Configure JSON logging
-class JsonFormatter(logging.Formatter):
-    def format(self, record):
-        log_record = {
-            "timestamp": self.formatTime(record, self.datefmt),
-            "level": record.levelname,
-            "message": record.getMessage(),
-            "service": "gateway",
-            "request_id": getattr(record, 'request_id', None),
-            "endpoint": getattr(record, 'endpoint', None),
-            "method": getattr(record, 'method', None),
-            "status_code": getattr(record, 'status_code', None),
-            "traceback": self.formatException(record.exc_info) if record.exc_info else None,
-        }
-        return json.dumps(log_record)
 
+configure_logging("gateway")
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(JsonFormatter())
-logger.addHandler(handler)
 
 app = FastAPI()
 
 MANAGEMENT_API_URL = os.getenv("MANAGEMENT_API_URL")
 REDIS_URL = os.getenv("REDIS_URL")
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5")) # seconds; a stalled Redis fails fast instead of hanging requests
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5")) # seconds
+REDIS_BREAKER_FAILURE_THRESHOLD = int(os.getenv("REDIS_BREAKER_FAILURE_THRESHOLD", "3")) # consecutive failures
+REDIS_BREAKER_RECOVERY_TIMEOUT = float(os.getenv("REDIS_BREAKER_RECOVERY_TIMEOUT", "5")) # seconds open before a trial call
+REDIS_FAILURES = (redis.ConnectionError, redis.TimeoutError)
+redis_breaker = CircuitBreaker(
+    "redis",
+    failure_threshold=REDIS_BREAKER_FAILURE_THRESHOLD,
+    recovery_timeout=REDIS_BREAKER_RECOVERY_TIMEOUT,
+)
+
+# Calls to the management API fail fast so a slow management API cannot stall every worker
+MANAGEMENT_API_CONNECT_TIMEOUT = float(os.getenv("MANAGEMENT_API_CONNECT_TIMEOUT", "0.5")) # seconds
+MANAGEMENT_API_TIMEOUT = float(os.getenv("MANAGEMENT_API_TIMEOUT", "2")) # seconds for read, write and pool
+MANAGEMENT_API_HEDGE_DELAY = float(os.getenv("MANAGEMENT_API_HEDGE_DELAY", "0")) # seconds before a duplicate key validation is sent; 0 disables
+MANAGEMENT_API_BREAKER_FAILURE_THRESHOLD = int(os.getenv("MANAGEMENT_API_BREAKER_FAILURE_THRESHOLD", "5")) # consecutive failures
+MANAGEMENT_API_BREAKER_RECOVERY_TIMEOUT = float(os.getenv("MANAGEMENT_API_BREAKER_RECOVERY_TIMEOUT", "10")) # seconds open before a trial call
 
 redis_client: redis.Redis = None
-http_client: AsyncClient = None
+redis_binary_client: redis.Redis = None # For binary values such as the API key filter bitmap
+redis_pubsub_client: redis.Redis = None # Without socket timeouts, so an idle subscription is not dropped
+management_client: ManagementApiClient = None
+rate_limiter: RateLimiter = None
+token_leaser: TokenLeaser = None
+usage_buffer: UsageEventBuffer = None
+upstream_clients: UpstreamClients = None
+upstream_pools: UpstreamPools = None
 
 API_KEY_CACHE_PREFIX = "api_key:"
 API_KEY_CACHE_EXPIRATION = 300 # seconds
+API_KEY_REVOCATION_CHANNEL = "api_key_revocations" # Published by management-api when a key is revoked
+API_KEY_INVALID_PREFIX = "api_key_invalid:" # Negative cache of rejected key hashes, shared with management-api
+API_KEY_NEGATIVE_CACHE_TTL = int(os.getenv("API_KEY_NEGATIVE_CACHE_TTL", "60")) # seconds
+
+# In-process L1 cache in front of the api_key: Redis entries
+API_KEY_L1_CACHE_SIZE = int(os.getenv("API_KEY_L1_CACHE_SIZE", "10000"))
+API_KEY_L1_CACHE_TTL = float(os.getenv("API_KEY_L1_CACHE_TTL", "30")) # seconds
+API_KEY_STALE_TTL = float(os.getenv("API_KEY_STALE_TTL", "300")) # seconds an expired key is still served while the management API is down
+api_key_cache = ApiKeyCache(max_size=API_KEY_L1_CACHE_SIZE, ttl_seconds=API_KEY_L1_CACHE_TTL, stale_ttl_seconds=API_KEY_STALE_TTL)
+key_lookups = SingleFlight() # One in-flight lookup per key hash
+invalid_key_cache = ApiKeyCache(max_size=API_KEY_L1_CACHE_SIZE, ttl_seconds=API_KEY_NEGATIVE_CACHE_TTL)
+
+# Bloom filter of active key hashes, built by management-api; unknown keys are rejected with no I/O
+API_KEY_FILTER_ENABLED = os.getenv("API_KEY_FILTER_ENABLED", "true").lower() == "true"
+API_KEY_FILTER_RELOAD_INTERVAL = int(os.getenv("API_KEY_FILTER_RELOAD_INTERVAL", "60")) # seconds
+key_filter: KeyFilter = None # None until a complete filter has been loaded
+key_filter_task: asyncio.Task = None
+
+# Probabilistic early refresh of the api_key: Redis entries of hot keys
+API_KEY_EARLY_REFRESH_BETA = float(os.getenv("API_KEY_EARLY_REFRESH_BETA", "1.0")) # Higher refreshes earlier
+API_KEY_EARLY_REFRESH_MIN_DELTA = float(os.getenv("API_KEY_EARLY_REFRESH_MIN_DELTA", "1.0")) # seconds
+validation_latency_ewma = 0.0 # Smoothed management API validation latency, in seconds
+key_update_listener_task: asyncio.Task = None
 
 USAGE_STREAM_KEY = "usage_events"
+USAGE_BUFFER_BATCH_SIZE = int(os.getenv("USAGE_BUFFER_BATCH_SIZE", "500"))
+USAGE_BUFFER_FLUSH_INTERVAL = float(os.getenv("USAGE_BUFFER_FLUSH_INTERVAL", "0.05")) # seconds
+USAGE_BUFFER_CAPACITY = int(os.getenv("USAGE_BUFFER_CAPACITY", "100000"))
+USAGE_STREAM_MAXLEN = int(os.getenv("USAGE_STREAM_MAXLEN", "1000000")) # Approximate cap on stream entries
+USAGE_STREAM_RETENTION_SECONDS = int(os.getenv("USAGE_STREAM_RETENTION_SECONDS", "0")) or None # Optional MINID trimming
+USAGE_STREAM_PARTITIONS = int(os.getenv("USAGE_STREAM_PARTITIONS", "8")) # Must match the billing worker
+
+# Upstream (publisher backend) proxying
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5")) # seconds
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30")) # seconds between received chunks
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30")) # seconds between sent chunks
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5")) # seconds to wait for a free pooled connection
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100")) # per upstream
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20")) # per upstream
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60")) # seconds
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() == "true"
+MAX_REQUEST_BODY_BYTES = int(os.getenv("MAX_REQUEST_BODY_BYTES", str(50 * 1024 * 1024))) # 0 disables the cap
+MAX_RESPONSE_BODY_BYTES = int(os.getenv("MAX_RESPONSE_BODY_BYTES", "0")) # 0 disables the cap
+
+# Load balancing across the backend targets of an API, with active health checks and outlier ejection
+UPSTREAM_LOAD_BALANCING = os.getenv("UPSTREAM_LOAD_BALANCING", LEAST_OUTSTANDING) # Used when the API does not choose one
+UPSTREAM_HEALTH_CHECK_PATH = os.getenv("UPSTREAM_HEALTH_CHECK_PATH", "/") # Used when the API does not set one
+UPSTREAM_HEALTH_CHECK_INTERVAL = float(os.getenv("UPSTREAM_HEALTH_CHECK_INTERVAL", "10")) # seconds
+UPSTREAM_HEALTH_CHECK_TIMEOUT = float(os.getenv("UPSTREAM_HEALTH_CHECK_TIMEOUT", "2")) # seconds
+UPSTREAM_HEALTHY_THRESHOLD = int(os.getenv("UPSTREAM_HEALTHY_THRESHOLD", "2")) # passed checks in a row to return to rotation
+UPSTREAM_UNHEALTHY_THRESHOLD = int(os.getenv("UPSTREAM_UNHEALTHY_THRESHOLD", "3")) # failed checks in a row to leave rotation
+UPSTREAM_EJECTION_FAILURES = int(os.getenv("UPSTREAM_EJECTION_FAILURES", "5")) # failed requests in a row that eject a target
+UPSTREAM_EJECTION_SECONDS = float(os.getenv("UPSTREAM_EJECTION_SECONDS", "30"))
+UPSTREAM_SLOW_FACTOR = float(os.getenv("UPSTREAM_SLOW_FACTOR", "3")) # Eject targets this many times slower than the fastest; 0 disables
+UPSTREAM_SLOW_MIN_LATENCY = float(os.getenv("UPSTREAM_SLOW_MIN_LATENCY", "0.2")) # seconds; faster targets are never slow
+
+# Bulkheads: per-API and per-client concurrency limits, so one slow backend or busy client cannot take every slot
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "200")) # per worker process; 0 disables
+CLIENT_MAX_CONCURRENCY = int(os.getenv("CLIENT_MAX_CONCURRENCY", "50")) # per worker process; 0 disables
+BULKHEAD_MAX_QUEUE = int(os.getenv("BULKHEAD_MAX_QUEUE", "100")) # Requests waiting for a slot, per API or client
+BULKHEAD_QUEUE_TIMEOUT = float(os.getenv("BULKHEAD_QUEUE_TIMEOUT", "1")) # seconds a request waits for a slot
+# Load shedding: past a share of this many in-flight requests, lower plan priorities are rejected first
+GATEWAY_MAX_IN_FLIGHT = int(os.getenv("GATEWAY_MAX_IN_FLIGHT", "1000")) # per worker process; 0 disables
+GATEWAY_SHED_THRESHOLDS = parse_shed_thresholds(os.getenv("GATEWAY_SHED_THRESHOLDS", "0:0.7")) # priority:share of GATEWAY_MAX_IN_FLIGHT
+LOAD_SHED_RETRY_AFTER = int(os.getenv("LOAD_SHED_RETRY_AFTER", "1")) # seconds
+api_bulkheads = Bulkheads(API_MAX_CONCURRENCY, BULKHEAD_MAX_QUEUE, BULKHEAD_QUEUE_TIMEOUT)
+client_bulkheads = Bulkheads(CLIENT_MAX_CONCURRENCY, BULKHEAD_MAX_QUEUE, BULKHEAD_QUEUE_TIMEOUT)
+load_shedder = LoadShedder(GATEWAY_MAX_IN_FLIGHT, GATEWAY_SHED_THRESHOLDS)
+
+# Response cache for APIs that opt in; entries follow the upstream's Cache-Control and ETag
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))) # In-process tier
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024))) # Larger responses are not cached
+RESPONSE_CACHE_REDIS_ENABLED = os.getenv("RESPONSE_CACHE_REDIS_ENABLED", "false").lower() == "true" # Share entries between instances
+RESPONSE_CACHE_STALE_SECONDS = int(os.getenv("RESPONSE_CACHE_STALE_SECONDS", "300")) # Stale entries with an ETag are kept for revalidation
+response_cache: ResponseCache = None
 
 # Rate Limiting Configuration (per API key, per minute)
 RATE_LIMIT_WINDOW_SECONDS = 60
 DEFAULT_RATE_LIMIT_REQUESTS = 100 # Default if no specific limit is found
+DEFAULT_RATE_LIMIT_ALGORITHM = os.getenv("RATE_LIMIT_ALGORITHM", SLIDING_WINDOW_LOG) # Used when the plan does not choose one
+DEFAULT_REDIS_FAILURE_MODE = os.getenv("REDIS_FAILURE_MODE", FAIL_OPEN) # Used when the plan does not choose one
+DEFAULT_POLICY = PlanPolicy(
+    rate_limit=DEFAULT_RATE_LIMIT_REQUESTS,
+    window_seconds=RATE_LIMIT_WINDOW_SECONDS,
+    burst=None,
+    algorithm=DEFAULT_RATE_LIMIT_ALGORITHM,
+    quota_limit=None,
+    failure_mode=DEFAULT_REDIS_FAILURE_MODE,
+)
+
+# Degraded mode: while Redis is unreachable each process enforces its share of every limit locally
+GATEWAY_REPLICAS = int(os.getenv("GATEWAY_REPLICAS", "1")) # Gateway instances behind the load balancer
+GATEWAY_WORKER_COUNT = int(os.getenv("GATEWAY_WORKER_COUNT", "1")) # Worker processes per instance, set by serve.py
+DEGRADED_RATE_LIMIT_MAX_KEYS = int(os.getenv("DEGRADED_RATE_LIMIT_MAX_KEYS", "100000"))
+local_rate_limiter = LocalRateLimiter(share=1 / (GATEWAY_REPLICAS * GATEWAY_WORKER_COUNT), max_keys=DEGRADED_RATE_LIMIT_MAX_KEYS)
+quota_backlog = QuotaBacklog() # Quota consumed in degraded mode, added to the Redis counters on recovery
+quota_resync = SingleFlight() # One backlog resync at a time
+
+# Plans on the leased_token_bucket algorithm spend batches of tokens reserved from Redis locally
+RATE_LIMIT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "1")) # Unused tokens go back to Redis after this
+RATE_LIMIT_LEASE_MAX_TOKENS = int(os.getenv("RATE_LIMIT_LEASE_MAX_TOKENS", "1000")) # Largest batch one lease takes
+RATE_LIMIT_LEASE_MAX_SHARE = float(os.getenv("RATE_LIMIT_LEASE_MAX_SHARE", "0")) or 1 / (GATEWAY_REPLICAS * GATEWAY_WORKER_COUNT) # Of the bucket capacity per lease
+RATE_LIMIT_LEASE_MAX_KEYS = int(os.getenv("RATE_LIMIT_LEASE_MAX_KEYS", "100000"))
+
+# Per-plan limits compiled from management-api, reloaded on plan changes
+POLICY_RELOAD_INTERVAL = int(os.getenv("POLICY_RELOAD_INTERVAL", "60")) # seconds
+policy_table = PolicyTable({}, DEFAULT_POLICY)
+policy_reload_task: asyncio.Task = None
 
 # Prometheus Metrics for Gateway
-REQUEST_COUNT = Counter('gateway_http_requests_total', 'Total Gateway HTTP Requests', ['method', 'endpoint', 'status_code'])
-REQUEST_LATENCY = Histogram('gateway_http_request_duration_seconds', 'Gateway HTTP Request Latency', ['method', 'endpoint'])
+# Proxied traffic is labelled by api_id and a normalized path, everything else by route template
+REQUEST_COUNT = Counter('gateway_http_requests_total', 'Total Gateway HTTP Requests', ['method', 'api_id', 'endpoint', 'status_code'])
+REQUEST_LATENCY = Histogram('gateway_http_request_duration_seconds', 'Gateway HTTP Request Latency', ['method', 'api_id', 'endpoint'])
+app.add_middleware(RequestMetricsMiddleware, request_count=REQUEST_COUNT, request_latency=REQUEST_LATENCY, per_api=True)
+
+API_KEY_CACHE_HITS = Counter('gateway_api_key_cache_hits_total', 'API key lookups served from the in-process L1 cache')
+API_KEY_CACHE_MISSES = Counter('gateway_api_key_cache_misses_total', 'API key lookups that missed the in-process L1 cache')
+API_KEY_CACHE_EVICTIONS = Counter('gateway_api_key_cache_evictions_total', 'API keys evicted from the in-process L1 cache', ['reason'])
+API_KEY_LOOKUPS_COALESCED = Counter('gateway_api_key_lookups_coalesced_total', 'API key cache misses that joined an in-flight lookup for the same key')
+API_KEY_EARLY_REFRESHES = Counter('gateway_api_key_early_refreshes_total', 'Background refreshes of API keys started before their cache entry expired')
+API_KEY_REJECTED_LOCALLY = Counter('gateway_api_key_rejected_locally_total', 'Invalid API keys rejected without asking the management API', ['reason'])
+RATE_LIMIT_DEGRADED_DECISIONS = Counter('gateway_rate_limit_degraded_decisions_total', 'Rate limit decisions made without Redis', ['mode'])
+API_KEY_STALE_SERVED = Counter('gateway_api_key_stale_served_total', 'Expired API keys served from the L1 cache because the management API was unavailable')
+# Gauges name how worker values combine when several gateway processes are scraped as one (see serve.py)
+API_KEY_CACHE_SIZE = Gauge('gateway_api_key_cache_entries', 'Entries currently held in the in-process L1 API key cache', multiprocess_mode='livesum')
 
 @app.on_event("startup")
 async def startup_event():
-    global redis_client, http_client
-    redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-    http_client = AsyncClient(base_url=MANAGEMENT_API_URL)
+    global redis_client, redis_binary_client, redis_pubsub_client, management_client, rate_limiter, token_leaser, usage_buffer, upstream_clients, upstream_pools, response_cache, key_update_listener_task, key_filter_task, policy_reload_task
+    redis_timeouts = {"socket_timeout": REDIS_SOCKET_TIMEOUT, "socket_connect_timeout": REDIS_CONNECT_TIMEOUT}
+    redis_client = redis.from_url(REDIS_URL, decode_responses=True, **redis_timeouts)
+    redis_binary_client = redis.from_url(REDIS_URL, **redis_timeouts)
+    redis_pubsub_client = redis.from_url(REDIS_URL, decode_responses=True, socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+    management_client = ManagementApiClient(
+        MANAGEMENT_API_URL,
+        timeout=httpx.Timeout(MANAGEMENT_API_TIMEOUT, connect=MANAGEMENT_API_CONNECT_TIMEOUT),
+        breaker=CircuitBreaker(
+            "management_api",
+            failure_threshold=MANAGEMENT_API_BREAKER_FAILURE_THRESHOLD,
+            recovery_timeout=MANAGEMENT_API_BREAKER_RECOVERY_TIMEOUT,
+        ),
+        hedge_delay=MANAGEMENT_API_HEDGE_DELAY or None,
+    )
+    rate_limiter = RateLimiter(redis_client)
+    token_leaser = TokenLeaser(
+        rate_limiter,
+        lease_seconds=RATE_LIMIT_LEASE_SECONDS,
+        max_tokens=RATE_LIMIT_LEASE_MAX_TOKENS,
+        max_share=RATE_LIMIT_LEASE_MAX_SHARE,
+        max_keys=RATE_LIMIT_LEASE_MAX_KEYS,
+    )
+    token_leaser.start()
+    usage_buffer = UsageEventBuffer(
+        redis_client,
+        USAGE_STREAM_KEY,
+        batch_size=USAGE_BUFFER_BATCH_SIZE,
+        flush_interval=USAGE_BUFFER_FLUSH_INTERVAL,
+        capacity=USAGE_BUFFER_CAPACITY,
+        maxlen=USAGE_STREAM_MAXLEN,
+        retention_seconds=USAGE_STREAM_RETENTION_SECONDS,
+        partitions=USAGE_STREAM_PARTITIONS,
+    )
+    usage_buffer.start()
+    upstream_clients = UpstreamClients(
+        connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+        read_timeout=UPSTREAM_READ_TIMEOUT,
+        write_timeout=UPSTREAM_WRITE_TIMEOUT,
+        pool_timeout=UPSTREAM_POOL_TIMEOUT,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        http2=UPSTREAM_HTTP2,
+    )
+    upstream_pools = UpstreamPools(
+        upstream_clients,
+        interval=UPSTREAM_HEALTH_CHECK_INTERVAL,
+        timeout=UPSTREAM_HEALTH_CHECK_TIMEOUT,
+        healthy_threshold=UPSTREAM_HEALTHY_THRESHOLD,
+        unhealthy_threshold=UPSTREAM_UNHEALTHY_THRESHOLD,
+        redis_client=redis_client,
+        failure_threshold=UPSTREAM_EJECTION_FAILURES,
+        ejection_seconds=UPSTREAM_EJECTION_SECONDS,
+        slow_factor=UPSTREAM_SLOW_FACTOR,
+        slow_min_latency=UPSTREAM_SLOW_MIN_LATENCY,
+    )
+    upstream_pools.start()
+    if RESPONSE_CACHE_ENABLED:
+        response_cache = ResponseCache(
+            max_bytes=RESPONSE_CACHE_MAX_BYTES,
+            max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES,
+            redis_client=redis_binary_client if RESPONSE_CACHE_REDIS_ENABLED else None,
+        )
+    key_update_listener_task = asyncio.create_task(listen_for_key_updates())
+    if API_KEY_FILTER_ENABLED:
+        key_filter_task = asyncio.create_task(reload_periodically(load_key_filter, API_KEY_FILTER_RELOAD_INTERVAL, "API key filter"))
+    policy_reload_task = asyncio.create_task(reload_periodically(load_policy_table, POLICY_RELOAD_INTERVAL, "plan policy table"))
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    key_update_listener_task.cancel()
+    if key_filter_task is not None:
+        key_filter_task.cancel()
+    policy_reload_task.cancel()
+    await usage_buffer.close() # Drain buffered usage events before the Redis connection goes away
+    await token_leaser.close() # Give unused leased tokens back to the shared buckets
+    await upstream_pools.close()
     await redis_client.close()
-    await http_client.aclose()
-
-@app.middleware("http")
-async def add_prometheus_metrics_and_logging(request: Request, call_next):
-    request_id = str(uuid.uuid4())
-    request.state.request_id = request_id # Store request_id in request state
-
-    method = request.method
-    endpoint = request.url.path
-    
-    extra_log_data = {
-        "request_id": request_id,
-        "method": method,
-        "endpoint": endpoint,
-        "service": "gateway"
-    }
-
-    logger.info(f"Incoming request: {method} {endpoint}", extra=extra_log_data)
-
-    with REQUEST_LATENCY.labels(method=method, endpoint=endpoint).time():
-        response = await call_next(request)
-    
-    REQUEST_COUNT.labels(method=method, endpoint=endpoint, status_code=response.status_code).inc()
-    extra_log_data["status_code"] = response.status_code
-    logger.info(f"Outgoing response: {method} {endpoint} {response.status_code}", extra=extra_log_data)
-
-    return response
-
-async def validate_api_key(api_key_raw: str):
-    api_key_hash = hashlib.sha256(api_key_raw.encode()).hexdigest()
-    cached_key = await redis_client.get(f"{API_KEY_CACHE_PREFIX}{api_key_hash}")
+    await redis_binary_client.close()
+    await redis_pubsub_client.close()
+    await management_client.aclose()
+    await upstream_clients.aclose()
+
+background_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    # The event loop only keeps weak references to tasks, so hold fire-and-forget ones here
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def listen_for_key_updates():
+    # Apply key revocations, key creations and plan changes as soon as management-api announces them
+    while True:
+        pubsub = redis_pubsub_client.pubsub()
+        try:
+            await pubsub.subscribe(API_KEY_REVOCATION_CHANNEL, API_KEY_FILTER_UPDATES_CHANNEL, PLAN_UPDATES_CHANNEL)
+            # Messages published while we were not subscribed are lost, so start from a clean cache,
+            # a fresh copy of the key filter and a fresh policy table
+            api_key_cache.clear()
+            API_KEY_CACHE_SIZE.set(0)
+            if API_KEY_FILTER_ENABLED:
+                await load_key_filter()
+            await reload_policy_table()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                if message["channel"] == PLAN_UPDATES_CHANNEL:
+                    spawn(reload_policy_table())
+                    continue
+                key_hash = message["data"]
+                if message["channel"] == API_KEY_FILTER_UPDATES_CHANNEL:
+                    if key_filter is not None:
+                        key_filter.add(key_hash)
+                    invalid_key_cache.invalidate(key_hash)
+                    continue
+                invalid_key_cache.set(key_hash, {})
+                if api_key_cache.invalidate(key_hash):
+                    API_KEY_CACHE_EVICTIONS.labels(reason="revoked").inc()
+                    API_KEY_CACHE_SIZE.set(len(api_key_cache))
+        except asyncio.CancelledError:
+            await pubsub.close()
+            raise
+        except Exception as e:
+            logger.error(f"API key update listener failed, resubscribing: {e}", exc_info=True)
+            await pubsub.close()
+            await asyncio.sleep(1)
+
+async def load_key_filter():
+    global key_filter
+    bitmap = await redis_binary_client.get(API_KEY_FILTER_KEY)
+    loaded = KeyFilter.from_bitmap(bitmap)
+    if loaded is None:
+        logger.warning("API key filter not available in Redis; validating every unknown key")
+    key_filter = loaded
+
+async def load_policy_table():
+    global policy_table
+    response = await management_client.get("/validate/plan-policies", "plan_policies")
+    response.raise_for_status()
+    # Build the new table completely, then swap the reference in one step
+    policy_table = build_policy_table(response.json(), DEFAULT_POLICY)
+
+async def reload_policy_table():
+    try:
+        await load_policy_table()
+        logger.info(f"Reloaded plan policy table with {len(policy_table)} plans")
+    except Exception as e:
+        logger.error(f"Failed to reload plan policy table: {e}", exc_info=True)
 
-    if cached_key:
-        key_data = json.loads(cached_key)
-        if key_data.get("status") == "active":
-            return key_data
+async def reload_periodically(load, interval: int, name: str):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Keep using the copy we have until the next attempt
+            logger.error(f"Failed to reload {name}: {e}", exc_info=True)
+
+def cache_key_locally(api_key_hash: str, key_data: dict, source_ttl_seconds: float):
+    evicted = api_key_cache.set(api_key_hash, key_data, source_ttl_seconds)
+    if evicted:
+        API_KEY_CACHE_EVICTIONS.labels(reason="capacity").inc(evicted)
+    API_KEY_CACHE_SIZE.set(len(api_key_cache))
+
+def reject_invalid_key():
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API Key")
+
+def serve_stale_api_key(api_key_hash: str, reason: str) -> dict:
+    # The management API cannot answer; fall back to the last-known-good copy of the key
+    entry = api_key_cache.get_stale(api_key_hash)
+    if entry is None:
+        logger.error(f"API key validation unavailable: {reason}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="API key validation temporarily unavailable",
+            headers={"Retry-After": str(math.ceil(MANAGEMENT_API_BREAKER_RECOVERY_TIMEOUT))},
+        )
+    API_KEY_STALE_SERVED.inc()
+    return entry.key_data
+
+async def remember_invalid_key(api_key_hash: str):
+    invalid_key_cache.set(api_key_hash, {})
+    try:
+        await redis_client.setex(f"{API_KEY_INVALID_PREFIX}{api_key_hash}", API_KEY_NEGATIVE_CACHE_TTL, "invalid")
+    except REDIS_FAILURES as e:
+        logger.warning(f"Could not share negative cache entry in Redis: {e}")
 
-    # If not in cache or not active, validate with management API
+async def fetch_api_key(api_key_raw: str, api_key_hash: str):
+    global validation_latency_ewma
     try:
-        response = await http_client.get(f"/validate/validate-api-key/{api_key_raw}")
+        start = time.perf_counter()
+        response = await management_client.get(f"/validate/validate-api-key/{api_key_raw}", "validate_api_key", hedge=True)
+        validation_latency_ewma += 0.2 * (time.perf_counter() - start - validation_latency_ewma)
+        if response.status_code >= 500:
+            return serve_stale_api_key(api_key_hash, f"management API returned {response.status_code}")
+        if response.status_code in (status.HTTP_401_UNAUTHORIZED, status.HTTP_404_NOT_FOUND):
+            # Unknown or revoked: cache the rejection so repeats never reach Postgres
+            await remember_invalid_key(api_key_hash)
+            reject_invalid_key()
         response.raise_for_status() # Raise an exception for bad status codes
         key_data = response.json()
         
         if key_data.get("status") == "active":
-            await redis_client.setex(f"{API_KEY_CACHE_PREFIX}{api_key_hash}", API_KEY_CACHE_EXPIRATION, json.dumps(key_data))
+            try:
+                await redis_client.setex(f"{API_KEY_CACHE_PREFIX}{api_key_hash}", API_KEY_CACHE_EXPIRATION, json.dumps(key_data))
+            except REDIS_FAILURES as e:
+                # The key is valid; only other gateway processes miss out on the shared copy
+                logger.warning(f"Could not cache API key in Redis: {e}")
+            cache_key_locally(api_key_hash, key_data, API_KEY_CACHE_EXPIRATION)
             return key_data
         else:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API Key")
+            await remember_invalid_key(api_key_hash)
+            reject_invalid_key()
+    except HTTPException:
+        raise
+    except (CircuitOpenError, httpx.TransportError) as e:
+        return serve_stale_api_key(api_key_hash, str(e) or type(e).__name__)
     except Exception as e:
         logger.error(f"API Key validation failed: {e}", exc_info=True, extra={"request_id": getattr(app.state, 'request_id', None)})
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"API Key validation failed: {e}")
 
-async def apply_rate_limit(api_key_hash: str, limit: int):
-    current_time = int(time.time())
-    key = f"rate_limit:{api_key_hash}"
-    
-    await redis_client.zremrangebyscore(key, 0, current_time - RATE_LIMIT_WINDOW_SECONDS)
-    await redis_client.zadd(key, {current_time: current_time})
-    request_count = await redis_client.zcard(key)
-    await redis_client.expire(key, RATE_LIMIT_WINDOW_SECONDS + 5) # A bit longer than the window
-
-    if request_count > limit:
-        logger.warning(f"Rate limit exceeded for {api_key_hash}", extra={"request_id": getattr(app.state, 'request_id', None), "api_key_hash": api_key_hash, "limit": limit, "current_count": request_count})
-        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Rate limit exceeded")
-    
-    return limit - request_count
+async def load_api_key(api_key_raw: str, api_key_hash: str):
+    # The positive entry, its TTL (which drives early refresh of hot keys) and the
+    # negative entry are all read in one round trip
+    async def read_cached_key():
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(f"{API_KEY_CACHE_PREFIX}{api_key_hash}")
+            pipe.pttl(f"{API_KEY_CACHE_PREFIX}{api_key_hash}")
+            pipe.exists(f"{API_KEY_INVALID_PREFIX}{api_key_hash}")
+            return await pipe.execute()
 
-@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"])
-async def proxy(request: Request, path: str):
-    api_key_raw = request.headers.get("X-API-Key")
-    if not api_key_raw:
-        logger.warning("X-API-Key header missing", extra={"request_id": getattr(request.state, 'request_id', None)})
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="X-API-Key header missing")
+    try:
+        cached_key, ttl_ms, known_invalid = await redis_breaker.call(read_cached_key, REDIS_FAILURES)
+    except (CircuitOpenError, *REDIS_FAILURES) as e:
+        # Without the shared cache the management API remains the source of truth
+        logger.warning(f"Redis unavailable for API key lookup, asking the management API: {e}")
+        return await fetch_api_key(api_key_raw, api_key_hash)
 
-    validated_key = await validate_api_key(api_key_raw)
+    if known_invalid:
+        invalid_key_cache.set(api_key_hash, {})
+        API_KEY_REJECTED_LOCALLY.labels(reason="negative_cache").inc()
+        reject_invalid_key()
+
+    if cached_key:
+        key_data = json.loads(cached_key)
+        if key_data.get("status") == "active":
+            cache_key_locally(api_key_hash, key_data, max(ttl_ms, 0) / 1000)
+            return key_data
+
+    # If not in cache or not active, validate with management API
+    return await fetch_api_key(api_key_raw, api_key_hash)
+
+def refresh_api_key_early(api_key_raw: str, api_key_hash: str):
+    if key_lookups.in_flight(api_key_hash) or management_client.breaker.is_open:
+        return
+    API_KEY_EARLY_REFRESHES.inc()
+    # Shares the single flight with any request that misses while the refresh runs;
+    # failures are already logged by fetch_api_key and the current entry stays valid
+    spawn(key_lookups.do(api_key_hash, lambda: fetch_api_key(api_key_raw, api_key_hash)))
+
+async def validate_api_key(api_key_raw: str):
     api_key_hash = hashlib.sha256(api_key_raw.encode()).hexdigest()
 
-    # Determine rate limit from plan, or use default
-    rate_limit = DEFAULT_RATE_LIMIT_REQUESTS
-    if validated_key.get("plan") and validated_key["plan"].get("unit_type") == "request" and validated_key["plan"].get("unit_price_cents") is not None:
-        rate_limit = 1000 # Example: higher limit for metered plans
-    elif validated_key.get("plan") and validated_key["plan"].get("name") == "Free Tier": # Example for a free tier
-        rate_limit = 10 # Example: lower limit for free tier
-    
-    # Apply rate limiting
-    remaining_requests = await apply_rate_limit(api_key_hash, rate_limit)
-
-    # Quota Enforcement
-    quota_limit = validated_key.get("plan", {}).get("quota_limit")
-    current_quota_usage = 0
-
-    if quota_limit is not None:
-        # Fetch current usage from management-api
-        today = date.today()
-        start_of_month = date(today.year, today.month, 1)
-        
+    entry = api_key_cache.get(api_key_hash)
+    if entry is not None:
+        API_KEY_CACHE_HITS.inc()
+        delta = max(validation_latency_ewma, API_KEY_EARLY_REFRESH_MIN_DELTA)
+        if should_refresh_early(entry, delta, API_KEY_EARLY_REFRESH_BETA):
+            refresh_api_key_early(api_key_raw, api_key_hash)
+        return entry.key_data
+    API_KEY_CACHE_MISSES.inc()
+
+    if invalid_key_cache.get(api_key_hash) is not None:
+        API_KEY_REJECTED_LOCALLY.labels(reason="negative_cache").inc()
+        reject_invalid_key()
+    if key_filter is not None and not key_filter.might_contain(api_key_hash):
+        API_KEY_REJECTED_LOCALLY.labels(reason="key_filter").inc()
+        reject_invalid_key()
+
+    # Concurrent misses for the same key share one Redis lookup and at most one management API call
+    if key_lookups.in_flight(api_key_hash):
+        API_KEY_LOOKUPS_COALESCED.inc()
+    return await key_lookups.do(api_key_hash, lambda: load_api_key(api_key_raw, api_key_hash))
+
+def resolve_policy(validated_key: dict) -> PlanPolicy:
+    plan = validated_key.get("plan")
+    if not plan:
+        return DEFAULT_POLICY
+    policy = policy_table.get(plan.get("id"))
+    if policy is None:
+        # Plan created since the table was last loaded; its cached key data carries the same settings
+        policy = policy_from_plan(plan, DEFAULT_POLICY)
+    return policy
+
+async def apply_rate_limit(api_key_hash: str, policy: PlanPolicy, validated_key: dict) -> RateLimitResult:
+    # The monthly quota counter is checked and incremented in the same script as the rate limit
+    quota_kwargs = {}
+    if policy.quota_limit is not None:
+        quota_kwargs = {
+            "quota_key": quota_key(validated_key.get("api_id"), validated_key.get("client_id")),
+            "quota_limit": policy.quota_limit,
+            "quota_expire_at": quota_expire_at(),
+        }
+    if policy.algorithm == LEASED_TOKEN_BUCKET:
+        decide = lambda: token_leaser.hit(api_key_hash, policy.rate_limit, policy.window_seconds, policy.burst, **quota_kwargs)
+    else:
+        decide = lambda: rate_limiter.hit(api_key_hash, policy.rate_limit, policy.window_seconds, policy.algorithm, policy.burst, **quota_kwargs)
+    try:
+        result = await redis_breaker.call(decide, REDIS_FAILURES)
+    except (CircuitOpenError, *REDIS_FAILURES) as e:
+        result = degraded_rate_limit(api_key_hash, policy, quota_kwargs, e)
+    else:
+        if len(quota_backlog) and not quota_resync.in_flight("quota"):
+            spawn(quota_resync.do("quota", resync_quota_backlog))
+
+    if result.quota_exceeded:
+        logger.warning(f"Quota limit exceeded for {api_key_hash}", extra={"request_id": getattr(app.state, 'request_id', None), "api_key_hash": api_key_hash, "quota_limit": policy.quota_limit, "current_usage": result.quota_used})
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Quota limit exceeded",
+            headers={"X-Quota-Limit": str(policy.quota_limit), "X-Quota-Used": str(result.quota_used)},
+        )
+
+    if not result.allowed:
+        logger.warning(f"Rate limit exceeded for {api_key_hash}", extra={"request_id": getattr(app.state, 'request_id', None), "api_key_hash": api_key_hash, "limit": policy.rate_limit, "algorithm": policy.algorithm})
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={
+                "X-RateLimit-Limit": str(result.limit),
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset": str(result.reset_after_seconds),
+                "Retry-After": str(result.reset_after_seconds),
+            },
+        )
+
+    return result
+
+def degraded_rate_limit(api_key_hash: str, policy: PlanPolicy, quota_kwargs: dict, error: Exception) -> RateLimitResult:
+    if policy.failure_mode == FAIL_CLOSED:
+        RATE_LIMIT_DEGRADED_DECISIONS.labels(mode=FAIL_CLOSED).inc()
+        logger.warning(f"Rejecting request for {api_key_hash}, Redis is unavailable and the plan fails closed: {error}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Rate limiting temporarily unavailable",
+            headers={"Retry-After": str(math.ceil(redis_breaker.recovery_timeout))},
+        )
+
+    RATE_LIMIT_DEGRADED_DECISIONS.labels(mode=FAIL_OPEN).inc()
+    result = local_rate_limiter.hit(api_key_hash, policy.rate_limit, policy.window_seconds, policy.burst)
+    # The quota cannot be checked without the shared counter, so the usage of admitted
+    # requests is only recorded here and added to the counter once Redis is back
+    if quota_kwargs and result.allowed:
+        quota_backlog.add(quota_kwargs["quota_key"], quota_kwargs["quota_expire_at"])
+    return result
+
+async def resync_quota_backlog():
+    pending = quota_backlog.drain()
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, (count, expire_at) in pending.items():
+                pipe.incrby(key, count)
+                pipe.expireat(key, expire_at)
+            await pipe.execute()
+    except REDIS_FAILURES as e:
+        quota_backlog.restore(pending)
+        logger.warning(f"Could not add degraded-mode usage to {len(pending)} quota counters, will retry: {e}")
+        return
+    # Redis is authoritative again; the local buckets would be stale at the next outage
+    local_rate_limiter.clear()
+    logger.info(f"Added degraded-mode usage to {len(pending)} quota counters")
+
+async def admit_request(validated_key: dict, policy: PlanPolicy):
+    """Takes a load shedding slot and the API's and client's bulkhead slots.
+
+    Returns the function that gives them back, or raises 503 with Retry-After.
+    """
+    api_key = str(validated_key.get("api_id"))
+    client_key = str(validated_key.get("client_id"))
+    released = []
+    try:
+        load_shedder.admit(policy.priority)
+        released.append(load_shedder.release)
+        if CLIENT_MAX_CONCURRENCY:
+            await client_bulkheads.acquire(client_key, policy.priority)
+            released.append(lambda: client_bulkheads.release(client_key))
+        if API_MAX_CONCURRENCY:
+            await api_bulkheads.acquire(api_key, policy.priority)
+            released.append(lambda: api_bulkheads.release(api_key))
+    except BaseException as e:
+        for release in reversed(released):
+            release()
+        if not isinstance(e, Rejected):
+            raise
+        REQUESTS_SHED.labels(reason=e.reason, priority=str(policy.priority)).inc()
+        logger.warning(f"Shed request for API {api_key}, client {client_key} ({e.reason})")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Gateway overloaded, retry later",
+            headers={"Retry-After": str(LOAD_SHED_RETRY_AFTER)},
+        )
+
+    def release_all():
+        for release in reversed(released):
+            release()
+    return release_all
+
+class ReleasingResponse(Response):
+    """Sends `response` unchanged and then runs `release`.
+
+    Streamed responses keep their slots until the body has been sent. Unlike a
+    background task, `release` also runs when the client disconnects mid-body.
+    """
+
+    def __init__(self, response: Response, release):
+        self.response = response
+        self.release = release
+        self.status_code = response.status_code
+        self.background = None
+
+    async def __call__(self, scope, receive, send):
         try:
-            analytics_response = await http_client.get(
-                f"/apis/{validated_key.get('api_id')}/usage",
-                params={
-                    "start_date": start_of_month.isoformat(),
-                    "end_date": today.isoformat(),
-                    "client_id": validated_key.get("client_id") # Now filtering by client_id
-                }
-            )
-            analytics_response.raise_for_status()
-            usage_data = analytics_response.json()
-            
-            # Sum up total_requests for the current client
-            current_quota_usage = sum(entry.get("total_requests", 0) for entry in usage_data)
-
-            if current_quota_usage >= quota_limit:
-                logger.warning(f"Quota limit exceeded for {api_key_raw[:5]}...", extra={"request_id": getattr(request.state, 'request_id', None), "api_key_hash": api_key_hash, "quota_limit": quota_limit, "current_usage": current_quota_usage})
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Quota limit exceeded")
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
 
-        except Exception as e:
-            logger.error(f"Error fetching usage for quota enforcement: {e}", exc_info=True, extra={"request_id": getattr(request.state, 'request_id', None)})
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes its body iterator however sending ends.
+
+    Starlette leaves the iterator suspended when sending fails or is cancelled,
+    so cleanup in the iterator's `finally` would otherwise wait for garbage
+    collection.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
 
-    usage_event = {
+def record_usage(validated_key: dict, path: str, request_bytes: int, response_bytes: int):
+    usage_buffer.add({
         "api_id": validated_key.get("api_id"),
         "client_id": validated_key.get("client_id"),
         "endpoint": f"/{path}",
         "units": 1, # For now, 1 unit per request
-        "bytes": len(await request.body()), # Approximate bytes transferred
+        "request_bytes": request_bytes, # Ingress body bytes
+        "response_bytes": response_bytes, # Egress body bytes
+        "bytes": request_bytes + response_bytes, # Total transferred, billed by MB plans
         "timestamp": time.time() # Unix timestamp
-    }
-    await redis_client.xadd(USAGE_STREAM_KEY, usage_event)
+    })
+
+async def send_to_upstream(request: Request, path: str, validated_key: dict, extra_headers=()) -> Tuple[httpx.Response, MeteredStream]:
+    # The API's backend targets, or its base URL when it has none
+    urls = validated_key.get("api_upstream_targets") or [url for url in [validated_key.get("api_base_url")] if url]
+    if not urls:
+        logger.error(f"No upstream configured for API {validated_key.get('api_id')}", extra={"request_id": getattr(request.state, 'request_id', None)})
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Upstream not configured for this API")
+    pool = upstream_pools.get(
+        validated_key.get("api_id"),
+        urls,
+        validated_key.get("api_load_balancing") or UPSTREAM_LOAD_BALANCING,
+        validated_key.get("api_health_check_path") or UPSTREAM_HEALTH_CHECK_PATH,
+    )
+
+    declared_length = request.headers.get("content-length")
+    if declared_length is not None:
+        try:
+            declared_length = int(declared_length)
+        except ValueError:
+            declared_length = -1
+        if declared_length < 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Content-Length header")
+    if MAX_REQUEST_BODY_BYTES and declared_length and declared_length > MAX_REQUEST_BODY_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Request body too large")
+
+    # Bodies are streamed chunk by chunk in both directions and never held in full;
+    # bytes are counted as they pass so the usage event carries exact figures
+    request_body = MeteredStream(request.stream(), MAX_REQUEST_BODY_BYTES)
+    content = request_body if has_request_body(request) else None
+    # A request without a body that could not connect is tried once more on another target
+    attempts = 2 if content is None and len(pool) > 1 else 1
+
+    target = None
+    for attempt in range(attempts):
+        target = pool.pick(exclude=target)
+        client = upstream_clients.get(target.url)
+        upstream_request = client.build_request(
+            request.method,
+            "/" + path,
+            params=request.url.query,
+            headers=forwarded_request_headers(request) + list(extra_headers),
+            content=content,
+        )
+
+        pool.started(target)
+        start_time = time.perf_counter()
+        try:
+            upstream_response = await client.send(upstream_request, stream=True)
+        except BodyTooLarge:
+            pool.finished(target, time.perf_counter() - start_time, failed=False)
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Request body too large")
+        except httpx.ConnectError as e:
+            pool.finished(target, time.perf_counter() - start_time, failed=True)
+            if attempt + 1 < attempts:
+                logger.warning(f"Could not connect to upstream target {target.url}, trying another: {e}", extra={"request_id": getattr(request.state, 'request_id', None)})
+                continue
+            logger.error(f"Upstream request failed: {e}", extra={"request_id": getattr(request.state, 'request_id', None)})
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Upstream request failed")
+        except httpx.TimeoutException as e:
+            pool.finished(target, time.perf_counter() - start_time, failed=True)
+            logger.error(f"Upstream timed out: {e}", extra={"request_id": getattr(request.state, 'request_id', None)})
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Upstream timed out")
+        except httpx.HTTPError as e:
+            pool.finished(target, time.perf_counter() - start_time, failed=True)
+            logger.error(f"Upstream request failed: {e}", extra={"request_id": getattr(request.state, 'request_id', None)})
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Upstream request failed")
+        except BaseException:
+            pool.abandoned(target)
+            raise
+        pool.finished(target, time.perf_counter() - start_time, failed=upstream_response.status_code >= 500)
+        return upstream_response, request_body
+
+def stream_upstream_response(
+    upstream_response: httpx.Response,
+    request_body: MeteredStream,
+    validated_key: dict,
+    path: str,
+    cache_entry_key: Optional[str] = None,
+    cache_ttl: Optional[int] = None,
+) -> StreamingResponse:
+    response_body = MeteredStream(upstream_response.aiter_raw(), MAX_RESPONSE_BODY_BYTES)
+    headers = forwarded_response_headers(upstream_response)
+    # A copy of the body is kept for the response cache while it streams, within the entry size cap
+    capture = BodyCapture(response_body, RESPONSE_CACHE_MAX_ENTRY_BYTES) if cache_entry_key else None
+
+    async def body():
+        sent = 0
+        try:
+            async for chunk in capture or response_body:
+                yield chunk
+                sent += len(chunk) # Resumed only once the chunk has been sent
+        finally:
+            # However the body ends (sent in full, upstream failure or timeout, over the
+            # size cap, client gone) the request is billed and the connection released
+            await upstream_response.aclose()
+            record_usage(validated_key, path, request_body.bytes, sent)
+
+    async def store_in_cache():
+        # Runs only once the whole body has been sent
+        if capture.body() is not None:
+            entry = entry_from_response(upstream_response, headers, capture.body(), cache_ttl, RESPONSE_CACHE_STALE_SECONDS)
+            await response_cache.set(cache_entry_key, entry)
+
+    response = ClosingStreamingResponse(
+        body(),
+        status_code=upstream_response.status_code,
+        background=BackgroundTask(store_in_cache) if capture is not None else None,
+    )
+    response.raw_headers = list(headers) # Copied: the proxy appends its own headers to this list
+    return response
 
-    response = Response(content=json.dumps({"message": f"Request proxied for path: /{path}", "api_key_used": api_key_raw, "validated_key_info": validated_key}), media_type="application/json")
-    response.headers["X-RateLimit-Limit"] = str(rate_limit)
-    response.headers["X-RateLimit-Remaining"] = str(remaining_requests)
-    response.headers["X-RateLimit-Reset"] = str(RATE_LIMIT_WINDOW_SECONDS) # Time until reset
-    if quota_limit is not None:
-        response.headers["X-Quota-Limit"] = str(quota_limit)
-        response.headers["X-Quota-Used"] = str(current_quota_usage + 1) # +1 for the current request
+async def forward_to_upstream(request: Request, path: str, validated_key: dict) -> StreamingResponse:
+    upstream_response, request_body = await send_to_upstream(request, path, validated_key)
+    return stream_upstream_response(upstream_response, request_body, validated_key, path)
+
+def response_cache_applies(request: Request, validated_key: dict) -> bool:
+    return (
+        response_cache is not None
+        and bool(validated_key.get("api_response_cache_enabled"))
+        and request.method in CACHEABLE_METHODS
+        and not has_request_body(request)
+    )
+
+def serve_cached_response(entry: CachedResponse, request: Request, validated_key: dict, path: str, outcome: str) -> Response:
+    RESPONSE_CACHE_LOOKUPS.labels(result=outcome).inc()
+    if_none_match = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if entry.etag is not None and (entry.etag in if_none_match or "*" in if_none_match):
+        response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+        response.raw_headers = [(b"etag", entry.etag.encode("latin-1"))]
+        body_bytes = 0
+    else:
+        response = Response(content=entry.body, status_code=entry.status_code)
+        response.raw_headers = [(k, v) for k, v in entry.headers if k != b"content-length"]
+        response.raw_headers.append((b"content-length", str(len(entry.body)).encode()))
+        body_bytes = len(entry.body)
+    response.headers["Age"] = str(entry.age())
+    response.headers["X-Cache"] = "HIT"
+    # Served without the upstream, but still billed as a request
+    record_usage(validated_key, path, 0, body_bytes)
+    return response
 
+async def serve_with_response_cache(request: Request, path: str, validated_key: dict) -> Response:
+    vary_headers = vary_headers_for(validated_key.get("api_response_cache_vary_headers"))
+    key = cache_key(validated_key.get("api_id"), path, request.url.query, request.headers, vary_headers)
+    request_directives = parse_cache_control(request.headers.get("cache-control", ""))
+    entry = await response_cache.get(key)
+    if entry is not None and entry.is_fresh() and "no-cache" not in request_directives:
+        return serve_cached_response(entry, request, validated_key, path, "hit")
+
+    # A stale copy with an ETag is revalidated rather than fetched again
+    extra_headers = []
+    if entry is not None and entry.etag and "if-none-match" not in request.headers:
+        extra_headers.append(("if-none-match", entry.etag))
+    upstream_response, request_body = await send_to_upstream(request, path, validated_key, extra_headers)
+    max_ttl = validated_key.get("api_response_cache_max_ttl_seconds")
+    has_authorization = "authorization" in request.headers
+
+    if extra_headers and upstream_response.status_code == status.HTTP_304_NOT_MODIFIED:
+        await upstream_response.aclose()
+        # A 304 may leave out Cache-Control, in which case the stored one still applies
+        headers = upstream_response.headers if "cache-control" in upstream_response.headers else httpx.Headers(entry.headers)
+        ttl = freshness_lifetime(headers, vary_headers, has_authorization, max_ttl)
+        if ttl is not None:
+            entry = revalidated(entry, ttl, RESPONSE_CACHE_STALE_SECONDS)
+            await response_cache.set(key, entry)
+        return serve_cached_response(entry, request, validated_key, path, "revalidated")
+
+    RESPONSE_CACHE_LOOKUPS.labels(result="stale" if entry is not None else "miss").inc()
+    ttl = freshness_lifetime(upstream_response.headers, vary_headers, has_authorization, max_ttl)
+    storable = ttl is not None and upstream_response.status_code in CACHEABLE_STATUS_CODES and "no-store" not in request_directives
+    response = stream_upstream_response(upstream_response, request_body, validated_key, path, key if storable else None, ttl)
+    response.headers["X-Cache"] = "MISS"
     return response
 
+# Registered before the catch-all proxy route, which would otherwise shadow it
 @app.get("/metrics", response_class=PlainTextResponse)
-async def metrics():
+def metrics():
+    # With several workers (serve.py), any one of them answers for all by reading their metric files
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return PlainTextResponse(generate_latest(registry))
     return PlainTextResponse(generate_latest())
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"])
+async def proxy(request: Request, path: str):
+    api_key_raw = request.headers.get("X-API-Key")
+    if not api_key_raw:
+        logger.warning("X-API-Key header missing", extra={"request_id": getattr(request.state, 'request_id', None)})
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="X-API-Key header missing")
+
+    validated_key = await validate_api_key(api_key_raw)
+    api_key_hash = hashlib.sha256(api_key_raw.encode()).hexdigest()
+    request.state.metrics_api_id = str(validated_key.get("api_id", ""))
+    request.state.metrics_endpoint = normalize_path(path)
+
+    # Limits come from the compiled plan policy table
+    policy = resolve_policy(validated_key)
+
+    # Load shedding and bulkheads come first, so a shed request costs no Redis round
+    # trip and none of the client's rate limit or quota. The slots are held until
+    # the response has been sent.
+    release = await admit_request(validated_key, policy)
+    try:
+        # Rate limiting and quota enforcement take one Redis round trip
+        rate_limit_result = await apply_rate_limit(api_key_hash, policy, validated_key)
+        # Cache hits are served after rate limiting, so they count against limits and are metered
+        if response_cache_applies(request, validated_key):
+            response = await serve_with_response_cache(request, path, validated_key)
+        else:
+            response = await forward_to_upstream(request, path, validated_key)
+    except BaseException:
+        release()
+        raise
+    response.headers["X-RateLimit-Limit"] = str(rate_limit_result.limit)
+    response.headers["X-RateLimit-Remaining"] = str(rate_limit_result.remaining)
+    response.headers["X-RateLimit-Reset"] = str(rate_limit_result.reset_after_seconds) # Seconds until capacity is given back
+    if policy.quota_limit is not None:
+        response.headers["X-Quota-Limit"] = str(policy.quota_limit)
+        response.headers["X-Quota-Used"] = str(rate_limit_result.quota_used) # Includes the current request
+
+    return ReleasingResponse(response, release)
@@ -0,0 +1,89 @@
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+from prometheus_client import Counter, Histogram
+
+from circuit_breaker import CircuitBreaker
+
+MANAGEMENT_API_LATENCY = Histogram(
+    'gateway_management_api_request_duration_seconds',
+    'Latency of gateway calls to the management API, including hedges',
+    ['operation', 'outcome'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+MANAGEMENT_API_HEDGES = Counter('gateway_management_api_hedged_requests_total', 'Hedged duplicate requests sent to the management API', ['operation'])
+
+
+class ManagementApiClient:
+    """HTTP client for the management API with tight timeouts and a circuit breaker.
+
+    Transport errors, timeouts and 5xx responses count as failures; any other
+    response means the management API is healthy. With `hedge_delay` set, a GET
+    that has not answered within that many seconds is sent a second time and the
+    first response to arrive wins, which cuts tail latency when one management API
+    replica stalls.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: httpx.Timeout,
+        breaker: CircuitBreaker,
+        hedge_delay: Optional[float] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None, # Lets benchmarks answer in-process
+    ):
+        self.breaker = breaker
+        self.hedge_delay = hedge_delay
+        self._client = httpx.AsyncClient(base_url=base_url, timeout=timeout, transport=transport)
+
+    async def get(self, url: str, operation: str, hedge: bool = False) -> httpx.Response:
+        self.breaker.before_call()
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            if hedge and self.hedge_delay:
+                response = await self._hedged_get(url, operation)
+            else:
+                response = await self._client.get(url)
+            outcome = "server_error" if response.status_code >= 500 else "ok"
+        except (httpx.HTTPError, asyncio.TimeoutError):
+            self.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            # The caller went away; that says nothing about the management API
+            self.breaker.release()
+            raise
+        finally:
+            MANAGEMENT_API_LATENCY.labels(operation=operation, outcome=outcome).observe(time.perf_counter() - start)
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def _hedged_get(self, url: str, operation: str) -> httpx.Response:
+        tasks = {asyncio.create_task(self._client.get(url))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                MANAGEMENT_API_HEDGES.labels(operation=operation).inc()
+                tasks.add(asyncio.create_task(self._client.get(url)))
+
+            # The first successful response wins; fail only when every attempt failed
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self):
+        await self._client.aclose()
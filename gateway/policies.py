@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+from rate_limiter import ALGORITHMS
+
+# Published by management-api whenever a plan is created or updated
+PLAN_UPDATES_CHANNEL = "plan_updates"
+
+# What a plan's keys get while Redis is unreachable
+FAIL_OPEN = "open" # Approximate limits enforced by each gateway process on its own
+FAIL_CLOSED = "closed" # Requests are rejected until Redis is back
+FAILURE_MODES = (FAIL_OPEN, FAIL_CLOSED)
+
+# Load shedding priority of plans that do not set one: paid plans outrank free ones
+FREE_PLAN_PRIORITY = 0
+PAID_PLAN_PRIORITY = 1
+
+
+@dataclass(frozen=True)
+class PlanPolicy:
+    rate_limit: int # requests per window
+    window_seconds: int
+    burst: Optional[int] # token bucket / GCRA capacity; defaults to rate_limit
+    algorithm: str
+    quota_limit: Optional[int] # requests per calendar month
+    failure_mode: str = FAIL_OPEN
+    priority: int = 0 # load shedding order; higher is shed later
+
+
+class PolicyTable:
+    """Immutable plan_id -> PlanPolicy lookup used on every proxied request.
+
+    A reload builds a new table and swaps the reference, so readers never see a
+    partially updated table and need no locking.
+    """
+
+    def __init__(self, policies: Mapping[int, PlanPolicy], default: PlanPolicy):
+        self._policies = MappingProxyType(dict(policies))
+        self.default = default
+
+    def __len__(self):
+        return len(self._policies)
+
+    def get(self, plan_id: Optional[int]) -> Optional[PlanPolicy]:
+        return self._policies.get(plan_id)
+
+
+def default_priority(plan: Dict[str, Any]) -> int:
+    return PAID_PLAN_PRIORITY if plan.get("price_cents") or plan.get("unit_price_cents") else FREE_PLAN_PRIORITY
+
+
+def policy_from_plan(plan: Dict[str, Any], default: PlanPolicy) -> PlanPolicy:
+    algorithm = plan.get("rate_limit_algorithm")
+    failure_mode = plan.get("rate_limit_failure_mode")
+    priority = plan.get("priority")
+    return PlanPolicy(
+        rate_limit=plan.get("rate_limit_requests") or default.rate_limit,
+        window_seconds=plan.get("rate_limit_window_seconds") or default.window_seconds,
+        burst=plan.get("rate_limit_burst"),
+        algorithm=algorithm if algorithm in ALGORITHMS else default.algorithm,
+        quota_limit=plan.get("quota_limit"),
+        failure_mode=failure_mode if failure_mode in FAILURE_MODES else default.failure_mode,
+        priority=priority if priority is not None else default_priority(plan),
+    )
+
+
+def build_policy_table(plans: Iterable[Dict[str, Any]], default: PlanPolicy) -> PolicyTable:
+    return PolicyTable({plan["id"]: policy_from_plan(plan, default) for plan in plans}, default)
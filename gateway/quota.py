@@ -0,0 +1,22 @@
+from datetime import datetime, timezone
+
+# Monthly per-(api_id, client_id) request counters. The billing worker reconciles
+# these against usage_aggregates, so keep the key format in sync with it.
+QUOTA_KEY_PREFIX = "quota:"
+QUOTA_KEY_GRACE_SECONDS = 7 * 24 * 3600 # Keep last month's counter around for reconciliation
+
+def quota_period(now: datetime = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime("%Y%m")
+
+def quota_key(api_id, client_id, now: datetime = None) -> str:
+    # The period is part of the key, so a new month starts from an empty counter
+    return f"{QUOTA_KEY_PREFIX}{api_id}:{client_id}:{quota_period(now)}"
+
+def quota_expire_at(now: datetime = None) -> int:
+    now = now or datetime.now(timezone.utc)
+    if now.month == 12:
+        next_month = datetime(now.year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        next_month = datetime(now.year, now.month + 1, 1, tzinfo=timezone.utc)
+    return int(next_month.timestamp()) + QUOTA_KEY_GRACE_SECONDS
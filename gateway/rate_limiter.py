@@ -0,0 +1,310 @@
+import math
+import uuid
+from typing import NamedTuple, Optional
+
+import redis.asyncio as redis
+
+SLIDING_WINDOW_LOG = "sliding_window_log"
+SLIDING_WINDOW_COUNTER = "sliding_window_counter"
+TOKEN_BUCKET = "token_bucket"
+GCRA = "gcra"
+LEASED_TOKEN_BUCKET = "leased_token_bucket" # Token bucket spent from per-process leases, see token_lease.py
+
+ALGORITHMS = (SLIDING_WINDOW_LOG, SLIDING_WINDOW_COUNTER, TOKEN_BUCKET, GCRA, LEASED_TOKEN_BUCKET)
+
+# Every script takes the decision against the Redis server clock, so all gateway
+# instances share one time source, and returns {allowed, remaining, reset_ms, quota_used}.
+# reset_ms is the time until the next request would be admitted when denied, and
+# the time until the oldest consumed capacity is given back when allowed.
+#
+# KEYS[2] is an optional monthly quota counter checked and incremented in the same
+# script, with ARGV[1] = quota limit and ARGV[2] = unix time the counter expires.
+# allowed is -1 when the quota, rather than the rate limit, rejected the request.
+# Algorithm arguments start at ARGV[3].
+_PRELUDE = """
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local quota_key = KEYS[2]
+local quota_used = 0
+if quota_key then
+    quota_used = tonumber(redis.call('GET', quota_key) or '0')
+    if quota_used >= tonumber(ARGV[1]) then
+        return {-1, 0, 0, quota_used}
+    end
+end
+
+local function consume_quota()
+    if quota_key then
+        quota_used = redis.call('INCR', quota_key)
+        redis.call('EXPIREAT', quota_key, ARGV[2])
+    end
+end
+"""
+
+# KEYS[1] = sorted set of admitted requests; ARGV = limit, window_ms, unique member
+SLIDING_WINDOW_LOG_SCRIPT = _PRELUDE + """
+local key = KEYS[1]
+local limit = tonumber(ARGV[3])
+local window_ms = tonumber(ARGV[4])
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now_ms - window_ms)
+local count = redis.call('ZCARD', key)
+local allowed = 0
+if count < limit then
+    redis.call('ZADD', key, now_ms, ARGV[5])
+    redis.call('PEXPIRE', key, window_ms)
+    count = count + 1
+    allowed = 1
+    consume_quota()
+end
+
+local reset_ms = window_ms
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset_ms = tonumber(oldest[2]) + window_ms - now_ms
+end
+return {allowed, limit - count, reset_ms, quota_used}
+"""
+
+# KEYS[1] = hash of per-window counters keyed by window index; ARGV = limit, window_ms
+SLIDING_WINDOW_COUNTER_SCRIPT = _PRELUDE + """
+local key = KEYS[1]
+local limit = tonumber(ARGV[3])
+local window_ms = tonumber(ARGV[4])
+
+local window = math.floor(now_ms / window_ms)
+local elapsed = now_ms - window * window_ms
+local current = tonumber(redis.call('HGET', key, tostring(window)) or '0')
+local previous = tonumber(redis.call('HGET', key, tostring(window - 1)) or '0')
+local weight = (window_ms - elapsed) / window_ms
+local estimate = previous * weight + current
+
+local allowed = 0
+if estimate + 1 <= limit then
+    current = redis.call('HINCRBY', key, tostring(window), 1)
+    estimate = estimate + 1
+    allowed = 1
+    consume_quota()
+end
+for _, field in ipairs(redis.call('HKEYS', key)) do
+    if tonumber(field) < window - 1 then
+        redis.call('HDEL', key, field)
+    end
+end
+redis.call('PEXPIRE', key, window_ms * 2)
+
+local reset_ms = window_ms - elapsed
+if allowed == 0 and current + 1 <= limit and previous > 0 then
+    -- The previous window's weight decays linearly; wait until enough of it is gone
+    reset_ms = math.ceil((estimate + 1 - limit) / previous * window_ms)
+end
+return {allowed, math.max(0, math.floor(limit - estimate)), reset_ms, quota_used}
+"""
+
+# KEYS[1] = hash {tokens, ts}; ARGV = capacity, refill_per_ms (as string)
+TOKEN_BUCKET_SCRIPT = _PRELUDE + """
+local key = KEYS[1]
+local capacity = tonumber(ARGV[3])
+local rate = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now_ms
+tokens = math.min(capacity, tokens + math.max(0, now_ms - ts) * rate)
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+    consume_quota()
+end
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now_ms)
+redis.call('PEXPIRE', key, math.ceil(capacity / rate))
+
+local reset_ms
+if allowed == 1 then
+    reset_ms = math.ceil((capacity - tokens) / rate)
+else
+    reset_ms = math.ceil((1 - tokens) / rate)
+end
+return {allowed, math.floor(tokens), reset_ms, quota_used}
+"""
+
+# KEYS[1] = theoretical arrival time (us); ARGV = emission_interval_us (as string), capacity
+# Works in microseconds: at high rates the interval is a fraction of a millisecond,
+# which a millisecond timestamp of this magnitude cannot accumulate.
+GCRA_SCRIPT = _PRELUDE + """
+local key = KEYS[1]
+local interval = tonumber(ARGV[3])
+local capacity = tonumber(ARGV[4])
+local tolerance = interval * capacity
+local now_us = tonumber(t[1]) * 1000000 + tonumber(t[2])
+
+local tat = math.max(tonumber(redis.call('GET', key) or '0'), now_us)
+local new_tat = tat + interval
+local allow_at = new_tat - tolerance
+
+if now_us < allow_at then
+    return {0, 0, math.ceil((allow_at - now_us) / 1000), quota_used}
+end
+local ahead_ms = math.max(1, math.ceil((new_tat - now_us) / 1000))
+redis.call('SET', key, string.format('%.17g', new_tat), 'PX', ahead_ms)
+consume_quota()
+return {1, math.floor((tolerance - (new_tat - now_us)) / interval), ahead_ms, quota_used}
+"""
+
+# Takes up to `requested` tokens from a token bucket at once, after adding back
+# `returned` unused tokens of an earlier lease. Returns {granted, remaining, reset_ms,
+# quota_used}, granted being -1 when the quota is used up. Leased tokens are charged
+# to the quota when granted and refunded when returned (ARGV[7], which is 0 when the
+# earlier lease was charged to another quota period).
+# KEYS[1] = hash {tokens, ts}; ARGV = quota limit, quota expire_at, capacity,
+# refill_per_ms (as string), requested, returned, quota_returned
+LEASE_SCRIPT = """
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local key = KEYS[1]
+local capacity = tonumber(ARGV[3])
+local rate = tonumber(ARGV[4])
+local requested = tonumber(ARGV[5])
+
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now_ms
+tokens = math.min(capacity, tokens + math.max(0, now_ms - ts) * rate + tonumber(ARGV[6]))
+local granted = math.min(requested, math.floor(tokens))
+
+local quota_key = KEYS[2]
+local quota_used = 0
+local quota_exceeded = false
+if quota_key then
+    quota_used = redis.call('DECRBY', quota_key, ARGV[7])
+    local quota_left = math.max(0, tonumber(ARGV[1]) - quota_used)
+    quota_exceeded = requested > 0 and quota_left == 0
+    granted = math.min(granted, quota_left)
+    quota_used = redis.call('INCRBY', quota_key, granted)
+    redis.call('EXPIREAT', quota_key, ARGV[2])
+end
+
+tokens = tokens - granted
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now_ms)
+redis.call('PEXPIRE', key, math.ceil(capacity / rate))
+
+local reset_ms
+if granted > 0 then
+    reset_ms = math.ceil((capacity - tokens) / rate)
+else
+    reset_ms = math.ceil((1 - tokens) / rate)
+end
+if quota_exceeded then
+    granted = -1
+end
+return {granted, math.floor(tokens), reset_ms, quota_used}
+"""
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: float # seconds
+    quota_exceeded: bool = False
+    quota_used: int = 0
+
+    @property
+    def reset_after_seconds(self) -> int:
+        return max(1, math.ceil(self.reset_after))
+
+
+class LeaseGrant(NamedTuple):
+    granted: int
+    remaining: int # tokens left in the shared bucket
+    reset_after: float # seconds
+    quota_exceeded: bool = False
+    quota_used: int = 0
+
+
+class RateLimiter:
+    """Rate limiter that takes each decision in one atomic Redis round trip.
+
+    The algorithm is chosen per call, so plans can opt into different strategies.
+    `burst` is the capacity of the token bucket and GCRA algorithms and defaults
+    to `limit`; the windowed algorithms ignore it. When `quota_key` is given the
+    monthly quota counter is checked and incremented in the same script, so quota
+    enforcement costs no extra round trip.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str = "rate_limit:"):
+        self.key_prefix = key_prefix
+        self._scripts = {
+            SLIDING_WINDOW_LOG: redis_client.register_script(SLIDING_WINDOW_LOG_SCRIPT),
+            SLIDING_WINDOW_COUNTER: redis_client.register_script(SLIDING_WINDOW_COUNTER_SCRIPT),
+            TOKEN_BUCKET: redis_client.register_script(TOKEN_BUCKET_SCRIPT),
+            GCRA: redis_client.register_script(GCRA_SCRIPT),
+        }
+        self._lease_script = redis_client.register_script(LEASE_SCRIPT)
+
+    def _args(self, algorithm: str, limit: int, window_seconds: int, burst: int):
+        window_ms = window_seconds * 1000
+        if algorithm == SLIDING_WINDOW_LOG:
+            return [limit, window_ms, uuid.uuid4().hex]
+        if algorithm == SLIDING_WINDOW_COUNTER:
+            return [limit, window_ms]
+        if algorithm == TOKEN_BUCKET:
+            return [burst, repr(limit / window_ms)]
+        return [repr(window_ms * 1000 / limit), burst]
+
+    async def hit(
+        self,
+        identifier: str,
+        limit: int,
+        window_seconds: int,
+        algorithm: str = SLIDING_WINDOW_LOG,
+        burst: Optional[int] = None,
+        quota_key: Optional[str] = None,
+        quota_limit: Optional[int] = None,
+        quota_expire_at: int = 0,
+    ) -> RateLimitResult:
+        if algorithm not in self._scripts:
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+        burst = burst or limit
+
+        # Each algorithm keeps a different Redis type, so they never share a key
+        keys = [f"{self.key_prefix}{algorithm}:{identifier}"]
+        if quota_key is not None and quota_limit is not None:
+            keys.append(quota_key)
+        args = [quota_limit or 0, quota_expire_at] + self._args(algorithm, limit, window_seconds, burst)
+
+        allowed, remaining, reset_ms, quota_used = await self._scripts[algorithm](keys=keys, args=args)
+        capacity = burst if algorithm in (TOKEN_BUCKET, GCRA) else limit
+        return RateLimitResult(allowed == 1, capacity, max(0, int(remaining)), int(reset_ms) / 1000, allowed == -1, int(quota_used))
+
+    async def lease(
+        self,
+        identifier: str,
+        limit: int,
+        window_seconds: int,
+        burst: Optional[int] = None,
+        requested: int = 1,
+        returned: int = 0,
+        quota_key: Optional[str] = None,
+        quota_limit: Optional[int] = None,
+        quota_expire_at: int = 0,
+        quota_returned: int = 0,
+    ) -> LeaseGrant:
+        """Takes up to `requested` tokens from the key's bucket in one round trip.
+
+        `returned` unused tokens of the previous lease are put back first; a call
+        with `requested=0` only returns tokens.
+        """
+        burst = burst or limit
+        keys = [f"{self.key_prefix}{LEASED_TOKEN_BUCKET}:{identifier}"]
+        if quota_key is not None and quota_limit is not None:
+            keys.append(quota_key)
+        args = [
+            quota_limit or 0, quota_expire_at, burst, repr(limit / (window_seconds * 1000)),
+            requested, returned, quota_returned,
+        ]
+        granted, remaining, reset_ms, quota_used = await self._lease_script(keys=keys, args=args)
+        return LeaseGrant(max(0, int(granted)), max(0, int(remaining)), int(reset_ms) / 1000, granted == -1, int(quota_used))
@@ -0,0 +1,135 @@
+import logging
+import os
+import re
+import time
+import uuid
+from typing import Hashable, Optional, Set
+
+from prometheus_client import Counter, Histogram
+
+from logging_config import request_log_sampler
+
+logger = logging.getLogger(__name__)
+
+METRICS_MAX_ENDPOINTS = int(os.getenv("METRICS_MAX_ENDPOINTS", "500")) # Distinct endpoint label values before overflow
+METRICS_MAX_PATH_SEGMENTS = int(os.getenv("METRICS_MAX_PATH_SEGMENTS", "4")) # Deeper proxied paths are truncated
+
+UNMATCHED_ENDPOINT = "__unmatched__" # No route matched (404s, scanners)
+OVERFLOW_ENDPOINT = "__overflow__" # Endpoint label budget exhausted
+
+# Path segments that identify a resource rather than a route
+_ID_SEGMENT = re.compile(
+    r"^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-fA-F]{12,}|(?=.*\d)[\w.~-]{16,})$"
+)
+
+
+def normalize_path(path: str, max_segments: int = METRICS_MAX_PATH_SEGMENTS) -> str:
+    """Collapses a proxied path into a low-cardinality pattern.
+
+    IDs, UUIDs, hashes and long tokens become `{id}` and anything deeper than
+    `max_segments` becomes `...`, so `/users/42/orders/9f8e...` is reported as
+    `/users/{id}/orders/{id}`.
+    """
+    segments = [segment for segment in path.split("/") if segment]
+    pattern = ["{id}" if _ID_SEGMENT.match(segment) else segment for segment in segments[:max_segments]]
+    if len(segments) > max_segments:
+        pattern.append("...")
+    return "/" + "/".join(pattern)
+
+
+class LabelBudget:
+    """Admits at most `max_values` distinct label combinations.
+
+    Combinations seen before stay admitted; new ones beyond the budget are
+    reported under an overflow label so the number of series stays bounded.
+    """
+
+    def __init__(self, max_values: int):
+        self.max_values = max_values
+        self._seen: Set[Hashable] = set()
+
+    def admit(self, value: Hashable) -> bool:
+        if value in self._seen:
+            return True
+        if len(self._seen) >= self.max_values:
+            return False
+        self._seen.add(value)
+        return True
+
+
+class RequestMetricsMiddleware:
+    """Pure ASGI middleware that assigns request IDs, records metrics and logs requests.
+
+    The endpoint label is the matched route template (`/apis/{api_id}`) rather than
+    the raw URL. A handler can report a finer label by setting
+    `request.state.metrics_endpoint`, and `request.state.metrics_api_id` when
+    `per_api` is enabled; the gateway does this for proxied traffic. Endpoint
+    labels are capped by `max_endpoints`.
+    """
+
+    def __init__(
+        self,
+        app,
+        request_count: Counter,
+        request_latency: Histogram,
+        per_api: bool = False,
+        max_endpoints: int = METRICS_MAX_ENDPOINTS,
+    ):
+        self.app = app
+        self.request_count = request_count
+        self.request_latency = request_latency
+        self.per_api = per_api
+        self.endpoint_budget = LabelBudget(max_endpoints)
+
+    def _labels(self, scope, state: dict) -> dict:
+        endpoint = state.get("metrics_endpoint")
+        if endpoint is None:
+            endpoint = getattr(scope.get("route"), "path", UNMATCHED_ENDPOINT)
+        api_id = (state.get("metrics_api_id") or "") if self.per_api else None
+        if not self.endpoint_budget.admit((api_id, endpoint)):
+            endpoint = OVERFLOW_ENDPOINT
+        labels = {"method": scope["method"], "endpoint": endpoint}
+        if self.per_api:
+            labels["api_id"] = api_id
+        return labels
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = str(uuid.uuid4())
+        # Starlette's request.state is a view over this dict
+        state = scope.setdefault("state", {})
+        state["request_id"] = request_id
+        status_code: Optional[int] = None
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Includes streaming the body, not just producing the headers
+            duration = time.perf_counter() - start
+            status_code = status_code or 500 # The app raised before starting a response
+            labels = self._labels(scope, state)
+            self.request_latency.labels(**labels).observe(duration)
+            self.request_count.labels(status_code=status_code, **labels).inc()
+
+            if request_log_sampler.should_log(labels["endpoint"], status_code, duration):
+                method, path = scope["method"], scope["path"]
+                logger.info(
+                    f"Request completed: {method} {path} {status_code}",
+                    extra={
+                        "request_id": request_id,
+                        "method": method,
+                        "endpoint": path,
+                        "status_code": status_code,
+                        "duration_ms": round(duration * 1000, 2),
+                    },
+                )
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import httpx
+import redis.asyncio as redis
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_KEY_PREFIX = "response_cache:"
+
+CACHEABLE_METHODS = {"GET"}
+# Heuristically cacheable status codes (RFC 9110 section 15.1) the gateway is willing to store
+CACHEABLE_STATUS_CODES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+# Request headers that are always part of the cache key: the body is passed on
+# exactly as the upstream encoded it
+DEFAULT_VARY_HEADERS = ("accept-encoding",)
+
+# Never replayed from the cache; Age is recomputed on every hit
+UNCACHED_RESPONSE_HEADERS = {b"age", b"set-cookie"}
+
+RESPONSE_CACHE_LOOKUPS = Counter('gateway_response_cache_lookups_total', 'Response cache lookups by outcome', ['result'])
+RESPONSE_CACHE_BYTES = Gauge('gateway_response_cache_bytes', 'Bytes of response bodies held in the in-process response cache', multiprocess_mode='livesum')
+
+
+class CachedResponse(NamedTuple):
+    status_code: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: Optional[str]
+    stored_at: float # unix time the upstream produced or last revalidated the response
+    expires_at: float # unix time the response stops being fresh
+    keep_until: float # unix time a stale copy is dropped; kept this long for ETag revalidation
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.expires_at
+
+    def age(self, now: Optional[float] = None) -> int:
+        return max(0, int((now or time.time()) - self.stored_at))
+
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in value.split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def freshness_lifetime(
+    response_headers: httpx.Headers,
+    vary_headers: Iterable[str],
+    request_has_authorization: bool = False,
+    max_ttl_seconds: Optional[int] = None,
+) -> Optional[int]:
+    """Seconds a shared cache may serve this response, or None if it must not be stored.
+
+    Only explicit `s-maxage`/`max-age` freshness is honored; responses without
+    one are never cached. `no-cache` responses are stored with a lifetime of 0 so
+    they are revalidated on every use, which only pays off when they carry an ETag.
+    """
+    directives = parse_cache_control(response_headers.get("cache-control", ""))
+    if "no-store" in directives or "private" in directives or "set-cookie" in response_headers:
+        return None
+    # Requests with credentials are only shared when the upstream says so (RFC 9111 section 3.5)
+    if request_has_authorization and not ("public" in directives or "s-maxage" in directives):
+        return None
+
+    # The key only varies on configured headers, so the upstream may not vary on anything else
+    vary = {h.strip().lower() for h in response_headers.get("vary", "").split(",") if h.strip()}
+    if "*" in vary or not vary <= set(vary_headers):
+        return None
+
+    if "no-cache" in directives:
+        return 0 if "etag" in response_headers else None
+    lifetime = directives.get("s-maxage") or directives.get("max-age")
+    try:
+        ttl = int(lifetime)
+    except (TypeError, ValueError):
+        return None
+    if max_ttl_seconds:
+        ttl = min(ttl, max_ttl_seconds)
+    return max(0, ttl)
+
+
+def cache_key(api_id, path: str, query: str, request_headers, vary_headers: Iterable[str]) -> str:
+    varied = [f"{name}={request_headers.get(name, '')}" for name in sorted(vary_headers)]
+    material = "\n".join([str(api_id), "/" + path, query, *varied])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def vary_headers_for(configured: Optional[str]) -> Tuple[str, ...]:
+    extra = [h.strip().lower() for h in (configured or "").split(",") if h.strip()]
+    return tuple(sorted(set(DEFAULT_VARY_HEADERS) | set(extra)))
+
+
+def entry_from_response(
+    response: httpx.Response,
+    headers: List[Tuple[bytes, bytes]],
+    body: bytes,
+    ttl: int,
+    stale_seconds: int,
+) -> CachedResponse:
+    now = time.time()
+    headers = [(k, v) for k, v in headers if k not in UNCACHED_RESPONSE_HEADERS]
+    etag = response.headers.get("etag")
+    # Stale copies are only worth keeping when they can be revalidated
+    keep_until = now + ttl + (stale_seconds if etag else 0)
+    return CachedResponse(response.status_code, headers, body, etag, now, now + ttl, keep_until)
+
+
+def revalidated(entry: CachedResponse, ttl: int, stale_seconds: int) -> CachedResponse:
+    now = time.time()
+    return entry._replace(stored_at=now, expires_at=now + ttl, keep_until=now + ttl + stale_seconds)
+
+
+def _encode(entry: CachedResponse) -> bytes:
+    meta = {
+        "status_code": entry.status_code,
+        "headers": [[k.decode("latin-1"), v.decode("latin-1")] for k, v in entry.headers],
+        "etag": entry.etag,
+        "stored_at": entry.stored_at,
+        "expires_at": entry.expires_at,
+        "keep_until": entry.keep_until,
+    }
+    return json.dumps(meta).encode() + b"\n" + entry.body
+
+
+def _decode(value: bytes) -> CachedResponse:
+    meta, _, body = value.partition(b"\n")
+    meta = json.loads(meta)
+    headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in meta["headers"]]
+    return CachedResponse(meta["status_code"], headers, body, meta["etag"], meta["stored_at"], meta["expires_at"], meta["keep_until"])
+
+
+class ResponseCache:
+    """Two-tier cache of upstream responses.
+
+    The in-process tier is an LRU bounded by `max_bytes` of stored responses. When
+    a Redis client is given, entries are also written to Redis so gateway
+    instances share them; a Redis hit is promoted to the local tier. Redis errors
+    degrade to a cache miss rather than failing the request.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_entry_bytes: int,
+        redis_client: Optional[redis.Redis] = None,
+        key_prefix: str = RESPONSE_CACHE_KEY_PREFIX,
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now < entry.keep_until:
+                self._entries.move_to_end(key)
+                return entry
+            self._discard(key)
+
+        if self.redis_client is None:
+            return None
+        try:
+            value = await self.redis_client.get(f"{self.key_prefix}{key}")
+        except redis.RedisError as e:
+            logger.warning(f"Response cache read from Redis failed: {e}")
+            return None
+        if value is None:
+            return None
+        entry = _decode(value)
+        if now >= entry.keep_until:
+            return None
+        self._store_locally(key, entry)
+        return entry
+
+    async def set(self, key: str, entry: CachedResponse):
+        if entry.size() > self.max_entry_bytes:
+            return
+        self._store_locally(key, entry)
+        if self.redis_client is None:
+            return
+        ttl_ms = int((entry.keep_until - time.time()) * 1000)
+        if ttl_ms <= 0:
+            return
+        try:
+            await self.redis_client.set(f"{self.key_prefix}{key}", _encode(entry), px=ttl_ms)
+        except redis.RedisError as e:
+            logger.warning(f"Response cache write to Redis failed: {e}")
+
+    def _store_locally(self, key: str, entry: CachedResponse):
+        self._discard(key)
+        self._entries[key] = entry
+        self._bytes += entry.size()
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+        RESPONSE_CACHE_BYTES.set(self._bytes)
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size()
+            RESPONSE_CACHE_BYTES.set(self._bytes)
+
+
+class BodyCapture:
+    """Async iterable that keeps a copy of the chunks passing through it.
+
+    Chunks are yielded unchanged. Capturing stops once more than `max_bytes` have
+    gone through, and `body()` is None unless the stream completed within the cap.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], max_bytes: int):
+        self.chunks = chunks
+        self.max_bytes = max_bytes
+        self._parts: List[bytes] = []
+        self._size = 0
+        self._overflowed = False
+        self._complete = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.chunks:
+            if not self._overflowed:
+                self._size += len(chunk)
+                if self._size > self.max_bytes:
+                    self._overflowed = True
+                    self._parts.clear()
+                else:
+                    self._parts.append(chunk)
+            yield chunk
+        self._complete = True
+
+    def body(self) -> Optional[bytes]:
+        if not self._complete or self._overflowed:
+            return None
+        return b"".join(self._parts)
@@ -0,0 +1,107 @@
+"""Runs the gateway as one or more shared-nothing worker processes.
+
+Every worker imports `main` on its own, so each has its own L1 caches, Redis
+connections and upstream connection pools, and binds its own listening socket
+with SO_REUSEPORT so the kernel spreads incoming connections across workers.
+With more than one worker, Prometheus metrics are written to
+PROMETHEUS_MULTIPROC_DIR and `/metrics` aggregates all of them in one scrape.
+"""
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import time
+
+HOST = os.getenv("GATEWAY_HOST", "0.0.0.0")
+PORT = int(os.getenv("GATEWAY_PORT", "8001"))
+GATEWAY_WORKERS = int(os.getenv("GATEWAY_WORKERS", "1")) # 0 starts one worker per CPU core
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "/tmp/gateway-metrics")
+WORKER_RESTART_DELAY = 1.0 # seconds before a crashed worker is replaced
+
+
+def bind_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(host: str, port: int, reuse_port: bool = True):
+    import uvicorn
+
+    config = uvicorn.Config("main:app", host=host, port=port)
+    server = uvicorn.Server(config)
+    server.run(sockets=[bind_socket(host, port, reuse_port)])
+
+
+def prepare_metrics_dir(path: str):
+    # Files left by a previous run would be aggregated with this one's
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+
+def supervise(workers: int):
+    from prometheus_client import multiprocess
+
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    stopping = False
+
+    def start(slot: int):
+        process = context.Process(target=run_worker, args=(HOST, PORT), name=f"gateway-worker-{slot}")
+        process.start()
+        processes[slot] = process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(workers):
+        start(slot)
+    print(f"Started {workers} gateway workers on {HOST}:{PORT}", file=sys.stderr)
+
+    while not stopping:
+        for slot, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            # Drop the live gauges of the dead worker so they no longer count towards totals
+            multiprocess.mark_process_dead(process.pid)
+            if stopping:
+                break
+            print(f"Gateway worker {process.pid} exited with {process.exitcode}; restarting", file=sys.stderr)
+            time.sleep(WORKER_RESTART_DELAY)
+            start(slot)
+        time.sleep(0.5)
+
+    for process in processes.values():
+        process.join()
+        multiprocess.mark_process_dead(process.pid)
+
+
+def main():
+    workers = GATEWAY_WORKERS or os.cpu_count() or 1
+    # Each worker enforces its share of every rate limit when Redis is unavailable
+    os.environ["GATEWAY_WORKER_COUNT"] = str(workers)
+    if workers == 1:
+        # A single worker needs neither a supervisor nor multiprocess metrics
+        run_worker(HOST, PORT, reuse_port=False)
+        return
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("GATEWAY_WORKERS > 1 needs SO_REUSEPORT, which this platform does not support")
+    prepare_metrics_dir(PROMETHEUS_MULTIPROC_DIR)
+    supervise(workers)
+
+
+if __name__ == "__main__":
+    main()
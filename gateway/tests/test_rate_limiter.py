@@ -0,0 +1,171 @@
+"""Concurrency accuracy of the rate limit algorithms.
+
+Each test fires a burst of concurrent hits at one key and checks that exactly
+`limit` of them are admitted and that the remaining and reset values reported
+to clients agree with the state the script left in Redis. They run against
+fakeredis, or against a real Redis when TEST_REDIS_URL is set; keys get a
+prefix of their own, so a shared Redis is not disturbed.
+
+    cd gateway
+    pip install -r requirements.txt -r tests/requirements.txt
+    python -m pytest tests
+    TEST_REDIS_URL=redis://localhost:6379/15 python -m pytest tests
+"""
+import asyncio
+import math
+import os
+import uuid
+
+import pytest
+import redis.asyncio as redis
+
+from rate_limiter import (
+    GCRA, LEASED_TOKEN_BUCKET, SLIDING_WINDOW_COUNTER, SLIDING_WINDOW_LOG, TOKEN_BUCKET, RateLimiter,
+)
+from token_lease import TokenLeaser
+
+LIMIT = 10
+WINDOW_SECONDS = 3600 # Long enough that nothing refills noticeably during a test
+HITS = 50
+IDENTIFIER = "api:1:client:1"
+
+
+async def make_redis() -> redis.Redis:
+    url = os.getenv("TEST_REDIS_URL")
+    if url:
+        return redis.from_url(url, decode_responses=True)
+    import fakeredis
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+async def redis_now_ms(r: redis.Redis) -> float:
+    seconds, microseconds = await r.time()
+    return seconds * 1000 + microseconds / 1000
+
+
+async def burst(algorithm: str):
+    """Fires HITS concurrent hits at one key; returns the results, the Redis client and the key."""
+    r = await make_redis()
+    prefix = f"test:{uuid.uuid4().hex}:"
+    limiter = RateLimiter(r, key_prefix=prefix)
+    results = await asyncio.gather(*(
+        limiter.hit(IDENTIFIER, LIMIT, WINDOW_SECONDS, algorithm=algorithm) for _ in range(HITS)
+    ))
+    return results, r, f"{prefix}{algorithm}:{IDENTIFIER}"
+
+
+def assert_admitted_exactly_limit(results):
+    admitted = [result for result in results if result.allowed]
+    assert len(admitted) == LIMIT
+    # The script runs atomically, so every admitted hit saw one fewer slot left than the one before
+    assert sorted(result.remaining for result in admitted) == list(range(LIMIT))
+    for result in results:
+        assert result.limit == LIMIT
+        assert not result.quota_exceeded
+        if not result.allowed:
+            assert result.remaining == 0
+
+
+def test_sliding_window_log():
+    async def run():
+        results, r, key = await burst(SLIDING_WINDOW_LOG)
+        assert_admitted_exactly_limit(results)
+
+        assert await r.zcard(key) == LIMIT
+        (_, oldest), = await r.zrange(key, 0, 0, withscores=True)
+        # Capacity comes back when the oldest admitted request leaves the window
+        expected = (oldest + WINDOW_SECONDS * 1000 - await redis_now_ms(r)) / 1000
+        for result in results:
+            assert result.reset_after == pytest.approx(expected, abs=1)
+            assert result.reset_after <= WINDOW_SECONDS
+
+    asyncio.run(run())
+
+
+def test_sliding_window_counter():
+    async def run():
+        results, r, key = await burst(SLIDING_WINDOW_COUNTER)
+        assert_admitted_exactly_limit(results)
+
+        now_ms = await redis_now_ms(r)
+        window_ms = WINDOW_SECONDS * 1000
+        window = math.floor(now_ms / window_ms)
+        counters = await r.hgetall(key)
+        # The burst may straddle a window boundary; the two windows together hold every admitted hit
+        assert int(counters.get(str(window), 0)) + int(counters.get(str(window - 1), 0)) == LIMIT
+        assert set(counters) <= {str(window), str(window - 1)}
+        expected = (window_ms - (now_ms - window * window_ms)) / 1000
+        for result in results:
+            if not result.allowed and str(window - 1) not in counters:
+                assert result.reset_after == pytest.approx(expected, abs=1)
+            assert 0 < result.reset_after <= WINDOW_SECONDS
+
+    asyncio.run(run())
+
+
+def test_token_bucket():
+    async def run():
+        results, r, key = await burst(TOKEN_BUCKET)
+        assert_admitted_exactly_limit(results)
+
+        rate = LIMIT / WINDOW_SECONDS # tokens per second
+        state = await r.hgetall(key)
+        tokens = float(state["tokens"])
+        assert 0 <= tokens < 1
+        for result in results:
+            if result.allowed:
+                # Time until the bucket is full again
+                assert result.reset_after == pytest.approx((LIMIT - result.remaining) / rate, abs=1)
+            else:
+                # Time until the next whole token
+                assert result.reset_after == pytest.approx((1 - tokens) / rate, abs=1)
+
+    asyncio.run(run())
+
+
+def test_gcra():
+    async def run():
+        results, r, key = await burst(GCRA)
+        assert_admitted_exactly_limit(results)
+
+        interval_us = WINDOW_SECONDS * 1_000_000 / LIMIT
+        tat_us = float(await r.get(key))
+        now_us = await redis_now_ms(r) * 1000
+        # Every admitted hit moved the theoretical arrival time one interval further
+        assert tat_us - now_us == pytest.approx(LIMIT * interval_us, abs=1_000_000)
+        allow_at_us = tat_us + interval_us - LIMIT * interval_us
+        for result in results:
+            if result.allowed:
+                assert result.reset_after == pytest.approx((LIMIT - result.remaining) * interval_us / 1_000_000, abs=1)
+            else:
+                assert result.reset_after == pytest.approx((allow_at_us - now_us) / 1_000_000, abs=1)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_leased_token_bucket(processes):
+    async def run():
+        r = await make_redis()
+        prefix = f"test:{uuid.uuid4().hex}:"
+        limiter = RateLimiter(r, key_prefix=prefix)
+        # Each leaser stands in for one gateway process sharing the bucket
+        leasers = [TokenLeaser(limiter, lease_seconds=1.0) for _ in range(processes)]
+        results = await asyncio.gather(*(
+            leaser.hit(IDENTIFIER, LIMIT, WINDOW_SECONDS) for leaser in leasers for _ in range(HITS)
+        ))
+        assert_admitted_exactly_limit(results)
+
+        rate = LIMIT / WINDOW_SECONDS
+        for result in results:
+            if not result.allowed:
+                # Denied locally until the shared bucket has a whole token again
+                assert result.reset_after == pytest.approx(1 / rate, abs=1)
+
+        for leaser in leasers:
+            await leaser.close()
+        state = await r.hgetall(f"{prefix}{LEASED_TOKEN_BUCKET}:{IDENTIFIER}")
+        # Everything leased was spent, so closing hands nothing back to the shared bucket
+        assert 0 <= float(state["tokens"]) < 1
+
+    asyncio.run(run())
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from prometheus_client import Counter
+
+from rate_limiter import RateLimiter, RateLimitResult
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+TOKEN_LEASE_DECISIONS = Counter('gateway_token_lease_decisions_total', 'Leased token bucket decisions by where they were taken', ['source'])
+TOKEN_LEASE_TOKENS = Counter('gateway_token_lease_tokens_total', 'Tokens moved between Redis and local leases', ['direction'])
+
+
+class _Lease:
+    __slots__ = (
+        "tokens", "expires_at", "refilled_at", "requests", "rate", "remaining", "reset_after",
+        "denied_until", "quota_exceeded", "quota_used", "quota_key", "quota_expire_at", "limit", "window_seconds", "burst",
+    )
+
+    def __init__(self, now: float):
+        self.tokens = 0
+        self.expires_at = now
+        self.refilled_at = now
+        self.requests = 0 # since the last refill
+        self.rate: Optional[float] = None # smoothed requests per second
+        self.remaining = 0 # tokens left in the shared bucket at the last refill
+        self.reset_after = 0.0
+        self.denied_until = 0.0
+        self.quota_exceeded = False
+        self.quota_used = 0
+        self.quota_key: Optional[str] = None
+        self.quota_expire_at = 0
+        self.limit = 0
+        self.window_seconds = 0
+        self.burst: Optional[int] = None
+
+
+class TokenLeaser:
+    """Token bucket rate limiting that spends leased batches of tokens locally.
+
+    A process reserves a batch of tokens for a key from the shared Redis bucket
+    and admits requests against it without further round trips until the batch
+    is spent or `lease_seconds` have passed. Unused tokens of an expired lease go
+    back to the bucket on the next refill, or from the background sweep for keys
+    that went quiet, so Redis traffic follows the number of active keys rather
+    than the number of requests.
+
+    The batch size follows each key's smoothed request rate: roughly what the key
+    uses in `lease_seconds`, at most `max_tokens` and at most `max_share` of the
+    bucket capacity so one process cannot starve the others. A refused refill is
+    remembered until the bucket refills, so a key over its limit is also rejected
+    locally. At most `max_keys` leases are kept, least recently used first out.
+    """
+
+    def __init__(
+        self,
+        rate_limiter: RateLimiter,
+        lease_seconds: float = 1.0,
+        max_tokens: int = 1000,
+        max_share: float = 1.0,
+        max_keys: int = 100000,
+        smoothing: float = 0.5,
+    ):
+        self.rate_limiter = rate_limiter
+        self.lease_seconds = lease_seconds
+        self.max_tokens = max_tokens
+        self.max_share = max_share
+        self.max_keys = max_keys
+        self.smoothing = smoothing
+        self._leases: "OrderedDict[str, _Lease]" = OrderedDict()
+        self._evicted: List[tuple] = [] # (identifier, lease) pairs whose tokens are still to be returned
+        self._refills = SingleFlight() # One refill in flight per key
+        self._task: Optional[asyncio.Task] = None
+        self._closing = asyncio.Event()
+
+    def __len__(self):
+        return len(self._leases)
+
+    def _lease_for(self, identifier: str, now: float) -> _Lease:
+        lease = self._leases.get(identifier)
+        if lease is not None:
+            self._leases.move_to_end(identifier)
+            return lease
+        lease = self._leases[identifier] = _Lease(now)
+        while len(self._leases) > self.max_keys:
+            evicted = self._leases.popitem(last=False)
+            if evicted[1].tokens:
+                self._evicted.append(evicted)
+        return lease
+
+    def _lease_size(self, lease: _Lease, capacity: int, now: float) -> int:
+        if lease.rate is None:
+            # First refill: size it for the requests already waiting on it
+            lease.rate = lease.requests / self.lease_seconds
+        else:
+            observed = lease.requests / max(now - lease.refilled_at, 0.001)
+            lease.rate = self.smoothing * observed + (1 - self.smoothing) * lease.rate
+        cap = max(1, min(self.max_tokens, math.floor(capacity * self.max_share)))
+        return max(1, min(cap, math.ceil(lease.rate * self.lease_seconds)))
+
+    async def _refill(
+        self,
+        identifier: str,
+        lease: _Lease,
+        limit: int,
+        window_seconds: int,
+        burst: Optional[int],
+        quota_key: Optional[str],
+        quota_limit: Optional[int],
+        quota_expire_at: int,
+    ):
+        now = time.monotonic()
+        requested = self._lease_size(lease, burst or limit, now)
+        # Requests arriving while the refill is in flight count towards the next lease size
+        seen = lease.requests
+        returned, lease.tokens = lease.tokens, 0
+        # Tokens of a lease taken in an earlier quota period stay charged to that period
+        quota_returned = returned if lease.quota_key == quota_key else 0
+        try:
+            grant = await self.rate_limiter.lease(
+                identifier, limit, window_seconds, burst,
+                requested=requested, returned=returned,
+                quota_key=quota_key, quota_limit=quota_limit, quota_expire_at=quota_expire_at,
+                quota_returned=quota_returned,
+            )
+        except BaseException:
+            lease.tokens += returned
+            raise
+
+        TOKEN_LEASE_TOKENS.labels(direction="leased").inc(grant.granted)
+        TOKEN_LEASE_TOKENS.labels(direction="returned").inc(returned)
+        now = time.monotonic()
+        lease.tokens = grant.granted
+        lease.expires_at = now + self.lease_seconds
+        lease.refilled_at = now
+        lease.requests -= seen
+        lease.remaining = grant.remaining
+        lease.reset_after = grant.reset_after
+        lease.quota_exceeded = grant.quota_exceeded
+        lease.quota_used = grant.quota_used
+        lease.quota_key, lease.quota_expire_at = quota_key, quota_expire_at
+        lease.limit, lease.window_seconds, lease.burst = limit, window_seconds, burst
+        if not grant.granted:
+            # An exhausted quota does not come back within a lease, so ask again only once this one would have ended
+            lease.denied_until = now + (self.lease_seconds if grant.quota_exceeded else grant.reset_after)
+
+    def _take(self, lease: _Lease, capacity: int) -> RateLimitResult:
+        lease.tokens -= 1
+        return RateLimitResult(True, capacity, lease.remaining + lease.tokens, lease.reset_after, False, lease.quota_used)
+
+    def _denied(self, lease: _Lease, capacity: int, now: float) -> RateLimitResult:
+        return RateLimitResult(False, capacity, 0, max(0.0, lease.denied_until - now), lease.quota_exceeded, lease.quota_used)
+
+    async def hit(
+        self,
+        identifier: str,
+        limit: int,
+        window_seconds: int,
+        burst: Optional[int] = None,
+        quota_key: Optional[str] = None,
+        quota_limit: Optional[int] = None,
+        quota_expire_at: int = 0,
+    ) -> RateLimitResult:
+        capacity = burst or limit
+        now = time.monotonic()
+        lease = self._lease_for(identifier, now)
+        lease.requests += 1
+
+        # Callers that find the lease spent while another refill is in flight wait for it and try again
+        for _ in range(3):
+            if now < lease.denied_until:
+                TOKEN_LEASE_DECISIONS.labels(source="local").inc()
+                return self._denied(lease, capacity, now)
+            if lease.tokens > 0 and now < lease.expires_at and lease.quota_key == quota_key:
+                TOKEN_LEASE_DECISIONS.labels(source="local").inc()
+                return self._take(lease, capacity)
+            TOKEN_LEASE_DECISIONS.labels(source="redis").inc()
+            await self._refills.do(identifier, lambda: self._refill(
+                identifier, lease, limit, window_seconds, burst, quota_key, quota_limit, quota_expire_at,
+            ))
+            now = time.monotonic()
+            if lease.tokens > 0:
+                return self._take(lease, capacity)
+            lease.requests += 1 # Still unserved, so still demand
+        lease.denied_until = max(lease.denied_until, now + lease.reset_after)
+        return self._denied(lease, capacity, now)
+
+    async def _return(self, identifier: str, lease: _Lease):
+        returned, lease.tokens = lease.tokens, 0
+        try:
+            await self.rate_limiter.lease(
+                identifier, lease.limit, lease.window_seconds, lease.burst,
+                requested=0, returned=returned,
+                quota_key=lease.quota_key, quota_limit=0 if lease.quota_key else None,
+                quota_expire_at=lease.quota_expire_at, quota_returned=returned,
+            )
+        except Exception as e:
+            # The tokens come back as the bucket refills; only this process' share is lost for a while
+            logger.warning(f"Could not return {returned} leased tokens: {e}")
+            return
+        TOKEN_LEASE_TOKENS.labels(direction="returned").inc(returned)
+
+    async def return_expired(self):
+        now = time.monotonic()
+        expired, self._evicted = self._evicted, []
+        for identifier, lease in list(self._leases.items()):
+            if now < lease.expires_at or self._refills.in_flight(identifier):
+                continue
+            if lease.tokens:
+                expired.append((identifier, lease))
+            elif not lease.requests and now >= lease.denied_until:
+                # Idle for a whole lease; forget it so the table only holds active keys
+                del self._leases[identifier]
+        if expired:
+            await asyncio.gather(*(self._return(identifier, lease) for identifier, lease in expired))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            # The flag covers a cancellation swallowed by the Redis client mid-call
+            self._closing.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Hand back everything still leased so other processes can use it right away
+        for lease in self._leases.values():
+            lease.expires_at = 0.0
+        await self.return_expired()
+
+    async def _run(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), timeout=self.lease_seconds)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.return_expired()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to return expired token leases: {e}", exc_info=True)
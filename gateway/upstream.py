@@ -0,0 +1,121 @@
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+from starlette.requests import Request
+
+# Connection-level headers that must not be forwarded by a proxy (RFC 9110 section 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Gateway credentials are never passed on to publisher backends
+STRIPPED_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | {"host", "x-api-key"}
+
+# Rewritten by the gateway rather than trusted from the client
+FORWARDED_HEADERS = {"x-forwarded-for", "x-forwarded-proto", "x-forwarded-host"}
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class UpstreamClients:
+    """One pooled `httpx.AsyncClient` per publisher base URL.
+
+    Clients keep connections alive between requests and negotiate HTTP/2 when the
+    backend supports it, so proxied requests do not pay a new TCP/TLS handshake.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float,
+        read_timeout: float,
+        write_timeout: float,
+        pool_timeout: float,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        http2: bool = True,
+        transport: Optional[httpx.AsyncBaseTransport] = None, # Lets benchmarks answer in-process
+    ):
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.transport = transport
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def get(self, base_url: str) -> httpx.AsyncClient:
+        client = self._clients.get(base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=base_url,
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=self.http2,
+                follow_redirects=False,
+                transport=self.transport,
+            )
+            self._clients[base_url] = client
+        return client
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+def has_request_body(request: Request) -> bool:
+    return "content-length" in request.headers or "transfer-encoding" in request.headers
+
+
+def forwarded_request_headers(request: Request) -> List[Tuple[str, str]]:
+    headers = [(k, v) for k, v in request.headers.items() if k not in STRIPPED_REQUEST_HEADERS and k not in FORWARDED_HEADERS]
+    client_host = request.client.host if request.client else None
+    prior = request.headers.get("x-forwarded-for")
+    if client_host:
+        headers.append(("x-forwarded-for", f"{prior}, {client_host}" if prior else client_host))
+    elif prior:
+        headers.append(("x-forwarded-for", prior))
+    headers.append(("x-forwarded-proto", request.url.scheme))
+    headers.append(("x-forwarded-host", request.headers.get("host", "")))
+    return headers
+
+
+def forwarded_response_headers(response: httpx.Response) -> List[Tuple[bytes, bytes]]:
+    # Raw pairs keep repeated headers such as Set-Cookie intact
+    return [
+        (k.lower(), v)
+        for k, v in response.headers.raw
+        if k.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS
+    ]
+
+
+class MeteredStream:
+    """Async iterable that counts the bytes passing through it.
+
+    Chunks are yielded unchanged, so metering adds no copies. `BodyTooLarge` is
+    raised once more than `max_bytes` have gone through, when a cap is given.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], max_bytes: Optional[int] = None):
+        self.chunks = chunks
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.chunks:
+            self.bytes += len(chunk)
+            if self.max_bytes and self.bytes > self.max_bytes:
+                raise BodyTooLarge(f"Body exceeds {self.max_bytes} bytes")
+            yield chunk
@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+from typing import Dict, List, Optional, Sequence, Set
+
+import httpx
+import redis.asyncio as redis
+from prometheus_client import Counter, Gauge, Histogram
+
+from upstream import UpstreamClients
+
+logger = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = "least_outstanding" # Fewest requests waiting on the target
+EWMA_LATENCY = "ewma" # Lowest smoothed latency, weighted by requests waiting on the target
+BALANCING_STRATEGIES = (LEAST_OUTSTANDING, EWMA_LATENCY)
+
+# Hash per API of "<gateway instance> <target URL>" -> that process' JSON stats, merged by management-api
+UPSTREAM_HEALTH_KEY_PREFIX = "upstream_health:"
+
+UPSTREAM_TARGET_REQUESTS = Counter('gateway_upstream_target_requests_total', 'Requests sent to each publisher backend target', ['api_id', 'target', 'outcome'])
+UPSTREAM_TARGET_LATENCY = Histogram('gateway_upstream_target_response_seconds', 'Time until a publisher backend target answered with response headers', ['api_id', 'target'])
+UPSTREAM_TARGET_HEALTHY = Gauge('gateway_upstream_target_healthy', 'Whether a publisher backend target passes active health checks', ['api_id', 'target'], multiprocess_mode='livemin')
+UPSTREAM_TARGET_EJECTIONS = Counter('gateway_upstream_target_ejections_total', 'Publisher backend targets taken out of rotation', ['api_id', 'target', 'reason'])
+
+
+class Target:
+    __slots__ = ("url", "outstanding", "ewma", "failures", "health_successes", "health_failures", "healthy", "ejected_until", "requests", "errors")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.ewma: Optional[float] = None # smoothed seconds until response headers
+        self.failures = 0 # consecutive failed requests
+        self.health_successes = 0 # consecutive passed health checks
+        self.health_failures = 0 # consecutive failed health checks
+        self.healthy = True # verdict of the active health checks
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+
+class UpstreamPool:
+    """The backend targets of one API and the state used to choose between them.
+
+    Each request goes to the better of two randomly chosen available targets
+    (power of two choices), compared by outstanding requests or by EWMA latency.
+    A target is ejected for `ejection_seconds` after `failure_threshold` failed
+    requests in a row, or when its EWMA latency exceeds `slow_factor` times that
+    of the fastest other target. The last available target is never ejected,
+    and when no target is available every target is tried rather than none.
+    """
+
+    def __init__(
+        self,
+        api_id,
+        urls: Sequence[str],
+        balancing: str = LEAST_OUTSTANDING,
+        health_check_path: str = "/",
+        failure_threshold: int = 5,
+        ejection_seconds: float = 30.0,
+        slow_factor: float = 3.0,
+        slow_min_latency: float = 0.2,
+        smoothing: float = 0.3,
+    ):
+        self.api_id = str(api_id)
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.slow_factor = slow_factor
+        self.slow_min_latency = slow_min_latency
+        self.smoothing = smoothing
+        self.targets: Dict[str, Target] = {}
+        self.configure(urls, balancing, health_check_path)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def configure(self, urls: Sequence[str], balancing: str, health_check_path: str):
+        # Targets that stay keep their state; removed ones are forgotten
+        self.targets = {url: self.targets.get(url) or Target(url) for url in urls}
+        if len(self.targets) == 1:
+            # A lone target is not health checked, so an old verdict would never be revised
+            target, = self.targets.values()
+            target.healthy, target.health_successes, target.health_failures = True, 0, 0
+        self.balancing = balancing if balancing in BALANCING_STRATEGIES else LEAST_OUTSTANDING
+        self.health_check_path = health_check_path
+        self._config = (tuple(urls), balancing, health_check_path)
+
+    def _load(self, target: Target) -> float:
+        if self.balancing == EWMA_LATENCY:
+            return (target.ewma or 0.0) * (target.outstanding + 1)
+        return target.outstanding
+
+    def pick(self, exclude: Optional[Target] = None) -> Target:
+        now = time.monotonic()
+        candidates = [target for target in self.targets.values() if target is not exclude]
+        available = [target for target in candidates if target.available(now)]
+        candidates = available or candidates or list(self.targets.values())
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if self._load(first) <= self._load(second) else second
+
+    def started(self, target: Target):
+        target.outstanding += 1
+        target.requests += 1
+
+    def abandoned(self, target: Target):
+        # The caller went away before the target answered, which says nothing about the target
+        target.outstanding -= 1
+
+    def finished(self, target: Target, latency: float, failed: bool):
+        target.outstanding -= 1
+        UPSTREAM_TARGET_REQUESTS.labels(api_id=self.api_id, target=target.url, outcome="error" if failed else "success").inc()
+        UPSTREAM_TARGET_LATENCY.labels(api_id=self.api_id, target=target.url).observe(latency)
+        if failed:
+            target.errors += 1
+            target.failures += 1
+            if target.failures >= self.failure_threshold:
+                self._eject(target, "failures")
+            return
+        target.failures = 0
+        target.ewma = latency if target.ewma is None else self.smoothing * latency + (1 - self.smoothing) * target.ewma
+        if self.slow_factor and target.ewma > self.slow_min_latency:
+            now = time.monotonic()
+            others = [other.ewma for other in self.targets.values() if other is not target and other.ewma is not None and other.available(now)]
+            if others and target.ewma > self.slow_factor * min(others):
+                self._eject(target, "slow")
+
+    def _eject(self, target: Target, reason: str):
+        now = time.monotonic()
+        if not any(other.available(now) for other in self.targets.values() if other is not target):
+            return
+        target.ejected_until = now + self.ejection_seconds
+        # Measured afresh when it returns
+        target.failures = 0
+        target.ewma = None
+        UPSTREAM_TARGET_EJECTIONS.labels(api_id=self.api_id, target=target.url, reason=reason).inc()
+        logger.warning(f"Ejected upstream target {target.url} of API {self.api_id} for {self.ejection_seconds}s ({reason})")
+
+    def record_health_check(self, target: Target, passed: bool, healthy_threshold: int, unhealthy_threshold: int):
+        if passed:
+            target.health_successes += 1
+            target.health_failures = 0
+            if not target.healthy and target.health_successes >= healthy_threshold:
+                target.healthy = True
+                logger.info(f"Upstream target {target.url} of API {self.api_id} is healthy again")
+        else:
+            target.health_failures += 1
+            target.health_successes = 0
+            if target.healthy and target.health_failures >= unhealthy_threshold:
+                target.healthy = False
+                logger.warning(f"Upstream target {target.url} of API {self.api_id} failed {target.health_failures} health checks")
+        UPSTREAM_TARGET_HEALTHY.labels(api_id=self.api_id, target=target.url).set(1 if target.healthy else 0)
+
+    def stats(self) -> Dict[str, str]:
+        now = time.monotonic()
+        return {
+            target.url: json.dumps({
+                "healthy": target.healthy,
+                "ejected": now < target.ejected_until,
+                "outstanding": target.outstanding,
+                "ewma_latency_ms": None if target.ewma is None else round(target.ewma * 1000, 3),
+                "requests": target.requests,
+                "errors": target.errors,
+                "updated_at": time.time(),
+            })
+            for target in self.targets.values()
+        }
+
+
+class UpstreamPools:
+    """Upstream pools of every API seen by this gateway process, plus their health checks.
+
+    Every `interval` seconds each target of a pool with more than one target gets
+    a GET on the pool's health check path; a response below 500 passes. Pools
+    with a single target are not checked, as it is used whatever the verdict. A target leaves rotation after
+    `unhealthy_threshold` failed checks in a row and returns after
+    `healthy_threshold` passed ones. Per-target stats are then written to Redis so
+    publishers can see them through management-api. Each process writes only its
+    own fields, named after `instance`, as its counters cover only its requests.
+    """
+
+    def __init__(
+        self,
+        clients: UpstreamClients,
+        interval: float = 10.0,
+        timeout: float = 2.0,
+        healthy_threshold: int = 2,
+        unhealthy_threshold: int = 3,
+        redis_client: Optional[redis.Redis] = None,
+        instance: Optional[str] = None,
+        **pool_options,
+    ):
+        self.clients = clients
+        self.interval = interval
+        self.timeout = timeout
+        self.healthy_threshold = healthy_threshold
+        self.unhealthy_threshold = unhealthy_threshold
+        self.redis_client = redis_client
+        self.instance = instance or f"{socket.gethostname()}:{os.getpid()}"
+        self.pool_options = pool_options
+        self._pools: Dict[str, UpstreamPool] = {}
+        self._published: Dict[str, Set[str]] = {} # Redis key -> our fields in it
+        self._task: Optional[asyncio.Task] = None
+        self._closing = asyncio.Event()
+
+    def get(self, api_id, urls: List[str], balancing: str, health_check_path: str) -> UpstreamPool:
+        pool = self._pools.get(str(api_id))
+        if pool is None:
+            pool = self._pools[str(api_id)] = UpstreamPool(api_id, urls, balancing, health_check_path, **self.pool_options)
+        elif pool._config != (tuple(urls), balancing, health_check_path):
+            pool.configure(urls, balancing, health_check_path)
+        return pool
+
+    async def _check(self, pool: UpstreamPool, target: Target):
+        try:
+            response = await self.clients.get(target.url).get(pool.health_check_path, timeout=self.timeout)
+            passed = response.status_code < 500
+        except httpx.HTTPError:
+            passed = False
+        pool.record_health_check(target, passed, self.healthy_threshold, self.unhealthy_threshold)
+
+    async def check_all(self):
+        pools = list(self._pools.values())
+        await asyncio.gather(*(
+            self._check(pool, target)
+            for pool in pools if len(pool) > 1
+            for target in list(pool.targets.values())
+        ))
+        if self.redis_client is None or not pools:
+            return
+        published = {}
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for pool in pools:
+                key = f"{UPSTREAM_HEALTH_KEY_PREFIX}{pool.api_id}"
+                stats = {f"{self.instance} {url}": value for url, value in pool.stats().items()}
+                published[key] = set(stats)
+                pipe.hset(key, mapping=stats)
+                pipe.expire(key, int(self.interval * 3))
+                # Fields of targets the API no longer has
+                removed = self._published.get(key, set()) - published[key]
+                if removed:
+                    pipe.hdel(key, *removed)
+            await pipe.execute()
+        self._published = published
+
+    async def unpublish(self):
+        """Removes this process' fields, so publishers stop seeing its figures right away."""
+        if self.redis_client is None or not self._published:
+            return
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for key, fields in self._published.items():
+                pipe.hdel(key, *fields)
+            await pipe.execute()
+        self._published = {}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            # The flag covers a cancellation swallowed by the Redis client mid-call
+            self._closing.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self.unpublish()
+        except Exception as e:
+            logger.warning(f"Could not remove upstream health stats: {e}")
+
+    async def _run(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), timeout=self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Upstream health checks failed: {e}", exc_info=True)
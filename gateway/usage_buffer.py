@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+import zlib
+from collections import deque
+from typing import Any, Dict, Optional
+
+import redis.asyncio as redis
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+USAGE_BUFFER_DEPTH = Gauge('gateway_usage_buffer_depth', 'Usage events waiting to be written to the usage stream', multiprocess_mode='livesum')
+USAGE_BUFFER_FLUSH_LATENCY = Histogram('gateway_usage_buffer_flush_duration_seconds', 'Time taken to write one batch of usage events')
+USAGE_BUFFER_FLUSHED_EVENTS = Counter('gateway_usage_buffer_flushed_events_total', 'Usage events written to the usage stream')
+USAGE_BUFFER_DROPPED_EVENTS = Counter('gateway_usage_buffer_dropped_events_total', 'Usage events dropped before reaching the usage stream', ['reason'])
+
+
+def usage_stream_partition(api_id, partitions: int) -> int:
+    # A stable hash, unlike hash(), so every gateway process and the billing worker agree
+    return zlib.crc32(str(api_id).encode()) % partitions
+
+
+def usage_stream_key(stream_key: str, partition: int) -> str:
+    return f"{stream_key}:{partition}"
+
+
+class UsageEventBuffer:
+    """In-process buffer that writes usage events to a Redis stream in batches.
+
+    Events are flushed with one pipelined round trip once `batch_size` events are
+    waiting or `flush_interval` seconds have passed, whichever comes first. The
+    stream is trimmed approximately by `maxlen` and, when `retention_seconds` is
+    set, by minimum entry ID. At most `capacity` events are held; beyond that new
+    events are dropped and counted rather than growing memory without bound.
+
+    Events are spread over `partitions` streams named `<stream_key>:<n>` by a hash
+    of their api_id, so that billing workers can split the streams between them.
+    `maxlen` caps all partitions together.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        stream_key: str,
+        batch_size: int = 500,
+        flush_interval: float = 0.05,
+        capacity: int = 100000,
+        maxlen: Optional[int] = None,
+        retention_seconds: Optional[int] = None,
+        partitions: int = 1,
+    ):
+        self.redis_client = redis_client
+        self.stream_key = stream_key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.maxlen = maxlen
+        self.retention_seconds = retention_seconds
+        self.partitions = max(1, partitions)
+        self._events: deque = deque()
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, event: Dict[str, Any]) -> bool:
+        if len(self._events) >= self.capacity:
+            USAGE_BUFFER_DROPPED_EVENTS.labels(reason="buffer_full").inc()
+            return False
+        self._events.append(event)
+        USAGE_BUFFER_DEPTH.set(len(self._events))
+        if len(self._events) >= self.batch_size:
+            self._batch_ready.set()
+        return True
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            # Stopped with a flag as well as a cancellation: the Redis client can swallow
+            # a cancellation that lands mid-flush, which would leave the loop running
+            self._closing = True
+            self._batch_ready.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Drain whatever is left; stop if Redis rejects a batch so shutdown cannot hang
+        while self._events:
+            if not await self.flush():
+                break
+        if self._events:
+            USAGE_BUFFER_DROPPED_EVENTS.labels(reason="shutdown").inc(len(self._events))
+            logger.error(f"Dropped {len(self._events)} usage events on shutdown")
+            self._events.clear()
+            USAGE_BUFFER_DEPTH.set(0)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            while self._events:
+                if not await self.flush():
+                    await asyncio.sleep(1) # Back off while Redis is failing
+                    break
+                if len(self._events) < self.batch_size:
+                    break
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._events:
+                return True
+
+            batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+            start = time.perf_counter()
+            try:
+                maxlen = self.maxlen and max(1, self.maxlen // self.partitions)
+                streams = set()
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for event in batch:
+                        stream = usage_stream_key(self.stream_key, usage_stream_partition(event.get("api_id"), self.partitions))
+                        streams.add(stream)
+                        pipe.xadd(stream, event, maxlen=maxlen, approximate=True)
+                    if self.retention_seconds:
+                        min_id = int((time.time() - self.retention_seconds) * 1000)
+                        for stream in streams:
+                            pipe.xtrim(stream, minid=f"{min_id}-0", approximate=True)
+                    # Errors are returned per command, so a failed XADD does not hide the ones Redis applied
+                    results = await pipe.execute(raise_on_error=False)
+            except Exception as e:
+                # No replies came back, so which events Redis applied is unknown; the whole batch is retried
+                logger.error(f"Failed to flush {len(batch)} usage events: {e}", exc_info=True)
+                self._requeue(batch)
+                return False
+
+            # Only the events whose XADD failed go back; re-adding the others would bill them twice
+            failed = [event for event, result in zip(batch, results) if isinstance(result, Exception)]
+            if failed:
+                error = next(result for result in results if isinstance(result, Exception))
+                logger.error(f"Failed to flush {len(failed)} of {len(batch)} usage events: {error}")
+                self._requeue(failed)
+            flushed = len(batch) - len(failed)
+            if flushed:
+                USAGE_BUFFER_FLUSH_LATENCY.observe(time.perf_counter() - start)
+                USAGE_BUFFER_FLUSHED_EVENTS.inc(flushed)
+            USAGE_BUFFER_DEPTH.set(len(self._events))
+            return not failed
+
+    def _requeue(self, events):
+        # Put the events back in front, keeping as much as capacity allows
+        room = max(0, self.capacity - len(self._events))
+        if room < len(events):
+            USAGE_BUFFER_DROPPED_EVENTS.labels(reason="flush_failed").inc(len(events) - room)
+        self._events.extendleft(reversed(events[:room]))
+        USAGE_BUFFER_DEPTH.set(len(self._events))
@@ -2,15 +2,29 @@ from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import func
-from datetime import date, datetime
-from typing import List, Optional
+from datetime import date, datetime, timezone
+from typing import List, Literal, Optional
+import os
 
 import crud, schemas, models
 from database import get_db
-from auth import get_current_active_user
+from auth import get_current_active_user, get_owned_api
+from usage_rollups import series_resolution, usage_series_query, usage_totals_query
+
+USAGE_SERIES_MAX_POINTS = int(os.getenv("USAGE_SERIES_MAX_POINTS", "1000")) # Buckets per series when no resolution is asked for
 
 analytics_router = APIRouter()
 
+def _usage_range(start: datetime, end: Optional[datetime]):
+    end = end or datetime.now(timezone.utc)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end")
+    return start, end
+
 @analytics_router.get("/apis/{api_id}/usage", response_model=List[schemas.UsageAggregateInDB])
 async def get_api_usage(
     api_id: int,
@@ -21,10 +35,10 @@ async def get_api_usage(
     db: AsyncSession = Depends(get_db)
 ):
     # Verify that the current user owns the API or is an admin
-    db_api = await crud.get_api_by_id(db, api_id)
-    if not db_api or (db_api.owner_id != current_user.id and current_user.role != "admin"):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="API not found or unauthorized")
+    await get_owned_api(db, api_id, current_user, allow_admin=True)
 
+    # One row per client and day, so this reads the daily rollup; totals over a
+    # period come from /usage/summary, which picks the coarsest rollup
     query = select(models.UsageAggregate).filter(models.UsageAggregate.api_id == api_id)
 
     if start_date:
@@ -37,4 +51,49 @@ async def get_api_usage(
     result = await db.execute(query.order_by(models.UsageAggregate.date))
     usage_data = result.scalars().all()
 
-    return usage_data
\ No newline at end of file
+    return usage_data
+
+@analytics_router.get("/apis/{api_id}/usage/summary", response_model=schemas.UsageSummary)
+async def get_api_usage_summary(
+    api_id: int,
+    start: datetime = Query(..., description="Start of the period, inclusive (ISO 8601, UTC unless given)"),
+    end: Optional[datetime] = Query(None, description="End of the period, exclusive; defaults to now"),
+    client_id: Optional[int] = Query(None, description="Filter by client ID"),
+    current_user: schemas.UserInDB = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db)
+):
+    await get_owned_api(db, api_id, current_user, allow_admin=True)
+    start, end = _usage_range(start, end)
+
+    # Read from the coarsest rollup that answers the period exactly, e.g. the month rollup for whole months
+    resolution, rollup, query = usage_totals_query(start, end)
+    query = query.filter(rollup.api_id == api_id)
+    if client_id:
+        query = query.filter(rollup.client_id == client_id)
+    totals = (await db.execute(query)).one()
+
+    return schemas.UsageSummary(
+        api_id=api_id, client_id=client_id, start=start, end=end, resolution=resolution, **totals._mapping,
+    )
+
+@analytics_router.get("/apis/{api_id}/usage/series", response_model=List[schemas.UsageSeriesPoint])
+async def get_api_usage_series(
+    api_id: int,
+    start: datetime = Query(..., description="Start of the period, inclusive (ISO 8601, UTC unless given)"),
+    end: Optional[datetime] = Query(None, description="End of the period, exclusive; defaults to now"),
+    resolution: Optional[Literal["minute", "hour", "day", "month"]] = Query(None, description="Bucket size; by default the finest one that keeps the series short"),
+    client_id: Optional[int] = Query(None, description="Filter by client ID"),
+    current_user: schemas.UserInDB = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db)
+):
+    await get_owned_api(db, api_id, current_user, allow_admin=True)
+    start, end = _usage_range(start, end)
+
+    resolution = resolution or series_resolution(start, end, USAGE_SERIES_MAX_POINTS)
+    rollup, query = usage_series_query(start, end, resolution)
+    query = query.filter(rollup.api_id == api_id)
+    if client_id:
+        query = query.filter(rollup.client_id == client_id)
+    rows = (await db.execute(query)).all()
+
+    return [schemas.UsageSeriesPoint(resolution=resolution, **row._mapping) for row in rows]
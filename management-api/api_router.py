@@ -2,9 +2,12 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
+from datetime import datetime, timezone
+
 import crud, schemas, models
 from database import get_db
-from auth import get_current_active_user
+from auth import get_current_active_user, get_owned_api
+from redis_client import get_upstream_health
 
 api_router = APIRouter()
 
@@ -28,3 +31,46 @@ async def create_plan_for_api(api_id: int, plan: schemas.PlanBase, current_user:
     
     plan_create = schemas.PlanCreate(api_id=api_id, **plan.dict())
     return await crud.create_plan(db=db, plan=plan_create)
+
+
+@api_router.put("/apis/{api_id}/plans/{plan_id}", response_model=schemas.PlanInDB)
+async def update_plan_for_api(api_id: int, plan_id: int, plan: schemas.PlanUpdate, current_user: schemas.UserInDB = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    db_api = await crud.get_api_by_id(db, api_id=api_id)
+    if db_api is None or db_api.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="API not found or you don't have permission to update plans for this API")
+
+    db_plan = await crud.get_plan_by_id(db, plan_id=plan_id)
+    if db_plan is None or db_plan.api_id != api_id:
+        raise HTTPException(status_code=404, detail="Plan not found")
+
+    # Gateways are notified and reload their policy table without a restart
+    return await crud.update_plan(db=db, db_plan=db_plan, plan=plan)
+
+
+@api_router.post("/apis/{api_id}/targets", response_model=schemas.UpstreamTargetInDB, status_code=status.HTTP_201_CREATED)
+async def create_upstream_target(api_id: int, target: schemas.UpstreamTargetCreate, current_user: schemas.UserInDB = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    await get_owned_api(db, api_id, current_user)
+    return await crud.create_upstream_target(db=db, target=target, api_id=api_id)
+
+@api_router.get("/apis/{api_id}/targets", response_model=List[schemas.UpstreamTargetInDB])
+async def list_upstream_targets(api_id: int, current_user: schemas.UserInDB = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    await get_owned_api(db, api_id, current_user)
+    return await crud.get_upstream_targets(db, api_id=api_id)
+
+@api_router.delete("/apis/{api_id}/targets/{target_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_upstream_target(api_id: int, target_id: int, current_user: schemas.UserInDB = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    await get_owned_api(db, api_id, current_user)
+    db_target = await crud.get_upstream_target_by_id(db, target_id=target_id)
+    if db_target is None or db_target.api_id != api_id:
+        raise HTTPException(status_code=404, detail="Upstream target not found")
+    await crud.delete_upstream_target(db, db_target)
+
+@api_router.get("/apis/{api_id}/targets/health", response_model=List[schemas.UpstreamTargetHealth])
+async def get_upstream_target_health(api_id: int, current_user: schemas.UserInDB = Depends(get_current_active_user), db: AsyncSession = Depends(get_db)):
+    # Latest per-target health, latency and error figures, merged over the gateways
+    await get_owned_api(db, api_id, current_user)
+    health = await get_upstream_health(api_id)
+    return [
+        schemas.UpstreamTargetHealth(url=url, **{**stats, "updated_at": datetime.fromtimestamp(stats["updated_at"], timezone.utc)})
+        for url, stats in sorted(health.items())
+    ]
@@ -6,7 +6,7 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from sqlalchemy.ext.asyncio import AsyncSession
 
-import crud, schemas
+import crud, models, schemas
 from database import get_db
 
 # Configuration for JWT
@@ -48,3 +48,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
 async def get_current_active_user(current_user: schemas.UserInDB = Depends(get_current_user)):
     # Add any active checks here if needed
     return current_user
+
+async def get_owned_api(db: AsyncSession, api_id: int, current_user: schemas.UserInDB, allow_admin: bool = False) -> models.API:
+    """The API if `current_user` owns it (or is an admin, when `allow_admin`); 404 otherwise."""
+    db_api = await crud.get_api_by_id(db, api_id=api_id)
+    if db_api is None or (db_api.owner_id != current_user.id and not (allow_admin and current_user.role == "admin")):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="API not found or unauthorized")
+    return db_api
@@ -1,10 +1,15 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
 import models, schemas
 from passlib.context import CryptContext
 import stripe
 import os
+import logging
+from redis_client import publish_api_key_revocation, publish_plan_update
+from key_filter import add_key_to_filter
+
+logger = logging.getLogger(__name__)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -54,13 +59,57 @@ async def create_api(db: AsyncSession, api: schemas.APICreate, owner_id: int):
     await db.refresh(db_api)
     return db_api
 
+async def create_upstream_target(db: AsyncSession, target: schemas.UpstreamTargetCreate, api_id: int):
+    db_target = models.UpstreamTarget(**target.dict(), api_id=api_id)
+    db.add(db_target)
+    await db.commit()
+    await db.refresh(db_target)
+    return db_target
+
+async def get_upstream_targets(db: AsyncSession, api_id: int):
+    result = await db.execute(select(models.UpstreamTarget).filter(models.UpstreamTarget.api_id == api_id))
+    return result.scalars().all()
+
+async def get_upstream_target_by_id(db: AsyncSession, target_id: int):
+    result = await db.execute(select(models.UpstreamTarget).filter(models.UpstreamTarget.id == target_id))
+    return result.scalars().first()
+
+async def delete_upstream_target(db: AsyncSession, db_target: models.UpstreamTarget):
+    # Gateways pick up target changes as their cached copies of the API's keys expire
+    await db.delete(db_target)
+    await db.commit()
+
+async def _announce_plan_change(db_plan: models.Plan):
+    try:
+        await publish_plan_update(db_plan.id)
+    except Exception:
+        logger.warning(f"Error publishing update for plan {db_plan.id}", exc_info=True)
+        # Gateways will still pick up the change on their next periodic reload
+
 async def create_plan(db: AsyncSession, plan: schemas.PlanCreate):
     db_plan = models.Plan(**plan.dict())
     db.add(db_plan)
     await db.commit()
     await db.refresh(db_plan)
+    await _announce_plan_change(db_plan)
     return db_plan
 
+async def get_plan_by_id(db: AsyncSession, plan_id: int):
+    result = await db.execute(select(models.Plan).filter(models.Plan.id == plan_id))
+    return result.scalars().first()
+
+async def update_plan(db: AsyncSession, db_plan: models.Plan, plan: schemas.PlanUpdate):
+    for field, value in plan.dict(exclude_unset=True).items():
+        setattr(db_plan, field, value)
+    await db.commit()
+    await db.refresh(db_plan)
+    await _announce_plan_change(db_plan)
+    return db_plan
+
+async def get_all_plans(db: AsyncSession):
+    result = await db.execute(select(models.Plan))
+    return result.scalars().all()
+
 async def create_client(db: AsyncSession, client: schemas.ClientCreate):
     db_client = models.Client(**client.dict())
     db.add(db_client)
@@ -77,13 +126,31 @@ async def create_api_key(db: AsyncSession, api_key: schemas.APIKeyCreate, key_ha
     db.add(db_api_key)
     await db.commit()
     await db.refresh(db_api_key)
+    try:
+        await add_key_to_filter(key_hash)
+    except Exception:
+        logger.warning(f"Error adding API key {db_api_key.id} to the gateway key filter", exc_info=True)
+        # Gateways may reject the key until the next periodic filter rebuild
     return db_api_key
 
 async def get_api_key_by_hash(db: AsyncSession, key_hash: str):
     result = await db.execute(
-        select(models.APIKey).options(joinedload(models.APIKey.api).joinedload(models.API.plans)).filter(models.APIKey.key_hash == key_hash)
+        select(models.APIKey)
+        .options(
+            joinedload(models.APIKey.api).joinedload(models.API.plans),
+            joinedload(models.APIKey.api).selectinload(models.API.upstream_targets),
+        )
+        .filter(models.APIKey.key_hash == key_hash)
     )
     api_key = result.scalars().first()
+    if api_key and api_key.api:
+        api_key.api_base_url = api_key.api.base_url
+        api_key.api_response_cache_enabled = api_key.api.response_cache_enabled
+        api_key.api_response_cache_vary_headers = api_key.api.response_cache_vary_headers
+        api_key.api_response_cache_max_ttl_seconds = api_key.api.response_cache_max_ttl_seconds
+        api_key.api_upstream_targets = [target.url for target in api_key.api.upstream_targets if target.enabled]
+        api_key.api_load_balancing = api_key.api.load_balancing
+        api_key.api_health_check_path = api_key.api.health_check_path
     if api_key and api_key.api and api_key.api.plans:
         # Assuming an API key is tied to one active plan for rate limiting purposes
         # This logic might need refinement based on how plans are assigned to API keys
@@ -96,4 +163,9 @@ async def revoke_api_key(db: AsyncSession, api_key_id: int):
         db_api_key.status = "revoked"
         await db.commit()
         await db.refresh(db_api_key)
+        try:
+            await publish_api_key_revocation(db_api_key.key_hash)
+        except Exception:
+            logger.warning(f"Error publishing revocation for API key {db_api_key.id}", exc_info=True)
+            # Gateways will still drop the key once their cache entries expire
     return db_api_key
\ No newline at end of file
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import models
+from redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Bloom filter of active API key hashes, kept in Redis as a bitmap the gateway
+# loads into memory. The gateway derives bit positions the same way, so these
+# settings must match its API_KEY_FILTER_* configuration.
+API_KEY_FILTER_KEY = "api_key_filter"
+API_KEY_FILTER_UPDATES_CHANNEL = "api_key_filter_updates"
+API_KEY_FILTER_BITS = 1 << 24 # 2 MiB, ~0.05% false positives at one million keys
+API_KEY_FILTER_HASHES = 7
+# Periodic rebuilds drop revoked keys and repair bits lost while Redis was unavailable
+API_KEY_FILTER_REBUILD_INTERVAL = int(os.getenv("API_KEY_FILTER_REBUILD_INTERVAL", "3600")) # seconds
+
+def filter_positions(key_hash: str):
+    # key_hash is a SHA-256 hex digest, so its 32-bit slices are already independent hashes
+    return [int(key_hash[i * 8:(i + 1) * 8], 16) % API_KEY_FILTER_BITS for i in range(API_KEY_FILTER_HASHES)]
+
+def _set_bit(bits: bytearray, position: int):
+    # Same bit order as Redis SETBIT: offset 0 is the most significant bit of byte 0
+    bits[position >> 3] |= 0x80 >> (position & 7)
+
+async def rebuild_api_key_filter(db: AsyncSession):
+    started_at = datetime.now(timezone.utc)
+    bits = bytearray(API_KEY_FILTER_BITS // 8)
+    result = await db.stream_scalars(select(models.APIKey.key_hash).filter(models.APIKey.status == "active"))
+    count = 0
+    async for key_hash in result:
+        for position in filter_positions(key_hash):
+            _set_bit(bits, position)
+        count += 1
+    await redis_client.set(API_KEY_FILTER_KEY, bytes(bits))
+
+    # Keys created while the table was being read may have had their bits overwritten
+    recent = await db.execute(
+        select(models.APIKey.key_hash).filter(
+            models.APIKey.status == "active",
+            models.APIKey.created_at >= started_at - timedelta(minutes=1)
+        )
+    )
+    for key_hash in recent.scalars().all():
+        await add_key_to_filter(key_hash)
+    return count
+
+async def add_key_to_filter(key_hash: str):
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for position in filter_positions(key_hash):
+            pipe.setbit(API_KEY_FILTER_KEY, position, 1)
+        pipe.publish(API_KEY_FILTER_UPDATES_CHANNEL, key_hash)
+        await pipe.execute()
+
+async def run_api_key_filter_rebuilds(session_factory):
+    while True:
+        await asyncio.sleep(API_KEY_FILTER_REBUILD_INTERVAL)
+        try:
+            async with session_factory() as db:
+                await rebuild_api_key_filter(db)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.warning("Error rebuilding the API key filter", exc_info=True)
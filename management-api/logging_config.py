@@ -0,0 +1,116 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from typing import Dict
+
+from prometheus_client import Counter
+
+try:
+    import orjson
+except ImportError: # orjson is optional; fall back to the standard library encoder
+    orjson = None
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0")) # Share of successful requests logged
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "/metrics=0") # Per-route overrides, e.g. "/metrics=0,/apis/{api_id}=0.1"
+LOG_SLOW_REQUEST_SECONDS = float(os.getenv("LOG_SLOW_REQUEST_SECONDS", "1.0")) # Slower requests are always logged
+
+LOG_RECORDS_DROPPED = Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+def dumps(log_record: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(log_record, default=str).decode()
+    return json.dumps(log_record, default=str)
+
+# Configure JSON logging
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        log_record = {
+            "timestamp": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "service": self.service,
+            "request_id": getattr(record, 'request_id', None),
+            "endpoint": getattr(record, 'endpoint', None),
+            "method": getattr(record, 'method', None),
+            "status_code": getattr(record, 'status_code', None),
+            "duration_ms": getattr(record, 'duration_ms', None),
+            "traceback": record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None),
+        }
+        return dumps(log_record)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without ever blocking the event loop.
+
+    When the queue is full (stdout or the GELF pipe is backed up) the record is
+    dropped and counted instead of stalling the caller.
+    """
+
+    def prepare(self, record):
+        # Resolve the message and traceback while args and exc_info are still valid;
+        # JSON encoding and the write happen on the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        route, _, rate = item.rpartition("=")
+        rates[route] = float(rate)
+    return rates
+
+class RequestLogSampler:
+    """Decides whether the log line for a completed request is written.
+
+    Errors (status >= 400) and slow requests are always kept; other requests
+    are kept with the probability configured for their route.
+    """
+
+    def __init__(self, default_rate: float, route_rates: Dict[str, float], slow_request_seconds: float):
+        self.default_rate = default_rate
+        self.route_rates = route_rates
+        self.slow_request_seconds = slow_request_seconds
+
+    def should_log(self, route: str, status_code: int, duration_seconds: float) -> bool:
+        if status_code >= 400 or duration_seconds >= self.slow_request_seconds:
+            return True
+        rate = self.route_rates.get(route, self.default_rate)
+        return rate >= 1.0 or random.random() < rate
+
+def configure_logging(service: str, level: int = logging.INFO, stream=None) -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(JsonFormatter(service))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # Flush what is queued on interpreter exit
+
+    # Attach to the root logger so every module of the service shares the pipeline
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+    # httpx logs every request it sends at INFO, which would add a line per proxied call
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(max(level, logging.WARNING))
+    return listener
+
+request_log_sampler = RequestLogSampler(LOG_SAMPLE_RATE, parse_sample_rates(LOG_SAMPLE_RATES), LOG_SLOW_REQUEST_SECONDS)
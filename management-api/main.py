@@ -1,6 +1,9 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import init_db, get_db
+from database import init_db, get_db, AsyncSessionLocal
+from key_filter import rebuild_api_key_filter, run_api_key_filter_rebuilds
+from logging_config import configure_logging
+from request_metrics import RequestMetricsMiddleware
 import models, schemas
 from auth_router import auth_router
 from api_router import api_router
@@ -15,41 +18,35 @@ from stripe_connect_router import stripe_connect_router
 from prometheus_client import generate_latest, Counter, Histogram
 from starlette.responses import PlainTextResponse
 
+import asyncio
 import logging
-import json
-import uuid
-
-# Configure JSON logging
-class JsonFormatter(logging.Formatter):
-    def format(self, record):
-        log_record = {
-            "timestamp": self.formatTime(record, self.datefmt),
-            "level": record.levelname,
-            "message": record.getMessage(),
-            "service": "management-api",
-            "request_id": getattr(record, 'request_id', None),
-            "endpoint": getattr(record, 'endpoint', None),
-            "method": getattr(record, 'method', None),
-            "status_code": getattr(record, 'status_code', None),
-            "traceback": self.formatException(record.exc_info) if record.exc_info else None,
-        }
-        return json.dumps(log_record)
+import redis.asyncio as redis
 
+configure_logging("management-api")
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(JsonFormatter())
-logger.addHandler(handler)
 
 app = FastAPI()
 
 # Prometheus Metrics
+# Labelled by route template, e.g. /apis/{api_id}, never by the raw path
 REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP Requests', ['method', 'endpoint', 'status_code'])
 REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP Request Latency', ['method', 'endpoint'])
+app.add_middleware(RequestMetricsMiddleware, request_count=REQUEST_COUNT, request_latency=REQUEST_LATENCY)
+
 
 @app.on_event("startup")
 async def on_startup():
     await init_db()
+    # Gateways reject keys missing from this filter without any I/O, so build it before serving.
+    # Without Redis the API still starts: gateways check keys against this service while
+    # the filter is missing, and the periodic rebuild creates it once Redis is back
+    try:
+        async with AsyncSessionLocal() as db:
+            count = await rebuild_api_key_filter(db)
+        logger.info(f"Rebuilt API key filter with {count} active keys")
+    except redis.RedisError:
+        logger.warning("Could not rebuild the API key filter on startup", exc_info=True)
+    asyncio.create_task(run_api_key_filter_rebuilds(AsyncSessionLocal))
 
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
 app.include_router(api_router, tags=["apis"])
@@ -61,31 +58,6 @@ app.include_router(webhook_router, prefix="/webhooks", tags=["webhooks"])
 app.include_router(publisher_analytics_router, tags=["publisher-analytics"])
 app.include_router(stripe_connect_router, prefix="/stripe-connect", tags=["stripe-connect"])
 
-@app.middleware("http")
-async def add_prometheus_metrics_and_logging(request: Request, call_next):
-    request_id = str(uuid.uuid4())
-    request.state.request_id = request_id # Store request_id in request state
-
-    method = request.method
-    endpoint = request.url.path
-    
-    extra_log_data = {
-        "request_id": request_id,
-        "method": method,
-        "endpoint": endpoint
-    }
-
-    logger.info(f"Incoming request: {method} {endpoint}", extra=extra_log_data)
-
-    with REQUEST_LATENCY.labels(method=method, endpoint=endpoint).time():
-        response = await call_next(request)
-    
-    REQUEST_COUNT.labels(method=method, endpoint=endpoint, status_code=response.status_code).inc()
-    extra_log_data["status_code"] = response.status_code
-    logger.info(f"Outgoing response: {method} {endpoint} {response.status_code}", extra=extra_log_data)
-
-    return response
-
 @app.get("/")
 async def root():
     logger.info("Root endpoint accessed.", extra={"request_id": getattr(app.state, 'request_id', None)})
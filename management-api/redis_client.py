@@ -0,0 +1,61 @@
+import json
+import os
+import time
+from collections import defaultdict
+import redis.asyncio as redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Keys and channels shared with the gateway
+API_KEY_CACHE_PREFIX = "api_key:"
+API_KEY_REVOCATION_CHANNEL = "api_key_revocations"
+API_KEY_INVALID_PREFIX = "api_key_invalid:" # Negative cache of rejected key hashes
+API_KEY_INVALID_EXPIRATION = 60 # seconds
+PLAN_UPDATES_CHANNEL = "plan_updates" # Gateways reload their plan policy table when this fires
+UPSTREAM_HEALTH_KEY_PREFIX = "upstream_health:" # Per-API hash of "<gateway instance> <target URL>" -> JSON stats, written by gateways
+UPSTREAM_HEALTH_STALE_SECONDS = int(os.getenv("UPSTREAM_HEALTH_STALE_SECONDS", "60")) # Stats of gateways silent for longer are ignored
+
+redis_client: redis.Redis = redis.from_url(REDIS_URL, decode_responses=True)
+
+async def publish_api_key_revocation(key_hash: str):
+    # Remove the shared cache entry first so a gateway that misses its L1 cache
+    # cannot repopulate it from Redis, then tell every gateway to drop its L1 copy.
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(f"{API_KEY_CACHE_PREFIX}{key_hash}")
+        pipe.setex(f"{API_KEY_INVALID_PREFIX}{key_hash}", API_KEY_INVALID_EXPIRATION, "revoked")
+        pipe.publish(API_KEY_REVOCATION_CHANNEL, key_hash)
+        await pipe.execute()
+
+async def publish_plan_update(plan_id: int):
+    await redis_client.publish(PLAN_UPDATES_CHANNEL, str(plan_id))
+
+async def get_upstream_health(api_id: int) -> dict:
+    """Per-target stats of the API merged over the gateway processes reporting them.
+
+    Counters are summed. A target is healthy only if every gateway finds it
+    healthy, and ejected if any gateway has ejected it.
+    """
+    raw = await redis_client.hgetall(f"{UPSTREAM_HEALTH_KEY_PREFIX}{api_id}")
+    cutoff = time.time() - UPSTREAM_HEALTH_STALE_SECONDS
+    reports_by_url = defaultdict(list)
+    for field, value in raw.items():
+        stats = json.loads(value)
+        # Older stats were left behind by a gateway process that went away
+        if stats["updated_at"] >= cutoff:
+            reports_by_url[field.split(" ", 1)[-1]].append(stats)
+
+    merged = {}
+    for url, reports in reports_by_url.items():
+        # Latency is averaged by the number of requests each gateway measured it over
+        latencies = [(report["ewma_latency_ms"], max(1, report["requests"])) for report in reports if report["ewma_latency_ms"] is not None]
+        merged[url] = {
+            "healthy": all(report["healthy"] for report in reports),
+            "ejected": any(report["ejected"] for report in reports),
+            "outstanding": sum(report["outstanding"] for report in reports),
+            "ewma_latency_ms": round(sum(ms * weight for ms, weight in latencies) / sum(weight for _, weight in latencies), 3) if latencies else None,
+            "requests": sum(report["requests"] for report in reports),
+            "errors": sum(report["errors"] for report in reports),
+            "gateways": len(reports),
+            "updated_at": max(report["updated_at"] for report in reports),
+        }
+    return merged
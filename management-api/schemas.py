@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, EmailStr, Field
+from typing import Optional, List, Dict, Any, Literal
 from datetime import datetime, date
 
 # User Schemas
@@ -24,6 +24,11 @@ class APIBase(BaseModel):
     name: str
     description: Optional[str] = None
     base_url: str
+    response_cache_enabled: bool = False
+    response_cache_vary_headers: Optional[str] = None # e.g. "accept,accept-language"
+    response_cache_max_ttl_seconds: Optional[int] = Field(None, gt=0)
+    load_balancing: Optional[Literal["least_outstanding", "ewma"]] = None
+    health_check_path: Optional[str] = Field(None, pattern=r"^/")
 
 class APICreate(APIBase):
     pass
@@ -36,6 +41,33 @@ class APIInDB(APIBase):
     class Config:
         from_attributes = True
 
+# Upstream Target Schemas
+class UpstreamTargetBase(BaseModel):
+    url: str
+    enabled: bool = True
+
+class UpstreamTargetCreate(UpstreamTargetBase):
+    pass
+
+class UpstreamTargetInDB(UpstreamTargetBase):
+    id: int
+    api_id: int
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class UpstreamTargetHealth(BaseModel):
+    url: str
+    healthy: bool
+    ejected: bool
+    outstanding: int
+    ewma_latency_ms: Optional[float] = None
+    requests: int
+    errors: int
+    gateways: int # Gateway processes reporting the target
+    updated_at: datetime
+
 # Plan Schemas
 class PlanBase(BaseModel):
     name: str
@@ -45,10 +77,30 @@ class PlanBase(BaseModel):
     unit_price_cents: Optional[int] = None
     stripe_price_id: Optional[str] = None
     quota_limit: Optional[int] = None # New field for quota limit
+    rate_limit_requests: Optional[int] = Field(None, gt=0)
+    rate_limit_window_seconds: Optional[int] = Field(None, gt=0)
+    rate_limit_burst: Optional[int] = Field(None, gt=0)
+    rate_limit_algorithm: Optional[Literal["sliding_window_log", "sliding_window_counter", "token_bucket", "gcra", "leased_token_bucket"]] = None
+    rate_limit_failure_mode: Optional[Literal["open", "closed"]] = None
+    priority: Optional[int] = Field(None, ge=0)
 
 class PlanCreate(PlanBase):
     api_id: int
 
+class PlanUpdate(BaseModel):
+    name: Optional[str] = None
+    price_cents: Optional[int] = None
+    unit_type: Optional[str] = None
+    unit_price_cents: Optional[int] = None
+    stripe_price_id: Optional[str] = None
+    quota_limit: Optional[int] = None
+    rate_limit_requests: Optional[int] = Field(None, gt=0)
+    rate_limit_window_seconds: Optional[int] = Field(None, gt=0)
+    rate_limit_burst: Optional[int] = Field(None, gt=0)
+    rate_limit_algorithm: Optional[Literal["sliding_window_log", "sliding_window_counter", "token_bucket", "gcra", "leased_token_bucket"]] = None
+    rate_limit_failure_mode: Optional[Literal["open", "closed"]] = None
+    priority: Optional[int] = Field(None, ge=0)
+
 class PlanInDB(PlanBase):
     id: int
     api_id: int
@@ -84,6 +136,13 @@ class APIKeyInDB(BaseModel):
     created_at: datetime
     expires_at: Optional[datetime] = None
     plan: Optional[PlanInDB] = None # Add plan details here
+    api_base_url: Optional[str] = None # Publisher backend the gateway proxies to
+    api_response_cache_enabled: bool = False
+    api_response_cache_vary_headers: Optional[str] = None
+    api_response_cache_max_ttl_seconds: Optional[int] = None
+    api_upstream_targets: List[str] = [] # Enabled backend replicas; api_base_url is used when empty
+    api_load_balancing: Optional[str] = None
+    api_health_check_path: Optional[str] = None
 
     class Config:
         from_attributes = True
@@ -101,6 +160,8 @@ class UsageAggregateBase(BaseModel):
     date: date
     total_requests: int
     total_bytes: int
+    total_request_bytes: Optional[int] = 0
+    total_response_bytes: Optional[int] = 0
 
 class UsageAggregateInDB(UsageAggregateBase):
     id: int
@@ -108,6 +169,23 @@ class UsageAggregateInDB(UsageAggregateBase):
     class Config:
         from_attributes = True
 
+class UsageTotals(BaseModel):
+    total_requests: int
+    total_bytes: int
+    total_request_bytes: int
+    total_response_bytes: int
+
+class UsageSummary(UsageTotals):
+    api_id: int
+    client_id: Optional[int] = None
+    start: datetime
+    end: datetime
+    resolution: Literal["minute", "hour", "day", "month"] # Rollup the totals were read from
+
+class UsageSeriesPoint(UsageTotals):
+    bucket_start: datetime
+    resolution: Literal["minute", "hour", "day", "month"]
+
 # Subscription Schemas
 class SubscriptionBase(BaseModel):
     user_id: int
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 import hashlib
+from typing import List
 
 import crud, schemas
 from database import get_db
@@ -15,4 +16,9 @@ async def validate_api_key(api_key_raw: str, db: AsyncSession = Depends(get_db))
     if not db_api_key or db_api_key.status != "active":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API Key")
     
-    return db_api_key
\ No newline at end of file
+    return db_api_key
+
+@validation_router.get("/plan-policies", response_model=List[schemas.PlanInDB])
+async def get_plan_policies(db: AsyncSession = Depends(get_db)):
+    # Loaded by the gateway to build its per-plan rate limit and quota table
+    return await crud.get_all_plans(db)